@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Times dicomorg on a synthetic session
+
+Generates a session (see synthetic.py), then times each stage: reading
+the directory into a dcmtable and a dcmtable_light, grouping by series,
+building the seriestable, aliasing with undo and redo, and converting
+with the stub dcm2niix in bin. Each stage reports its best wall time
+over the repeats and its peak traced memory from one extra run.
+
+Results can be saved as a named baseline in baselines/, and compared
+against one later, e.g.
+
+    python benchmarks/run.py --series 16 --slices 64 --save before
+    (change something)
+    python benchmarks/run.py --series 16 --slices 64 --compare before
+
+baselines/example.json only shows what a baseline holds; its timings
+are from one machine, so save a baseline of your own to compare with.
+"""
+
+import os
+import os.path as op
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+HERE = op.dirname(op.abspath(__file__))
+sys.path.insert(0, op.dirname(HERE))
+
+from dicomorg.dcmutil import dcmtable, dcmtable_light, seriestable
+from dicomorg.colors import *
+from synthetic import make_session
+
+BASELINES = op.join(HERE, 'baselines')
+STUB = op.join(HERE, 'bin')
+
+
+def measure(stage, repeat):
+    """Times a stage
+
+    Parameters
+    ----------
+    stage : callable
+        Takes no arguments; called repeat + 1 times
+    repeat : int
+        The number of timed runs
+
+    Returns
+    -------
+    A dict of the best and mean wall time in seconds and the peak traced
+    memory in bytes
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+    # Tracing slows everything down, so memory gets its own run
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'best': min(times), 'mean': sum(times) / len(times),
+            'peak': peak}
+
+
+def stages(session, outpath, workers, jobs, edits):
+    """Returns the (name, callable) stages to time, in order"""
+    state = {}
+
+    def scan():
+        state['table'] = dcmtable(session, workers=workers, maxdepth=None)
+
+    def scan_light():
+        dcmtable_light(session, workers=workers, maxdepth=None)
+
+    def group():
+        table = state['table']
+        table._attribute_index = {}
+        table.group_by_attribute('SeriesNumber')
+
+    def series():
+        state['series'] = seriestable(state['table'])
+
+    def undo_redo():
+        table = seriestable(state['table'])
+        numbers = [str(s.get_number()) for s in table.SeriesList]
+        for i in range(edits):
+            n = numbers[i % len(numbers)]
+            table.alias(n + ' alias' + str(i))
+        while table.undo():
+            pass
+        while table.redo():
+            pass
+
+    def convert():
+        shutil.rmtree(outpath, ignore_errors=True)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            state['series'].convert(outpath=outpath, force=True,
+                                    interactive=False, jobs=jobs,
+                                    manifest=False)
+
+    return [('scan', scan), ('scan_light', scan_light), ('group', group),
+            ('series', series), ('undo_redo', undo_redo),
+            ('convert', convert)]
+
+
+def compare(results, baseline):
+    """Prints each stage's time against a baseline's"""
+    print(blue('{:12s}{:>12s}{:>12s}{:>10s}'.format(
+        'stage', 'baseline s', 'now s', 'ratio')))
+    for name, r in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if not before:
+            continue
+        ratio = r['best'] / before['best'] if before['best'] else 0
+        line = '{:12s}{:12.4f}{:12.4f}{:10.2f}'.format(
+            name, before['best'], r['best'], ratio)
+        if ratio > 1.1:
+            print(red(line))
+        elif ratio < 0.9:
+            print(green(line))
+        else:
+            print(line)
+    if baseline['config'] != results['config']:
+        print(yellow('Baseline was run with ' +
+                     json.dumps(baseline['config'])))
+    # Timings only compare on the machine and python they were taken on
+    for key in ('python', 'machine'):
+        if baseline.get(key) != results[key]:
+            print(yellow('Baseline was run on ' + key + ' ' +
+                         str(baseline.get(key)) + ', not ' + results[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark dicomorg')
+    parser.add_argument('--series', type=int, default=8)
+    parser.add_argument('--slices', type=int, default=32)
+    parser.add_argument('--echoes', type=int, default=1)
+    parser.add_argument('--junk', type=int, default=16,
+                        help='number of non-dicom files')
+    parser.add_argument('--depth', type=int, default=0,
+                        help='levels of subdirectories to nest files in')
+    parser.add_argument('--size', type=int, default=64,
+                        help='rows and columns of each image')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--edits', type=int, default=100,
+                        help='aliases to make, undo and redo')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--session', default=None,
+                        help='benchmark an existing session instead of '
+                             'generating one')
+    parser.add_argument('--save', default=None,
+                        help='save the results as a named baseline')
+    parser.add_argument('--compare', default=None,
+                        help='compare against a named baseline')
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in ('series', 'slices', 'echoes',
+                                            'junk', 'depth', 'size',
+                                            'workers', 'jobs', 'edits')}
+    os.environ['PATH'] = STUB + os.pathsep + os.environ['PATH']
+    workdir = tempfile.mkdtemp(prefix='dicomorg-bench.')
+    try:
+        if args.session:
+            session = op.abspath(args.session)
+            config['session'] = session
+        else:
+            session = op.join(workdir, 'session')
+            print(blue('Generating session...'))
+            make_session(session, series=args.series, slices=args.slices,
+                         echoes=args.echoes, junk=args.junk,
+                         depth=args.depth, rows=args.size,
+                         columns=args.size)
+        outpath = op.join(workdir, 'out')
+        results = {'config': config, 'python': platform.python_version(),
+                   'machine': platform.machine(), 'stages': {}}
+        for name, stage in stages(session, outpath, args.workers,
+                                  args.jobs, args.edits):
+            r = measure(stage, args.repeat)
+            results['stages'][name] = r
+            print('{:12s}{:10.4f} s{:10.1f} MiB'.format(
+                name, r['best'], r['peak'] / 2**20))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(op.join(BASELINES, args.compare + '.json')) as f:
+            compare(results, json.load(f))
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        fname = op.join(BASELINES, args.save + '.json')
+        with open(fname, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Baseline saved to ' + fname)
+
+
+if __name__ == '__main__':
+    main()
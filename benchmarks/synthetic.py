@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Generates synthetic dicom sessions for benchmarking
+
+Every file is a small, valid MR image, so sessions of any size can be
+made in seconds and converted with the stub dcm2niix in bin.
+"""
+
+import os
+import os.path as op
+import argparse
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+# Slices per directory at the block level of a nested session
+BLOCK = 16
+
+
+def _directory(path, depth, series, echo, slice_index):
+    """Returns the directory a file goes in for a nesting depth
+
+    The levels are the series, then the echo, then blocks of slices,
+    then as many single directories as are needed to reach depth.
+    """
+    levels = ['series{:03d}'.format(series), 'echo{:02d}'.format(echo),
+              'block{:03d}'.format(slice_index // BLOCK)]
+    levels += ['level{:d}'.format(i) for i in range(3, depth)]
+    return op.join(path, *levels[:depth])
+
+
+def make_header(series, echo, slice_index, study, series_uid, slices,
+                echo_time, rows, columns):
+    """Makes the dataset of one slice, without pixel data"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MR'
+    ds.PatientID = 'SYNTHETIC'
+    ds.StudyInstanceUID = study
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series
+    ds.SeriesDescription = 'series{:d}'.format(series)
+    ds.SeriesTime = '12{:02d}00'.format(series % 60)
+    ds.EchoTime = echo_time
+    ds.EchoNumbers = echo
+    ds.RepetitionTime = 2000
+    ds.ImagesInAcquisition = slices
+    ds.AcquisitionNumber = 1
+    ds.InstanceNumber = (echo - 1) * slices + slice_index + 1
+    ds.ImagePositionPatient = [0.0, 0.0, float(slice_index)]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    return ds
+
+
+def make_session(path, series=4, slices=32, echoes=1, junk=0, depth=0,
+                 rows=64, columns=64):
+    """Writes a synthetic session
+
+    Parameters
+    ----------
+    path : string
+        The session directory; created if needed
+    series : int
+        The number of series
+    slices : int
+        The number of slices in each echo of each series
+    echoes : int
+        The number of echoes in each series
+    junk : int
+        The number of non-dicom files to scatter among the dicoms
+    depth : int
+        How many levels of subdirectories the dicoms are nested in; 0
+        puts every file directly in path
+    rows, columns : int
+        The image size
+
+    Returns
+    -------
+    A list of the dicom files written
+    """
+    study = generate_uid()
+    pixels = bytes(rows * columns * 2)
+    written = []
+    for s in range(1, series + 1):
+        series_uid = generate_uid()
+        for e in range(1, echoes + 1):
+            for i in range(slices):
+                ds = make_header(s, e, i, study, series_uid, slices,
+                                 10.0 * e, rows, columns)
+                ds.PixelData = pixels
+                directory = _directory(path, depth, s, e, i)
+                os.makedirs(directory, exist_ok=True)
+                fname = op.join(directory, 'IM{:03d}_{:02d}_{:05d}.dcm'.format(
+                    s, e, i))
+                ds.save_as(fname, enforce_file_format=True)
+                written.append(fname)
+    for j in range(junk):
+        directory = _directory(path, depth, j % max(series, 1) + 1, 1, 0)
+        os.makedirs(directory, exist_ok=True)
+        with open(op.join(directory, 'junk{:05d}.txt'.format(j)), 'w') as f:
+            f.write('not a dicom\n' * (j % 8 + 1))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='write a synthetic dicom session')
+    parser.add_argument('path', help='session directory to write')
+    parser.add_argument('--series', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=32)
+    parser.add_argument('--echoes', type=int, default=1)
+    parser.add_argument('--junk', type=int, default=0,
+                        help='number of non-dicom files')
+    parser.add_argument('--depth', type=int, default=0,
+                        help='levels of subdirectories to nest files in')
+    parser.add_argument('--size', type=int, default=64,
+                        help='rows and columns of each image')
+    args = parser.parse_args()
+    files = make_session(args.path, series=args.series, slices=args.slices,
+                         echoes=args.echoes, junk=args.junk,
+                         depth=args.depth, rows=args.size,
+                         columns=args.size)
+    print('Wrote ' + str(len(files)) + ' dicoms to ' + args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Reading dicoms inside zip and tar archives without extracting them
+
+A member of an archive is named as if the archive were a directory,
+e.g. /data/export.zip/DICOM/IM0001, so tables, series and manifests
+treat it like any other file. Reading an archive's headers takes one
+pass over it, and conversion stages only the members it needs.
+"""
+
+import io
+import os
+import os.path as op
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from functools import lru_cache
+from contextlib import contextmanager
+
+from . import timing
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2',
+                      '.tbz2', '.tar.xz', '.txz')
+
+# What reading a damaged or unknown archive raises
+ARCHIVE_ERRORS = (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile)
+
+
+def is_archive(fname):
+    """Returns whether a filename has an archive extension"""
+    return fname.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_stem(fname):
+    """Returns a filename without its archive extension"""
+    for ext in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if fname.lower().endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+
+@lru_cache(maxsize=256)
+def _isfile(fname):
+    return op.isfile(fname)
+
+
+def split_member(fname):
+    """Splits the name of an archive member
+
+    Returns
+    -------
+    (archive, member) if fname is inside an archive, where member uses
+    the archive's own / separators; otherwise None
+    """
+    lower = fname.lower()
+    for ext in ARCHIVE_EXTENSIONS:
+        i = lower.find(ext + os.sep)
+        while i >= 0:
+            archive = fname[:i + len(ext)]
+            if _isfile(archive):
+                return archive, fname[i + len(ext) + 1:].replace(os.sep,
+                                                                 '/')
+            i = lower.find(ext + os.sep, i + 1)
+    return None
+
+
+def is_member(fname):
+    """Returns whether a filename is inside an archive"""
+    return split_member(fname) is not None
+
+
+def stat_file(fname):
+    """Returns os.stat of a file, or of its archive if it is a member"""
+    try:
+        return os.stat(fname)
+    except OSError:
+        member = split_member(fname)
+        if member is None:
+            raise
+        return os.stat(member[0])
+
+
+def archive_members(archive, wanted=None):
+    """Yields the regular members of an archive in a single pass
+
+    Parameters
+    ----------
+    archive : string
+        A zip or tar file, compressed or not
+    wanted : set
+        If given, only these member names are read; the pass stops once
+        all are found
+
+    Yields
+    ------
+    (fname, data) where fname names the member as a file and data are
+    its contents
+
+    Raises
+    ------
+    One of ARCHIVE_ERRORS if the archive cannot be read
+    """
+    remaining = set(wanted) if wanted is not None else None
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if remaining is not None:
+                    if info.filename not in remaining:
+                        continue
+                    remaining.discard(info.filename)
+                yield op.join(archive, info.filename), zf.read(info)
+                if remaining is not None and not remaining:
+                    return
+        return
+    # Stream mode reads compressed tars front to back, never seeking
+    with tarfile.open(archive, 'r|*') as tf:
+        for info in tf:
+            if not info.isfile():
+                continue
+            if remaining is not None:
+                if info.name not in remaining:
+                    continue
+                remaining.discard(info.name)
+            yield op.join(archive, info.name), tf.extractfile(info).read()
+            if remaining is not None and not remaining:
+                return
+
+
+def read_member(fname):
+    """Returns the contents of one archive member
+
+    This opens the archive for each call, which for a compressed tar
+    means decompressing up to the member; use archive_members to read
+    many.
+    """
+    archive, member = split_member(fname)
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return zf.read(member)
+    with tarfile.open(archive, 'r:*') as tf:
+        f = tf.extractfile(member)
+        if f is None:
+            raise IsADirectoryError(fname)
+        return f.read()
+
+
+def open_file(fname):
+    """Opens a file or archive member for binary reading; file objects
+    are returned as they are"""
+    if not isinstance(fname, str):
+        return fname
+    if not op.exists(fname) and is_member(fname):
+        return io.BytesIO(read_member(fname))
+    return open(fname, 'rb')
+
+
+def extract_members(pairs):
+    """Writes archive members to files, reading each archive once
+
+    Parameters
+    ----------
+    pairs : list
+        (member, destination) pairs; destination directories must exist
+
+    Returns
+    -------
+    The number of bytes written
+    """
+    byarchive = {}
+    for src, dst in pairs:
+        archive, member = split_member(src)
+        byarchive.setdefault(archive, {}).setdefault(member, []).append(dst)
+    nbytes = 0
+    for archive, members in byarchive.items():
+        for fname, data in archive_members(archive, set(members)):
+            member = split_member(fname)[1]
+            for dst in members[member]:
+                # Written under a temporary name, so dst is only ever
+                # complete
+                tempname = op.join(op.dirname(dst), '.tmp.' +
+                                   op.basename(dst))
+                with open(tempname, 'wb') as f:
+                    f.write(data)
+                os.replace(tempname, dst)
+                nbytes += len(data)
+    return nbytes
+
+
+@contextmanager
+def staged(files, directory):
+    """Extracts the archive members among files for the enclosed code
+
+    Parameters
+    ----------
+    files : list
+        Filenames, some of which may be archive members
+    directory : string
+        Where to make the staging directory; it is removed afterwards
+
+    Yields
+    ------
+    A dict where each member hashes to its extracted file; files which
+    are not members are not in it
+    """
+    members = [f for f in files if is_member(f)]
+    if not members:
+        yield {}
+        return
+    os.makedirs(directory, exist_ok=True)
+    stagedir = tempfile.mkdtemp(prefix='.tmp.stage.', dir=directory)
+    try:
+        paths = {f: op.join(stagedir, '{:06d}.dcm'.format(i))
+                 for i, f in enumerate(members)}
+        with timing.stage('stage', files=len(members)):
+            nbytes = extract_members(list(paths.items()))
+        timing.count('stage', nbytes=nbytes)
+        yield paths
+    finally:
+        shutil.rmtree(stagedir, ignore_errors=True)
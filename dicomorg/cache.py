@@ -0,0 +1,286 @@
+"""A persistent on-disk index of dicom headers
+
+The index pickles pydicom headers, and unpickling runs code, so it is
+only ever kept where the user alone writes: their cache directory, or
+one they name.
+"""
+
+import os
+import os.path as op
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+# The sidecar indices were once kept in; still never read as a dicom
+CACHENAME = '.dicomorg_index'
+CACHEVERSION = 2
+
+# Where header indices are kept unless another directory is given
+USERCACHE = op.join(os.environ.get('XDG_CACHE_HOME') or
+                    op.join(op.expanduser('~'), '.cache'), 'dicomorg')
+
+# The sidecar an interactive session is saved in; see snapshot.py
+SNAPSHOTNAME = '.dicomorg_session'
+
+
+def cache_location(path, cachedir=None, tags=None, shard=None):
+    """Returns where the header index for a directory lives
+
+    Parameters
+    ----------
+    path : string
+        The directory the index belongs to
+    cachedir : string
+        A directory to keep indices in; by default USERCACHE
+    tags : list
+        The tags the index holds, or None for full headers
+    shard : tuple
+        The (index, count) of the shard of path the index holds, if any,
+        so that shards read at once keep their own indices
+
+    Returns
+    -------
+    The filename of the index
+    """
+    path = op.abspath(path)
+    suffix = ''
+    if tags is not None:
+        tagdigest = hashlib.sha1(' '.join(tags).encode('utf-8'))
+        suffix = '_' + tagdigest.hexdigest()[:8]
+    if shard is not None:
+        suffix += '_shard{}of{}'.format(*shard)
+    if cachedir is None:
+        cachedir = USERCACHE
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return op.join(op.abspath(op.expanduser(cachedir)),
+                   digest + suffix + '.pkl')
+
+
+
+def snapshot_location(path, cachedir=None):
+    """Returns where the session snapshot for a directory lives
+
+    Parameters
+    ----------
+    path : string
+        The directory, or archive, the session reads
+    cachedir : string
+        A directory to keep snapshots in. If None, the snapshot is kept
+        as a sidecar file in path itself, or next to it for an archive.
+
+    Returns
+    -------
+    The filename of the snapshot
+    """
+    path = op.abspath(path)
+    if cachedir is not None:
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return op.join(op.abspath(op.expanduser(cachedir)),
+                       digest + '.session')
+    if op.isfile(path):
+        return op.join(op.dirname(path),
+                       SNAPSHOTNAME + '_' + op.basename(path))
+    return op.join(path, SNAPSHOTNAME)
+
+
+class headercache:
+    """An index of dicom headers keyed by absolute path, size and mtime
+
+    Attributes
+    ----------
+    cachefile : string
+        The file the index is stored in
+    entries : dict
+        A dict where each filename hashes to a (size, mtime, header,
+        reason) tuple. Files which are not dicoms have a header of None
+        and the reason they were skipped, so that they are not re-read
+        either.
+    hits : int
+        The number of lookups answered from the index
+    misses : int
+        The number of lookups which need the file to be read
+    """
+    def __init__(self, path, cachedir=None, tags=None, shard=None):
+        self.cachefile = cache_location(path, cachedir, tags, shard)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __str__(self):
+        return ('Cache: ' + self.cachefile + '\n' +
+                'Entries: ' + str(len(self.entries)))
+
+    def load(self):
+        """Loads the index from disk, discarding it if it is unreadable"""
+        try:
+            with open(self.cachefile, 'rb') as f:
+                contents = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError):
+            return
+        if (isinstance(contents, dict) and
+                contents.get('version') == CACHEVERSION):
+            self.entries = contents['entries']
+
+    def save(self, keep=None):
+        """Writes the index to disk
+
+        Parameters
+        ----------
+        keep : iterable
+            The filenames still present; anything else is dropped from
+            the index before writing. If None, everything is kept.
+        """
+        if keep is not None:
+            keep = set(keep)
+            self.entries = {f: v for f, v in self.entries.items()
+                            if f in keep}
+        cachepath = op.dirname(self.cachefile)
+        if not op.exists(cachepath):
+            os.makedirs(cachepath)
+        # Write to a temporary file first so a crash never leaves a
+        # truncated index behind
+        tempname = self.cachefile + '.tmp'
+        with open(tempname, 'wb') as f:
+            pickle.dump({'version': CACHEVERSION, 'entries': self.entries},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempname, self.cachefile)
+
+    def lookup(self, fname, stat):
+        """Looks up the header for a file
+
+        Parameters
+        ----------
+        fname : string
+            The absolute filename
+        stat : os.stat_result
+            The current stat of the file
+
+        Returns
+        -------
+        found : bool
+            Whether the file is indexed and unchanged since
+        header
+            The header, or None if not found or not a dicom
+        reason : string
+            Why the file was skipped as not a dicom, or None
+        """
+        entry = self.entries.get(fname)
+        if (entry is not None and entry[0] == stat.st_size and
+                entry[1] == stat.st_mtime_ns):
+            self.hits += 1
+            return True, entry[2], entry[3]
+        self.misses += 1
+        return False, None, None
+
+    def update(self, fname, stat, header, reason=None):
+        """Records the header for a file
+
+        Parameters
+        ----------
+        fname : string
+            The absolute filename
+        stat : os.stat_result
+            The stat of the file when it was read
+        header
+            The header of the file, or None if not a dicom
+        reason : string
+            Why the file was skipped as not a dicom, or None
+        """
+        self.entries[fname] = (stat.st_size, stat.st_mtime_ns, header,
+                               reason)
+
+
+class headerlru:
+    """A bounded, least-recently-used cache of full dicom headers
+
+    Attributes
+    ----------
+    maxentries : int
+        The most headers to keep, or None for no limit
+    maxbytes : int
+        The most header bytes (as read from disk) to keep, or None for
+        no limit
+    nbytes : int
+        The header bytes currently kept
+    hits : int
+        The number of lookups answered from the cache
+    misses : int
+        The number of lookups which read the header from disk
+    evictions : int
+        The number of headers dropped to stay within the limits
+    """
+    def __init__(self, maxentries=128, maxbytes=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return ('Header cache: {} entries, {} bytes, {} hits, {} misses, '
+                '{} evictions'.format(len(self), self.nbytes, self.hits,
+                                      self.misses, self.evictions))
+
+    def get(self, fname, loader):
+        """Returns the header for a file, loading it on a miss
+
+        Parameters
+        ----------
+        fname : string
+            The filename
+        loader : function
+            Called with fname on a miss; returns the header and its size
+            in bytes
+
+        Returns
+        -------
+        The header
+        """
+        with self._lock:
+            if fname in self._entries:
+                self._entries.move_to_end(fname)
+                self.hits += 1
+                return self._entries[fname][0]
+            self.misses += 1
+        header, nbytes = loader(fname)
+        with self._lock:
+            if fname not in self._entries:
+                self._entries[fname] = (header, nbytes)
+                self.nbytes += nbytes
+                self._evict()
+        return header
+
+    def clear(self):
+        """Drops every header, keeping the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """Returns the counters and sizes as a dict"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self),
+                'bytes': self.nbytes, 'maxentries': self.maxentries,
+                'maxbytes': self.maxbytes}
+
+    def _evict(self):
+        # Always keep the header just loaded, even if it alone is too big
+        while len(self._entries) > 1 and (
+                (self.maxentries is not None and
+                 len(self._entries) > self.maxentries) or
+                (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            header, nbytes = self._entries.popitem(last=False)[1]
+            self.nbytes -= nbytes
+            self.evictions += 1
+        if self.maxentries == 0:
+            self._entries.clear()
+            self.nbytes = 0
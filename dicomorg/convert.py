@@ -2,30 +2,75 @@
 
 import os
 import os.path as op
+import re
+import asyncio
+import shutil
 import subprocess
-from glob import glob
+import tempfile
+import time
+from glob import glob, escape
 
 from .colors import *
+from . import timing
+
+# Options passed to every dcm2niix call, besides input and output names
+DCM2NIIX_OPTIONS = ['-s', 'y']
+
+# Extensions of the files dcm2niix produces
+OUTPUT_EXTENSIONS = ('.nii', '.nii.gz', '.json', '.bval', '.bvec')
+
+# Suffixes dcm2niix appends to an output name, e.g. for echoes, phase,
+# complex parts, images of different sizes, coils and ROIs
+DCM2NIIX_SUFFIXES = (r'_e\d+|_ph|_phMag|_real|_imaginary|_i\d+|_c\d+|'
+                     r'_t\d+|_ROI\d+|_Eq|_Tilt|_MoCo|_ADC|_Crop|'
+                     r'_fieldmaphz')
 
 class ConversionError(Exception):
     pass
 
-def dcm2niix(files, fname, path, overwrite=False, verbose=False):
-    """Converts files using dcm2niix"""
-    tempname = op.join(path, '.tmp.dcm2niix.txt')
-    with open(tempname, 'w') as metafile:
-        for f in files:
-            metafile.write(f + '\n')
+def output_pattern(fname):
+    """Returns a regular expression matching the files dcm2niix writes
+    for an output name: the name, with %e as the echo number, then any
+    suffixes dcm2niix appends, then an extension"""
+    name = r'\d+'.join(re.escape(part) for part in fname.split('%e'))
+    extensions = '|'.join(re.escape(e) for e in OUTPUT_EXTENSIONS)
+    return re.compile(name + '(?:' + DCM2NIIX_SUFFIXES + ')*(?:' +
+                      extensions + ')$')
 
-    fulldest = op.join(path, fname)
-    if not op.exists(path):
-        os.mkdir(path)
+def conversion_outputs(fname, path):
+    """Returns the files dcm2niix has produced for an output name
+
+    Only the name itself and the name with suffixes dcm2niix appends
+    (see DCM2NIIX_SUFFIXES) match, so the outputs of a series named T1
+    never include those of one named T1_fmap.
 
+    Parameters
+    ----------
+    fname : string
+        The output name, possibly containing dcm2niix's %e
+    path : string
+        The output directory
+
+    Returns
+    -------
+    A sorted list of filenames
+    """
+    pattern = output_pattern(fname)
+    # Anything dcm2niix substitutes or appends comes after the first %
+    prefix = fname.split('%')[0]
+    return sorted(f for f in glob(op.join(escape(path), escape(prefix)) +
+                                  '*')
+                  if pattern.match(op.basename(f)))
+
+def check_existing(fulldest, overwrite=False):
+    """Makes way for the nifti of an output name, or raises ValueError
+    if it exists and overwrite is False"""
     # Special case: in multi-echo, need to replace %e with 1
     # This is slightly unsafe in that theoretically an echo-2 could exist bu
     # not an echo-1, but this seems unlikely 
     checkname = fulldest.replace('%e', '1') + '.nii'
-    if op.exists(checkname) or op.exists(checkname + '.gz'):
+    exists = op.exists(checkname) or op.exists(checkname + '.gz')
+    if exists:
         if not overwrite:
             raise ValueError('File ' + fulldest + ' would be overwritten.')
         elif op.exists(checkname):
@@ -33,19 +78,216 @@ def dcm2niix(files, fname, path, overwrite=False, verbose=False):
         elif op.exists(checkname + '.gz'):
             os.remove(checkname + '.gz')
 
-    args = ['dcm2niix', '-o', path, '-f', fname, '-s', 'y', tempname]
-
-    if verbose:
-        completion = subprocess.run(args)
-    else:
-        completion = subprocess.run(args, encoding='utf-8', 
-                                    stderr=subprocess.STDOUT,
-                                    stdout=subprocess.PIPE)
-
-    os.remove(tempname)
+def run_dcm2niix(args, nfiles, verbose=False):
+    """Runs dcm2niix, timing it and raising ConversionError if it fails"""
+    start = time.perf_counter()
+    with timing.stage('dcm2niix', files=nfiles):
+        if verbose:
+            completion = subprocess.run(args)
+        else:
+            completion = subprocess.run(args, encoding='utf-8',
+                                        stderr=subprocess.STDOUT,
+                                        stdout=subprocess.PIPE)
+    timing.record_subprocess(args[:5], nfiles, time.perf_counter() - start,
+                             completion.returncode)
 
     if completion.returncode:
         if verbose:
             raise ConversionError('dcm2niix failed')
         else:
             raise ConversionError('dcm2niix failed: ' + completion.stdout)
+
+def dcm2niix(files, fname, path, overwrite=False, verbose=False,
+             checkexisting=True):
+    """Converts files using dcm2niix
+
+    Returns
+    -------
+    A list of the files produced for fname
+    """
+    fulldest = op.join(path, fname)
+    os.makedirs(path, exist_ok=True)
+    if checkexisting:
+        check_existing(fulldest, overwrite)
+
+    # A unique file list per call, so that conversions into the same
+    # path can run at once
+    with timing.stage('filelist', files=len(files)):
+        handle, tempname = tempfile.mkstemp(prefix='.tmp.dcm2niix.',
+                                            suffix='.txt', dir=path)
+        with os.fdopen(handle, 'w') as metafile:
+            for f in files:
+                metafile.write(f + '\n')
+
+    args = (['dcm2niix', '-o', path, '-f', fname] + DCM2NIIX_OPTIONS +
+            [tempname])
+    try:
+        run_dcm2niix(args, len(files), verbose)
+    finally:
+        os.remove(tempname)
+
+    return conversion_outputs(fname, path)
+
+async def dcm2niix_async(files, fname, path, overwrite=False,
+                         checkexisting=True):
+    """Converts files using dcm2niix without blocking an event loop
+
+    Cancelling the coroutine kills dcm2niix and removes what it had
+    written so far.
+
+    Returns
+    -------
+    A list of the files produced for fname
+    """
+    fulldest = op.join(path, fname)
+    os.makedirs(path, exist_ok=True)
+    if checkexisting:
+        check_existing(fulldest, overwrite)
+
+    with timing.stage('filelist', files=len(files)):
+        handle, tempname = tempfile.mkstemp(prefix='.tmp.dcm2niix.',
+                                            suffix='.txt', dir=path)
+        with os.fdopen(handle, 'w') as metafile:
+            for f in files:
+                metafile.write(f + '\n')
+
+    args = (['dcm2niix', '-o', path, '-f', fname] + DCM2NIIX_OPTIONS +
+            [tempname])
+    existing = set(conversion_outputs(fname, path))
+    start = time.perf_counter()
+    try:
+        with timing.stage('dcm2niix', files=len(files)):
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+            try:
+                output = (await process.communicate())[0]
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                # Partial outputs would stop the next conversion
+                for f in conversion_outputs(fname, path):
+                    if f not in existing:
+                        os.remove(f)
+                raise
+    finally:
+        os.remove(tempname)
+    timing.record_subprocess(args[:5], len(files),
+                             time.perf_counter() - start, process.returncode)
+
+    if process.returncode:
+        raise ConversionError('dcm2niix failed: ' +
+                              output.decode('utf-8', 'replace'))
+
+    return conversion_outputs(fname, path)
+
+def _uid_name(uid):
+    """Returns a SeriesInstanceUID as it is compared to dcm2niix's %j
+    names, with anything dcm2niix might replace in a filename made _"""
+    return ''.join(c if c.isalnum() else '_' for c in uid)
+
+
+def _batch_owner(stem, names):
+    """Returns the index of the group whose %j name an output stem starts
+    with, preferring the longest, or None"""
+    owner = None
+    for i, name in enumerate(names):
+        if name is None:
+            continue
+        if stem == name or stem.startswith(name + '_'):
+            if owner is None or len(name) > len(names[owner]):
+                owner = i
+    return owner
+
+
+def dcm2niix_batch(groups, path, overwrite=False, verbose=False):
+    """Converts several groups of files, e.g. series, in one dcm2niix run
+
+    Each group is linked into its own folder of a staging directory,
+    which dcm2niix converts at once naming each output by its
+    SeriesInstanceUID (%j). The outputs are then renamed to their
+    group's output name, so only one process is started for all of them.
+
+    Parameters
+    ----------
+    groups : list
+        (files, fname, uid) tuples, where fname is the output name of
+        the files, without dcm2niix substitutions, and uid their
+        SeriesInstanceUID, which must differ between groups
+    path : string
+        The output directory
+    overwrite : bool
+        Whether to overwrite existing niftis
+
+    Returns
+    -------
+    A list with, for each group in order, the files produced for it, or
+    the ValueError or ConversionError it was not converted for
+
+    Raises
+    ------
+    ValueError if groups share a SeriesInstanceUID or have none
+    ConversionError if dcm2niix fails
+    """
+    uids = [uid for _, _, uid in groups]
+    if not all(uids) or len(set(uids)) != len(uids):
+        raise ValueError('Groups converted in a batch need their own '
+                         'SeriesInstanceUID')
+    os.makedirs(path, exist_ok=True)
+    results = [None] * len(groups)
+    stagedir = tempfile.mkdtemp(prefix='.tmp.batch.', dir=path)
+    try:
+        indir = op.join(stagedir, 'in')
+        outdir = op.join(stagedir, 'out')
+        os.mkdir(outdir)
+        nfiles = 0
+        with timing.stage('filelist',
+                          files=sum(len(g[0]) for g in groups)):
+            for i, (files, fname, uid) in enumerate(groups):
+                try:
+                    check_existing(op.join(path, fname), overwrite)
+                except ValueError as e:
+                    results[i] = e
+                    continue
+                folder = op.join(indir, 'group{:04d}'.format(i))
+                os.makedirs(folder)
+                for j, f in enumerate(files):
+                    os.symlink(op.abspath(f),
+                               op.join(folder, '{:06d}.dcm'.format(j)))
+                nfiles += len(files)
+        if not nfiles:
+            return results
+
+        args = (['dcm2niix', '-o', outdir, '-f', '%j'] + DCM2NIIX_OPTIONS +
+                [indir])
+        run_dcm2niix(args, nfiles, verbose)
+
+        names = [_uid_name(uid) if results[i] is None else None
+                 for i, uid in enumerate(uids)]
+        produced = [[] for g in groups]
+        for f in sorted(os.listdir(outdir)):
+            ext = next((e for e in sorted(OUTPUT_EXTENSIONS, key=len,
+                                          reverse=True) if f.endswith(e)),
+                       None)
+            if ext is None:
+                continue
+            stem = f[:-len(ext)]
+            i = _batch_owner(_uid_name(stem), names)
+            if i is not None:
+                produced[i].append((f, stem[len(names[i]):] + ext))
+        for i, (files, fname, uid) in enumerate(groups):
+            if results[i] is not None:
+                continue
+            if not produced[i]:
+                results[i] = ConversionError('dcm2niix produced nothing '
+                                             'for ' + fname)
+                continue
+            outputs = []
+            for f, rest in produced[i]:
+                dst = op.join(path, fname + rest)
+                os.replace(op.join(outdir, f), dst)
+                outputs.append(dst)
+            results[i] = sorted(outputs)
+        return results
+    finally:
+        shutil.rmtree(stagedir, ignore_errors=True)
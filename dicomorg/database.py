@@ -0,0 +1,288 @@
+"""A SQLite index of dicom headers across many sessions
+
+Tables are exported with the values of INDEXED_TAGS for each file, so
+that series can be found across an archive without reading any dicoms:
+
+    db = headerdb('archive.db')
+    db.export(dcmtable_light(session, tags=INDEXED_TAGS))
+    groups, values = db.group_by_attribute('SeriesDescription')
+    files = db.group_by_value('ProtocolName', 'rest')
+"""
+
+import sys
+import time
+import sqlite3
+import os.path as op
+
+from .dcmutil import dcmtable_light, compact_value
+
+# Tags kept for every file, with the SQLite type of their column
+INDEXED_TAGS = {'PatientID': 'TEXT', 'StudyInstanceUID': 'TEXT',
+                'StudyDate': 'TEXT', 'SeriesInstanceUID': 'TEXT',
+                'SeriesNumber': 'INTEGER', 'SeriesDescription': 'TEXT',
+                'SeriesTime': 'TEXT', 'ProtocolName': 'TEXT',
+                'Modality': 'TEXT', 'EchoTime': 'REAL'}
+
+SCHEMA_VERSION = 1
+
+
+def _to_sql(value):
+    """Converts a compact value to one SQLite can store"""
+    if isinstance(value, tuple):
+        return '\\'.join(str(v) for v in value)
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace')
+    return value
+
+
+def _from_sql(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def _check(attribute):
+    if attribute not in INDEXED_TAGS:
+        raise ValueError('Attribute ' + str(attribute) + ' is not indexed; '
+                         'choose from ' + ', '.join(INDEXED_TAGS))
+
+
+class headerdb:
+    """A SQLite database of the indexed tags of exported tables
+
+    Attributes
+    ----------
+    dbfile : string
+        The database file
+    connection : sqlite3.Connection
+        The open connection
+    """
+    def __init__(self, dbfile, timeout=60):
+        """Constructor for headerdb
+        Parameters
+        ----------
+        dbfile : string
+            The database file; created if it does not exist
+        timeout : float
+            Seconds to wait for other writers, e.g. batch sessions
+        """
+        self.dbfile = op.abspath(dbfile)
+        self.connection = sqlite3.connect(self.dbfile, timeout=timeout)
+        self._create()
+
+    def __str__(self):
+        nsessions, nfiles = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(nfiles), 0) FROM sessions'
+        ).fetchone()
+        return ('Database: ' + self.dbfile + '\n' +
+                'Sessions: ' + str(nsessions) + '\n' +
+                'Files: ' + str(nfiles))
+
+    def _create(self):
+        columns = ''.join(', "{}" {}'.format(t, kind)
+                          for t, kind in INDEXED_TAGS.items())
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (path TEXT PRIMARY '
+                'KEY, nfiles INTEGER, exported REAL, version INTEGER)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, '
+                'session TEXT NOT NULL, path TEXT NOT NULL' + columns + ')')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS files_session ON files '
+                '(session, id)')
+            for t in INDEXED_TAGS:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "files_{0}" ON files '
+                    '("{0}")'.format(t))
+
+    def close(self):
+        self.connection.close()
+
+    def export(self, table):
+        """Stores a table, replacing any earlier export of its directory
+
+        Parameters
+        ----------
+        table : dcmtable
+            The table to store; a dcmtable_light stores None for the
+            indexed tags it did not read
+
+        Returns
+        -------
+        The number of files stored
+        """
+        if isinstance(table, dcmtable_light):
+            columns = [table.columns.get(t, [None] * len(table.filelist))
+                       for t in INDEXED_TAGS]
+        else:
+            columns = [[compact_value(getattr(table.get_header(f), t, None))
+                        for f in table.filelist] for t in INDEXED_TAGS]
+        session = table.tablepath
+        rows = ((session, f) + tuple(_to_sql(c[i]) for c in columns)
+                for i, f in enumerate(table.filelist))
+        marks = ', '.join('?' for i in range(len(INDEXED_TAGS) + 2))
+        names = ', '.join('"{}"'.format(t) for t in INDEXED_TAGS)
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE session = ?',
+                                    (session,))
+            self.connection.executemany(
+                'INSERT INTO files (session, path, ' + names + ') VALUES (' +
+                marks + ')', rows)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                (session, len(table.filelist), time.time(), SCHEMA_VERSION))
+        return len(table.filelist)
+
+    def remove(self, session):
+        """Removes an exported directory"""
+        session = op.abspath(session)
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE session = ?',
+                                    (session,))
+            self.connection.execute('DELETE FROM sessions WHERE path = ?',
+                                    (session,))
+
+    def sessions(self):
+        """Returns the exported directories, sorted"""
+        return [r[0] for r in self.connection.execute(
+            'SELECT path FROM sessions ORDER BY path')]
+
+    def table(self, session, headerentries=128, headerbytes=None):
+        """Loads an exported directory as a table without reading it
+
+        Parameters
+        ----------
+        session : string
+            The exported directory
+        headerentries, headerbytes
+            See dcmtable_light
+
+        Returns
+        -------
+        A dcmtable_light with the indexed tags as its columns; full
+        headers are still read from the files on demand
+
+        Raises
+        ------
+        ValueError if the directory was not exported
+        """
+        session = op.abspath(session)
+        if not self.connection.execute(
+                'SELECT 1 FROM sessions WHERE path = ?',
+                (session,)).fetchone():
+            raise ValueError('Session ' + session + ' is not in the '
+                             'database.')
+        names = ', '.join('"{}"'.format(t) for t in INDEXED_TAGS)
+        cursor = self.connection.execute(
+            'SELECT path, ' + names + ' FROM files WHERE session = ? '
+            'ORDER BY id', (session,))
+        filelist = []
+        columns = {t: [] for t in INDEXED_TAGS}
+        lists = [columns[t] for t in INDEXED_TAGS]
+        for row in cursor:
+            filelist.append(row[0])
+            for values, v in zip(lists, row[1:]):
+                values.append(_from_sql(v))
+        return dcmtable_light.from_columns(session, filelist, columns,
+                                           headerentries=headerentries,
+                                           headerbytes=headerbytes)
+
+    def _where(self, criteria, session=None):
+        """Returns a WHERE clause and its parameters for equality
+        criteria"""
+        clauses = []
+        params = []
+        if session is not None:
+            clauses.append('session = ?')
+            params.append(op.abspath(session))
+        for attribute, value in sorted(criteria.items()):
+            _check(attribute)
+            clauses.append('"{}" = ?'.format(attribute))
+            params.append(_to_sql(value))
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def group_by_attribute(self, attribute, session=None, **criteria):
+        """Returns a list of a list of files and a list of the unique
+        values of an attribute, as dcmtable.group_by_attribute does
+
+        Parameters
+        ----------
+        attribute : string
+            One of INDEXED_TAGS
+        session : string
+            An exported directory to limit the search to; by default all
+        criteria
+            Indexed tags the files must have, e.g. Modality='MR'
+
+        Returns
+        -------
+        file_groups : list
+            A list of filename lists. Indices correspond with
+            unique_values.
+        unique_values : list
+            A sorted list of the values of the attribute
+        """
+        _check(attribute)
+        where, params = self._where(criteria, session)
+        cursor = self.connection.execute(
+            'SELECT "{0}", path FROM files{1} ORDER BY "{0}", id'.format(
+                attribute, where), params)
+        file_groups = []
+        unique_values = []
+        for value, path in cursor:
+            if not unique_values or unique_values[-1] != value:
+                unique_values.append(value)
+                file_groups.append([])
+            file_groups[-1].append(path)
+        return file_groups, unique_values
+
+    def group_by_value(self, attribute, attribute_value, session=None,
+                       **criteria):
+        """Returns the files whose attribute has a given value, as
+        dcmtable.group_by_value does
+
+        Parameters
+        ----------
+        attribute : string
+            One of INDEXED_TAGS
+        attribute_value
+            The value to match
+        session, criteria
+            See group_by_attribute
+
+        Returns
+        -------
+        A list of files, in the order they were exported
+        """
+        criteria[attribute] = attribute_value
+        where, params = self._where(criteria, session)
+        return [r[0] for r in self.connection.execute(
+            'SELECT path FROM files' + where + ' ORDER BY id', params)]
+
+    def find_series(self, session=None, **criteria):
+        """Returns the series which have files matching the criteria
+
+        Parameters
+        ----------
+        session, criteria
+            See group_by_attribute
+
+        Returns
+        -------
+        A list of dicts with the session, PatientID, StudyInstanceUID,
+        SeriesInstanceUID, SeriesNumber, SeriesDescription and the
+        number of matching files, sorted by session and series number
+        """
+        where, params = self._where(criteria, session)
+        keys = ['session', 'PatientID', 'StudyInstanceUID',
+                'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription']
+        names = ', '.join('"{}"'.format(k) for k in keys)
+        cursor = self.connection.execute(
+            'SELECT ' + names + ', COUNT(*) FROM files' + where +
+            ' GROUP BY ' + names + ' ORDER BY session, "SeriesNumber"',
+            params)
+        return [dict(zip(keys + ['files'], r)) for r in cursor]
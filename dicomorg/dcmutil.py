@@ -8,10 +8,353 @@ import shutil
 import copy
 from copy import copy
 import subprocess
-import pydicom
-from pydicom import dcmread
+import sys
+import io
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .colors import *
 from .convert import *
+from .cache import headercache, headerlru, CACHENAME, SNAPSHOTNAME
+from .manifest import conversionmanifest, input_signature
+from .nifti import numpy_convert, UnsupportedSeries
+from .organise import organise, plan_series, safe_name
+from .validate import validate_series, QUARANTINENAME
+from . import timing
+from .lazy import lazy_import
+from .scan import walk_files, classify, classify_start, SKIP_INVALID, \
+    SKIP_UNREADABLE
+from .archive import archive_members, open_file, is_archive, is_member, \
+    staged, ARCHIVE_ERRORS
+
+pydicom = lazy_import('pydicom')
+
+
+# The number of files read at a time while streaming a directory
+SCAN_CHUNK = 4096
+
+# The attributes seriestable and dcmseries need from each file
+LIGHT_TAGS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID',
+              'SeriesNumber', 'SeriesDescription', 'SeriesTime',
+              'EchoTime']
+
+# The levels seriestable nests series in, above the series number
+HIERARCHY_TAGS = ('PatientID', 'StudyInstanceUID', 'SeriesInstanceUID')
+
+# Converters a series can use; the numpy ones fall back to dcm2niix for
+# series they cannot handle
+BACKENDS = ('dcm2niix', 'numpy', 'numpy-gz')
+
+# The attributes of a dcmseries kept in a session snapshot, besides its
+# files and echoes
+SERIES_STATE = ('name', 'number', 'start', 'patient', 'study', 'uid', 'key',
+                'alias', 'past', 'future', 'backend', 'problems')
+
+# Value representations of plain text, which header_value decodes from
+# the raw bytes the way pydicom would
+RAW_TEXT_VRS = ('AS', 'CS', 'DA', 'DT', 'LO', 'SH', 'TM', 'UI')
+
+
+def read_header(fname, tags=None, force=False):
+    """Reads the dicom header of a file, skipping the pixel data
+
+    Parameters
+    ----------
+    fname : string
+        The file or archive member to read, or an open file
+    tags : list
+        If given, only these tags are read from the header
+    force : bool
+        Whether to read files without the DICM prefix
+
+    Returns
+    -------
+    The header for the file, or None if the file is not a dicom
+    """
+    try:
+        with open_file(fname) as f:
+            header = pydicom.dcmread(f, stop_before_pixels=True,
+                             specific_tags=tags, force=force)
+            timing.count('parse', nbytes=f.tell())
+            return header
+    except (IsADirectoryError, pydicom.errors.InvalidDicomError):
+        return None
+    except Exception:
+        # Forced reads of files which are not dicoms fail in many ways
+        if force:
+            return None
+        raise
+
+
+def read_header_sized(fname, force=False):
+    """Reads the full dicom header of a file, with its size on disk
+
+    Parameters
+    ----------
+    fname : string
+        The file to read
+    force : bool
+        Whether to read files without the DICM prefix
+
+    Returns
+    -------
+    header
+        The header for the file
+    nbytes : int
+        The number of bytes read, i.e. everything up to the pixel data
+    """
+    with open_file(fname) as f:
+        header = pydicom.dcmread(f, stop_before_pixels=True, force=force)
+        timing.count('load', files=1, nbytes=f.tell())
+        return header, f.tell()
+
+
+def scan_header(fname, tags=None, preambleless=False):
+    """Reads the dicom header of a file if a cheap check says it is one
+
+    Parameters
+    ----------
+    fname : string
+        The file to read
+    tags : list
+        If given, only these tags are read from the header
+    preambleless : bool
+        Whether to also read files without the preamble and DICM prefix
+
+    Returns
+    -------
+    header
+        The header for the file, or None if it is not a dicom
+    reason : string
+        Why the file is not a dicom, or None if it is
+    """
+    reason, force = classify(fname, preambleless)
+    if reason:
+        return None, reason
+    header = read_header(fname, tags, force)
+    if header is None:
+        return None, SKIP_INVALID
+    return header, None
+
+
+def scan_archive(archive, tags=None, preambleless=False):
+    """Reads the dicom headers of the members of an archive in one pass
+
+    Parameters
+    ----------
+    archive : string
+        A zip or tar file, compressed or not
+    tags, preambleless
+        See scan_header
+
+    Yields
+    ------
+    (fname, header, reason) for each member, as scan_header returns
+    them; fname names the member as a file inside the archive. An
+    archive which cannot be read yields itself as unreadable.
+    """
+    try:
+        for fname, data in archive_members(archive):
+            reason, force = classify_start(data, preambleless)
+            if reason:
+                yield fname, None, reason
+                continue
+            header = read_header(io.BytesIO(data), tags, force)
+            yield fname, header, None if header is not None else \
+                SKIP_INVALID
+    except ARCHIVE_ERRORS:
+        yield archive, None, SKIP_UNREADABLE
+
+
+def header_pool(workers=1, processes=False):
+    """Returns an executor to read headers with
+
+    Parameters
+    ----------
+    workers : int
+        The number of workers to read with
+    processes : bool
+        Whether to use processes rather than threads
+
+    Returns
+    -------
+    An executor, or None if workers is 1 and reading should be serial
+    """
+    if workers is None or workers <= 1:
+        return None
+    if processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def chunked(iterable, size):
+    """Yields lists of up to size items from an iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_headers(files, workers=1, processes=False, tags=None,
+                 preambleless=False, pool=None):
+    """Reads the dicom headers of many files, optionally in parallel
+
+    Parameters
+    ----------
+    files : list
+        The files to read
+    workers : int
+        The number of workers to read with; 1 reads serially
+    processes : bool
+        Whether to use a process pool (CPU-bound parsing) instead of a
+        thread pool (I/O-bound storage)
+    tags : list
+        If given, only these tags are read from each header
+    preambleless : bool
+        Whether to also read files without the preamble and DICM prefix
+    pool : Executor
+        An executor from header_pool to reuse, rather than starting one
+
+    Returns
+    -------
+    headers : list
+        The headers, in the same order as files. Files which are not
+        dicoms have a header of None.
+    reasons : list
+        Why each file is not a dicom, or None for dicoms
+    """
+    reader = partial(scan_header, tags=tags, preambleless=preambleless)
+    ownpool = pool is None
+    if ownpool and len(files) > 1:
+        pool = header_pool(workers, processes)
+    try:
+        if pool is None or len(files) < 2:
+            results = [reader(f) for f in files]
+        elif processes:
+            # Pickling a header per task is costly, so hand out chunks
+            chunksize = max(1, len(files) // (workers * 4))
+            results = list(pool.map(reader, files, chunksize=chunksize))
+        else:
+            results = list(pool.map(reader, files))
+    finally:
+        if ownpool and pool is not None:
+            pool.shutdown()
+    return [r[0] for r in results], [r[1] for r in results]
+
+
+def series_index(table, subset=None):
+    """Nests files by PatientID, StudyInstanceUID, series and EchoTime
+    in a single pass over a table
+
+    Parameters
+    ----------
+    table : dcmtable
+        The table to index
+    subset : list
+        The files to index; by default all files in the table
+
+    Returns
+    -------
+    A dict where each PatientID hashes to a dict where each
+    StudyInstanceUID hashes to a dict where each (SeriesNumber,
+    SeriesInstanceUID) hashes to a dict of file lists by EchoTime. The
+    identifiers are strings, '' where the files lack them, and the file
+    lists are in table order.
+    """
+    files = subset if subset is not None else table.filelist
+    columns = [table.optional_values(a, subset) for a in HIERARCHY_TAGS]
+    numbers = table.optional_values('SeriesNumber', subset)
+    echoes = table.optional_values('EchoTime', subset)
+    index = {}
+    for i, f in enumerate(files):
+        patient, study, uid = [str(c[i]) if c[i] is not None else ''
+                               for c in columns]
+        series = (int(numbers[i]), uid)
+        groups = index.setdefault(patient, {}).setdefault(
+            study, {}).setdefault(series, {})
+        try:
+            groups[echoes[i]].append(f)
+        except KeyError:
+            groups[echoes[i]] = [f]
+    return index
+
+
+def compact_value(value):
+    """Converts a pydicom element value to a plain, interned python value
+
+    Parameters
+    ----------
+    value
+        The value of a pydicom data element
+
+    Returns
+    -------
+    An int, float, str, tuple or None, with strings interned
+    """
+    if value is None:
+        return None
+    if isinstance(value, pydicom.multival.MultiValue):
+        return tuple(compact_value(v) for v in value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, bytes):
+        return value
+    return sys.intern(str(value))
+
+
+def header_value(header, keyword, tag=None):
+    """Returns the compact value of a tag in a header, skipping pydicom's
+    conversion where the raw value is plain ascii text
+
+    Converting values takes pydicom longer than reading them, so values
+    of RAW_TEXT_VRS, IS and DS are decoded here when they hold a single
+    ascii value. Anything else, e.g. text in another character set or a
+    header read without explicit VRs, goes through pydicom.
+
+    Parameters
+    ----------
+    header : Dataset
+        The header
+    keyword : string
+        The tag's keyword, e.g. 'SeriesNumber'
+    tag : int
+        The tag's number, if known; saves looking it up
+
+    Returns
+    -------
+    The value as compact_value returns it, or None if the header does
+    not have the tag
+    """
+    if tag is None:
+        tag = pydicom.datadict.tag_for_keyword(keyword)
+        if tag is None:
+            return compact_value(getattr(header, keyword, None))
+    if tag not in header:
+        return None
+    raw = header.get_item(tag)
+    value = raw.value
+    if (isinstance(raw, pydicom.dataelem.RawDataElement) and
+            isinstance(value, bytes) and value and
+            b'\\' not in value and b'\x1b' not in value):
+        try:
+            text = value.decode('ascii').rstrip('\0 ')
+            if raw.VR in RAW_TEXT_VRS:
+                return sys.intern(text)
+            if raw.VR == 'IS':
+                return int(text)
+            if raw.VR == 'DS':
+                return float(text)
+        except ValueError:
+            # Not ascii, or not a number; pydicom will know
+            pass
+    return compact_value(getattr(header, keyword, None))
+
 
 class dcmtable:
     """A table of all dicom files in a directory
@@ -21,7 +364,10 @@ class dcmtable:
     filemap : dict
         A dict where each filename hashes to its header contents
     filelist : list
-        A list where you can access files iteratively
+        A list where you can access files iteratively, sorted by name
+    skipped : dict
+        A dict where each reason a file was skipped as not a dicom
+        hashes to the number of files skipped for it
 
     Methods
     -------
@@ -39,36 +385,199 @@ class dcmtable:
     to access the dict in the latter case, at the expense of memory. This
     class is NOT memory-friendly. 
 
-    Future idea: a list-only implementation to be lightweight,
-    dcmtable_light?
+    For a lightweight alternative which only keeps a few tags for each
+    file, see dcmtable_light.
     """
 
+    # The tags read from each file; None reads the full header
+    tags = None
 
-    def __init__(self, path):
+
+    def __init__(self, path, workers=1, processes=False, cache=False,
+                 cachedir=None, preambleless=False, maxdepth=0,
+                 include=None, exclude=None, callback=None,
+                 archives=False, shard=None, shardby='hash'):
+        """Constructor for dcmtable
+        Parameters
+        ----------
+        path : string
+            The directory to read dicoms from, or a zip or tar archive
+        workers : int
+            The number of workers to read headers with; default 1
+        processes : bool
+            Whether to read with processes rather than threads
+        cache : bool
+            Whether to keep a persistent header index, so that later
+            loads only read new or changed files
+        cachedir : string
+            Where to keep the header index; by default the user's cache
+            directory, see cache.USERCACHE
+        preambleless : bool
+            Whether to also read files without the 128-byte preamble and
+            DICM prefix, if they start like a dicom
+        maxdepth : int
+            How many levels of subdirectories to read; by default none,
+            and None reads the whole tree
+        include : list
+            Globs of files to read, matched against the path relative to
+            path or the filename; by default all files
+        exclude : list
+            Globs of files and directories not to read
+        callback : function
+            Called as callback(table, files) while the table is read,
+            with each batch of dicom files just added to it
+        archives : bool
+            Whether to read the members of zip and tar archives in the
+            directory in place, rather than the archives as files. This
+            is always done when path is an archive. Archives are not
+            cached.
+        shard : tuple
+            If given, (index, count): only that shard of the files is
+            read; see walk_files and dicomorg.shard
+        shardby : string
+            How files are split into shards, one of SHARD_MODES
+        """
         if not op.exists(path):
             raise ValueError('Path to read dicoms from does not exist')
         path = op.abspath(path)
-        pathcontents = os.listdir(path)
+        self.preambleless = preambleless
         # Save the path for this table
         self.tablepath = copy(path)
-        # Preallocate; for large datasets this improves runtime
-        self.filemap = dict.fromkeys(range(len(pathcontents)))
+        self._allocate()
         self.filelist = []
+        self.skipped = {}
+        self._attribute_index = {}
+        self._optional_index = {}
+        self._rowmap = None
+
+        # Stream the tree in sorted chunks, so that the table is the same
+        # however many workers read it, without listing it all up front
+        if op.isfile(path) and is_archive(path):
+            files = iter([path])
+            archives = True
+        else:
+            files = timing.timed('list', walk_files(
+                path, maxdepth=maxdepth, include=include, exclude=exclude,
+                ignore=(CACHENAME, SNAPSHOTNAME), skipped=self.skipped,
+                shard=shard, shardby=shardby))
+        if cache:
+            with timing.stage('cache'):
+                index = headercache(self.tablepath, cachedir, self.tags,
+                                    shard)
+            seen = set()
+            changed = False
+        pool = header_pool(workers, processes)
+        try:
+            with timing.scan_profile():
+                for chunk in chunked(files, SCAN_CHUNK):
+                    if archives:
+                        found = [f for f in chunk if is_archive(f)]
+                        chunk = [f for f in chunk if not is_archive(f)]
+                    # Not all files are actually going to be dicoms, need to
+                    # check
+                    with timing.stage('parse', files=len(chunk)):
+                        if cache:
+                            headers, reasons, stale = self._read_cached(
+                                chunk, index, workers, processes, pool)
+                            seen.update(chunk)
+                            changed = changed or stale
+                        else:
+                            headers, reasons = read_headers(
+                                chunk, workers=workers,
+                                processes=processes, tags=self.tags,
+                                preambleless=preambleless, pool=pool)
+                    added = []
+                    for f, header, reason in zip(chunk, headers, reasons):
+                        if header is not None:
+                            self._add(f, header)
+                            self.filelist.append(f)
+                            added.append(f)
+                        else:
+                            self.skipped[reason] = self.skipped.get(reason,
+                                                                    0) + 1
+                    if callback and added:
+                        callback(self, added)
+                    if archives:
+                        for archive in found:
+                            self._read_archive(archive, callback)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if cache and (changed or len(index.entries) != len(seen)):
+            with timing.stage('cache'):
+                try:
+                    index.save(keep=seen)
+                except OSError:
+                    # A read-only session still loads, just not faster
+                    pass
+
 
-        # Not all files are actually going to be dicoms, need to check
-        end_idx = 0
-        for i in range(len(pathcontents)):
-            f = op.join(self.tablepath, pathcontents[i])
+    def _read_archive(self, archive, callback=None):
+        """Adds the dicoms inside an archive, reading it once"""
+        members = timing.timed('parse', scan_archive(
+            archive, tags=self.tags, preambleless=self.preambleless))
+        for chunk in chunked(members, SCAN_CHUNK):
+            added = []
+            for f, header, reason in chunk:
+                if header is not None:
+                    self._add(f, header)
+                    self.filelist.append(f)
+                    added.append(f)
+                else:
+                    self.skipped[reason] = self.skipped.get(reason, 0) + 1
+            if callback and added:
+                callback(self, added)
+
+
+    def _allocate(self):
+        """Prepares storage for headers"""
+        self.filemap = {}
+
+
+    def _add(self, fname, header):
+        """Stores the header read for a file"""
+        self.filemap[fname] = header
+
+
+    def _read_cached(self, files, index, workers, processes, pool):
+        """Reads headers through the persistent index, re-reading only
+        new or changed files. Returns the headers, the reasons files were
+        skipped and how many files were re-read."""
+        headers = [None for f in files]
+        reasons = [None for f in files]
+        stats = [None for f in files]
+        stale = []
+        for i in range(len(files)):
             try:
-                self.filemap[f] = dcmread(f, stop_before_pixels=True)
-                self.filelist.append(f)
-            except (IsADirectoryError, pydicom.errors.InvalidDicomError):
-                pass
+                stats[i] = os.stat(files[i])
+            except OSError:
+                reasons[i] = SKIP_UNREADABLE
+                continue
+            found, headers[i], reasons[i] = index.lookup(files[i], stats[i])
+            if not found:
+                stale.append(i)
+        fresh, freshreasons = read_headers([files[i] for i in stale],
+                                           workers=workers,
+                                           processes=processes,
+                                           tags=self.tags,
+                                           preambleless=self.preambleless,
+                                           pool=pool)
+        for i, header, reason in zip(stale, fresh, freshreasons):
+            headers[i] = header
+            reasons[i] = reason
+            index.update(files[i], stats[i], header, reason)
+        return headers, reasons, len(stale)
 
 
     def __str__(self):
-        return ('Path: ' + self.tablepath + '\n' + 
-                'Total files: ' + str(len(self.filelist)))
+        retstr = ('Path: ' + self.tablepath + '\n' + 
+                  'Total files: ' + str(len(self.filelist)))
+        if self.skipped:
+            reasons = sorted(self.skipped.items(), key=lambda r: -r[1])
+            retstr += ('\nSkipped: ' + str(sum(self.skipped.values())) +
+                       ' (' + ', '.join(r + ': ' + str(n)
+                                        for r, n in reasons) + ')')
+        return retstr
     
     
     def get_header(self, fname):
@@ -88,6 +597,90 @@ class dcmtable:
         except KeyError:
             return None
 
+    def get_value(self, fname, attribute):
+        """Returns the value of an attribute for a given filename
+
+        Parameters
+        ----------
+        fname : string
+            The filename to get the value for
+        attribute : string
+            The attribute to get
+
+        Returns
+        -------
+        The value of the attribute in the file's header
+        """
+        return getattr(self.filemap[fname], attribute)
+
+    def attribute_values(self, attribute):
+        """Returns the values of an attribute for every file in filelist
+
+        The values are read once and kept, so repeated groupings by the
+        same attribute do not touch the headers again.
+
+        Parameters
+        ----------
+        attribute : string
+            The attribute to get the values of
+
+        Returns
+        -------
+        A list of values. Indices correspond with filelist.
+        """
+        try:
+            return self._attribute_index[attribute]
+        except KeyError:
+            pass
+        self._test_attributes(attribute)
+        values = [self.get_value(f, attribute) for f in self.filelist]
+        self._attribute_index[attribute] = values
+        return values
+
+    def _rows(self):
+        """Returns a dict where each filename hashes to its filelist index"""
+        if self._rowmap is None:
+            self._rowmap = {f: i for i, f in enumerate(self.filelist)}
+        return self._rowmap
+
+    def group_by_attributes(self, attributes, subset=None):
+        """Groups files by one or more attributes in a single pass
+
+        Parameters
+        ----------
+        attributes : tuple
+            The attributes to group by, e.g. ('SeriesNumber', 'EchoTime')
+        subset : list
+            The files to group; by default all files in the table
+
+        Returns
+        -------
+        file_groups : list
+            A list of filename lists, each in the order the files appear
+            in the table. Indices correspond with unique_values.
+        unique_values : list
+            A sorted list of tuples of attribute values, one value per
+            attribute. Indices correspond with file_groups.
+        """
+        nfiles = len(subset) if subset else len(self.filelist)
+        with timing.stage('group', files=nfiles):
+            columns = [self.attribute_values(a) for a in attributes]
+            if subset:
+                rows = self._rows()
+                pairs = ((f, rows[f]) for f in subset)
+            else:
+                pairs = zip(self.filelist, range(len(self.filelist)))
+            groups = {}
+            for f, i in pairs:
+                key = tuple(c[i] for c in columns)
+                try:
+                    groups[key].append(f)
+                except KeyError:
+                    groups[key] = [f]
+            unique_values = sorted(groups)
+        file_groups = [groups[v] for v in unique_values]
+        return file_groups, unique_values
+
     def group_by_attribute(self, attribute, subset=None):
         """Returns a list of a list of files and a list of names for
         unique attributes.
@@ -96,6 +689,8 @@ class dcmtable:
         ----------
         attribute : string
             The attribute to group by
+        subset : list
+            The files to group; by default all files in the table
 
         Returns
         -------
@@ -106,55 +701,33 @@ class dcmtable:
             A list of values indicating the unique attribute names.
             Indices correspond with filegroups
         """
-
-        if subset:
-            filelist = subset
-        else:
-            filelist = self.filelist
-
-        attribute_values = ['' for i in filelist]
-        self._test_attributes(attribute)
-        for i in range(len(filelist)):
-            attribute_values[i] = getattr(self.filemap[filelist[i]],
-                                          attribute)
-
-        unique_values = list(set(attribute_values))
-        unique_values.sort()
-        file_groups = [[] for i in unique_values]
-        for i in range(len(filelist)):
-            f = self.filemap[filelist[i]]
-            for j in range(len(unique_values)):
-                v = unique_values[j]
-                if getattr(f, attribute) == v:
-                    file_groups[j].append(filelist[i])
-
-        return file_groups, unique_values
+        file_groups, unique_values = self.group_by_attributes((attribute,),
+                                                              subset)
+        return file_groups, [v[0] for v in unique_values]
 
 
     def group_by_value(self, attribute, attribute_value, subset=None):
-        relevant_files = ['' for x in self.filelist]
-        total_hits = 0
-        if subset:
-            filelist = subset
-        else:
-            filelist = self.filelist
+        """Returns the files whose attribute matches a value
 
-        self._test_attributes(attribute)
-        # Harvest the attributes and values, populating the list
-        for i in range(len(filelist)):
-            f = filelist[i]
-            header = self.filemap[f]
-            this_value = getattr(header, attribute)
-            if this_value == attribute_value:
-                # Hit
-                relevant_files[total_hits] = f
-                total_hits += 1
-
-        # Slice off empty
-        relevant_files = relevant_files[:total_hits+1]
+        Parameters
+        ----------
+        attribute : string
+            The attribute to match
+        attribute_value
+            The value to match
+        subset : list
+            The files to search; by default all files in the table
 
-        # Return the file group
-        return relevant_files
+        Returns
+        -------
+        A list of the matching filenames
+        """
+        values = self.attribute_values(attribute)
+        if subset:
+            rows = self._rows()
+            return [f for f in subset if values[rows[f]] == attribute_value]
+        return [self.filelist[i] for i in range(len(values))
+                if values[i] == attribute_value]
 
 
     def access(self, fname):
@@ -180,128 +753,1096 @@ class dcmtable:
         return header
 
 
+    def optional_values(self, attribute, subset=None):
+        """Returns the values of an attribute which not every file has
+
+        Parameters
+        ----------
+        attribute : string
+            The attribute to get the values of
+        subset : list
+            The files to get values for; by default all files
+
+        Returns
+        -------
+        A list of values, None for files without the attribute. Indices
+        correspond with subset or filelist.
+        """
+        try:
+            values = self._optional_index[attribute]
+        except KeyError:
+            values = [getattr(self.filemap[f], attribute, None)
+                      for f in self.filelist]
+            self._optional_index[attribute] = values
+        if subset is None:
+            return values
+        rows = self._rows()
+        return [values[rows[f]] for f in subset]
+
+
+    def add_files(self, files, workers=1, processes=False):
+        """Reads new files into the table
+
+        Files already in the table are left alone. Cached attribute
+        values are extended rather than rebuilt, so the cost is that of
+        the new files.
+
+        Parameters
+        ----------
+        files : list
+            The files to add; those which are not dicoms are counted in
+            skipped
+        workers, processes
+            See dcmtable
+
+        Returns
+        -------
+        The files added, in the order given
+        """
+        rows = self._rows()
+        new = [f for f in dict.fromkeys(files) if f not in rows]
+        with timing.stage('parse', files=len(new)):
+            headers, reasons = read_headers(new, workers=workers,
+                                            processes=processes,
+                                            tags=self.tags,
+                                            preambleless=self.preambleless)
+        added = []
+        for f, header, reason in zip(new, headers, reasons):
+            if header is not None:
+                self._add(f, header)
+                self.filelist.append(f)
+                added.append(f)
+            else:
+                self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        if self._rowmap is not None:
+            for f in added:
+                self._rowmap[f] = len(self._rowmap)
+        for attribute in list(self._attribute_index):
+            try:
+                self._attribute_index[attribute].extend(
+                    self.get_value(f, attribute) for f in added)
+            except AttributeError:
+                del self._attribute_index[attribute]
+        for attribute, values in self._optional_index.items():
+            values.extend(getattr(self.filemap[f], attribute, None)
+                          for f in added)
+        return added
+
+
+    def remove_files(self, files):
+        """Removes files from the table, e.g. because they were deleted
+
+        Parameters
+        ----------
+        files : list
+            The files to remove; those not in the table are ignored
+
+        Returns
+        -------
+        The files removed, in table order
+        """
+        gone = set(files).intersection(self._rows())
+        if not gone:
+            return []
+        removed = [f for f in self.filelist if f in gone]
+        self.filelist = [f for f in self.filelist if f not in gone]
+        self._remove(gone)
+        self._attribute_index = {}
+        self._optional_index = {}
+        self._rowmap = None
+        return removed
+
+
+    def _remove(self, gone):
+        """Drops the headers of removed files"""
+        for f in gone:
+            del self.filemap[f]
+
+
     def _test_attributes(self, attribute):
+        if not self.filelist:
+            return
         try:
-            getattr(self.filemap[self.filelist[0]], attribute)
+            self.get_value(self.filelist[0], attribute)
         except:
             raise ValueError('Dicom header does not contain attribute ' +
                              attribute)
 
-        
+
+
+class dcmtable_light(dcmtable):
+    """A memory-friendly table of the dicom files in a directory
+
+    Only a declared set of tags is read from each file, and their values
+    are kept in columns of plain, interned python values rather than as
+    pydicom headers. Full headers are read from disk on demand and kept
+    in a bounded least-recently-used cache. This is a drop-in replacement
+    for dcmtable in seriestable.
+
+    Attributes
+    ----------
+    filelist : list
+        A list where you can access files iteratively, sorted by name
+    rowmap : dict
+        A dict where each filename hashes to its row in the columns
+    columns : dict
+        A dict where each tag hashes to a list of values, one per file
+    headers : headerlru
+        The cache of full headers read by get_header and access, with
+        hit and miss counters
+    """
+    def __init__(self, path, tags=None, workers=1, processes=False,
+                 cache=False, cachedir=None, preambleless=False, maxdepth=0,
+                 include=None, exclude=None, headerentries=128,
+                 headerbytes=None, callback=None, archives=False,
+                 shard=None, shardby='hash'):
+        """Constructor for dcmtable_light
+        Parameters
+        ----------
+        path : string
+            The directory to read dicoms from, or a zip or tar archive
+        tags : list
+            The tags to keep for each file; by default LIGHT_TAGS
+        headerentries : int
+            The most full headers to keep cached; None for no limit
+        headerbytes : int
+            The most full header bytes to keep cached; None for no limit
+        workers, processes, cache, cachedir, preambleless, maxdepth,
+        include, exclude, callback, archives, shard, shardby
+            See dcmtable
+        """
+        if tags is None:
+            tags = LIGHT_TAGS
+        self.tags = list(tags)
+        self.headers = headerlru(headerentries, headerbytes)
+        dcmtable.__init__(self, path, workers=workers, processes=processes,
+                          cache=cache, cachedir=cachedir,
+                          preambleless=preambleless, maxdepth=maxdepth,
+                          include=include, exclude=exclude,
+                          callback=callback, archives=archives,
+                          shard=shard, shardby=shardby)
+        # Value pools are only needed while reading
+        del self._pools, self._numbers
+
+
+    @classmethod
+    def from_columns(cls, path, filelist, columns, preambleless=False,
+                     headerentries=128, headerbytes=None):
+        """Builds a table from values already read, without touching the
+        files
+
+        Parameters
+        ----------
+        path : string
+            The directory the files were read from
+        filelist : list
+            The dicom files, in table order
+        columns : dict
+            A dict where each tag hashes to a list of values, one per
+            file, as compact_value returns them
+        preambleless, headerentries, headerbytes
+            See dcmtable_light
+
+        Returns
+        -------
+        The table
+        """
+        table = cls.__new__(cls)
+        table.tablepath = op.abspath(path)
+        table.preambleless = preambleless
+        table.tags = list(columns)
+        table.headers = headerlru(headerentries, headerbytes)
+        table.filelist = list(filelist)
+        table.rowmap = {f: i for i, f in enumerate(table.filelist)}
+        table.columns = {t: list(v) for t, v in columns.items()}
+        table.skipped = {}
+        table._attribute_index = {}
+        table._optional_index = {}
+        table._rowmap = None
+        return table
+
+
+    def _allocate(self):
+        self.rowmap = {}
+        self.columns = {t: [] for t in self.tags}
+        self._pools = {t: {} for t in self.tags}
+        self._numbers = {t: pydicom.datadict.tag_for_keyword(t)
+                         for t in self.tags}
+
+
+    def _add(self, fname, header):
+        self.rowmap[fname] = len(self.rowmap)
+        for t in self.tags:
+            value = header_value(header, t, self._numbers[t])
+            # Share one object between all files with the same value
+            try:
+                value = self._pools[t].setdefault(value, value)
+            except TypeError:
+                pass
+            self.columns[t].append(value)
+
+
+    def add_files(self, files, workers=1, processes=False):
+        self._pools = {t: {} for t in self.tags}
+        self._numbers = {t: pydicom.datadict.tag_for_keyword(t)
+                         for t in self.tags}
+        try:
+            return dcmtable.add_files(self, files, workers=workers,
+                                      processes=processes)
+        finally:
+            del self._pools, self._numbers
+
+
+    def _remove(self, gone):
+        rows = [self.rowmap[f] for f in self.filelist]
+        self.columns = {t: [c[i] for i in rows]
+                        for t, c in self.columns.items()}
+        self.rowmap = {f: i for i, f in enumerate(self.filelist)}
+        self.headers.clear()
+
+
+    def get_header(self, fname):
+        """Returns the full dicom header for a given filename, reading it
+        from disk if it is not cached
+
+        Parameters
+        ----------
+        fname : string
+            The filename you'd like the header information for
+
+        Returns
+        -------
+        The header, or None if the file is not in the table
+        """
+        if fname not in self.rowmap:
+            return None
+        return self._load(fname)
+
+
+    def access(self, fname):
+        """Returns the full dicom header for any valid file, reading it
+        from disk if it is not cached
+
+        Parameters
+        ----------
+        fname : string
+            The filename to get the header of
+
+        Returns
+        -------
+        The header for the file
+
+        Raises
+        ------
+        ValueError if the file isn't in the table
+        """
+        if fname not in self.rowmap:
+            raise ValueError('File ' + fname + ' is not in the file table.')
+        return self._load(fname)
+
+
+    def _load(self, fname):
+        return self.headers.get(fname, partial(read_header_sized,
+                                               force=self.preambleless))
+
+
+    def cache_info(self):
+        """Returns the full header cache's counters and sizes as a dict"""
+        return self.headers.info()
+
+
+    def get_value(self, fname, attribute):
+        return self.columns[attribute][self.rowmap[fname]]
+
+
+    def attribute_values(self, attribute):
+        self._test_attributes(attribute)
+        return self.columns[attribute]
+
+
+    def optional_values(self, attribute, subset=None):
+        values = self.columns.get(attribute)
+        if values is None:
+            n = len(subset) if subset is not None else len(self.filelist)
+            return [None] * n
+        if subset is None:
+            return values
+        return [values[self.rowmap[f]] for f in subset]
+
+
+    def _rows(self):
+        return self.rowmap
+
+
+    def _test_attributes(self, attribute):
+        if attribute not in self.columns:
+            raise ValueError('Attribute ' + attribute + ' was not read; '
+                             'add it to the table tags')
+
+
 class seriestable:
+    """A table of the dicom series in a dcmtable
+
+    Attributes
+    ----------
+    pathtable : dcmtable
+        The table of files the series are built from
+    SeriesList : list
+        The dcmseries, sorted by patient, study and series number
+    index : dict
+        The same dcmseries nested by PatientID and StudyInstanceUID,
+        where each study's dict hashes (SeriesNumber,
+        SeriesInstanceUID) to its series
+    history : list
+        The changes which can be undone, latest last. Each change is a
+        (indices, forward) tuple of the SeriesList indices it stepped
+        and whether it stepped them forward (an edit or redo) or back
+        (an undo of a single series).
+    redohistory : list
+        The undone changes which can be redone, latest last. Changing a
+        series drops the undone changes to it, but undone changes to
+        other series can still be redone.
+
+    Notes
+    -----
+    Each dcmseries keeps the history of its own alias, so a change only
+    costs as much as the series it touches, and changes to different
+    series can be undone and redone independently.
+
+    Series are told apart by SeriesInstanceUID within their patient and
+    study, so folders mixing several studies do not merge series which
+    share a number. Such series are identified by their number and a
+    counter, e.g. 3.1 and 3.2; see dcmseries.get_key.
+    """
     def __init__(self, pathtable, orig=None):
         if orig:
             self.pathtable = orig.pathtable
-            self.nexttable = copy(orig.nexttable)
-            self.prevtable = copy(orig.prevtable)
+            self.history = list(orig.history)
+            self.redohistory = list(orig.redohistory)
             self.SeriesList = []
             for s in orig.SeriesList:
                 self.SeriesList.append(copy(s))
+            self._build_index()
         else:
-            groups, numbers = pathtable.group_by_attribute('SeriesNumber')
             self.pathtable = pathtable
-            self.SeriesList = [None for i in groups]
-            self.nexttable = None
-            self.prevtable = None
-            for i in range(len(groups)):
-                self.SeriesList[i] = dcmseries(pathtable, groups[i])
+            self.SeriesList = []
+            self.history = []
+            self.redohistory = []
+            with timing.stage('series', files=len(pathtable.filelist)):
+                # Split patients, studies, series and echoes in a single
+                # sweep over the table, and flatten the result
+                self.SeriesList = self._flatten(series_index(pathtable))
+            self._build_index()
+    def _flatten(self, index):
+        """Returns the dcmseries of a series_index, in order"""
+        serieslist = []
+        for patient in sorted(index):
+            for study in sorted(index[patient]):
+                for series in sorted(index[patient][study]):
+                    groups = index[patient][study][series]
+                    echoes = sorted(groups)
+                    echo_groups = [groups[e] for e in echoes]
+                    files = [f for g in echo_groups for f in g]
+                    serieslist.append(dcmseries(
+                        self.pathtable, files, echo_groups=echo_groups,
+                        echoes=echoes))
+        return serieslist
+    def _build_index(self):
+        """Nests SeriesList by patient and study and gives series which
+        share a number distinct keys"""
+        self.index = {}
+        bynumber = {}
+        for s in self.SeriesList:
+            self.index.setdefault(s.patient, {}).setdefault(
+                s.study, {})[(s.number, s.uid)] = s
+            bynumber.setdefault(s.number, []).append(s)
+        for number, shared in bynumber.items():
+            if len(shared) == 1:
+                shared[0].key = str(number)
+            else:
+                for i, s in enumerate(shared, 1):
+                    s.key = str(number) + '.' + str(i)
+    def _order(self, s):
+        return (s.patient, s.study, s.number, s.uid)
     def __str__(self):
         retstr = ''
+        mixed = len(self.index) > 1 or any(len(studies) > 1 for studies
+                                           in self.index.values())
+        last = None
         for s in self.SeriesList:
             if s.is_ignorable():
                 continue
+            if mixed and (s.patient, s.study) != last:
+                last = (s.patient, s.study)
+                retstr += blue('Patient ' + (s.patient or '?') + ', study ' +
+                               (s.study or '?')) + '\n'
             retstr += str(s) + '\n'
         return retstr
     def __copy__(self):
         return seriestable(self.pathtable, orig=self)
+
+    def get_state(self):
+        """Returns the series and their histories as plain values, with
+        files as rows of pathtable, for a session snapshot"""
+        rowmap = {f: i for i, f in enumerate(self.pathtable.filelist)}
+        return {'series': [s.get_state(rowmap) for s in self.SeriesList],
+                'history': list(self.history),
+                'redohistory': list(self.redohistory)}
+
+    @classmethod
+    def from_state(cls, pathtable, state):
+        """Builds a table from get_state without grouping any files
+
+        Parameters
+        ----------
+        pathtable : dcmtable
+            A table with the same files, in the same order, as the one
+            the state was taken from
+        state : dict
+            What get_state returned
+
+        Returns
+        -------
+        The table, with the aliases, backends and undo history it had
+        """
+        table = cls.__new__(cls)
+        table.pathtable = pathtable
+        table.SeriesList = [dcmseries.from_state(pathtable, s)
+                            for s in state['series']]
+        table.history = [tuple(h) for h in state['history']]
+        table.redohistory = [tuple(h) for h in state['redohistory']]
+        table._build_index()
+        return table
+
+    def restore(self, state):
+        """Carries aliases, ignores and backends over from get_state to
+        the same series here, e.g. after files were added to the tree;
+        undo history is not carried over
+
+        Returns
+        -------
+        The number of series carried over
+        """
+        saved = {(s['patient'], s['study'], s['number'], s['uid']): s
+                 for s in state['series']}
+        restored = 0
+        for s in self.SeriesList:
+            old = saved.get(self._order(s))
+            if old is None:
+                continue
+            s.alias = old['alias']
+            s.backend = old['backend']
+            restored += 1
+        return restored
         
     def isempty(self):
         return len(self.SeriesList) == 0
+    def find_series(self, identifier):
+        """Returns the index of a series in SeriesList
+
+        Parameters
+        ----------
+        identifier : string
+            The series key (its number, unless several series share
+            it), or its current alias or name
+
+        Returns
+        -------
+        The index of the series
+
+        Raises
+        ------
+        Exception if no series matches
+        """
+        for i in range(len(self.SeriesList)):
+            if identifier == self.SeriesList[i].get_key():
+                return i
+        for i in range(len(self.SeriesList)):
+            s = self.SeriesList[i]
+            if s.get_alias():
+                if identifier == s.get_alias():
+                    return i
+            elif identifier == s.get_name():
+                return i
+        raise Exception(identifier + ' is not present in the table.')
+    def _step(self, indices, forward):
+        """Steps the given series forward or back through their alias
+        histories, if they all can be"""
+        for i in indices:
+            if not self.SeriesList[i].can_step(forward):
+                return False
+        for i in indices:
+            self.SeriesList[i].step(forward)
+        return True
+    def _change(self, indices, forward=True):
+        """Records a change to the given series, after which undos of
+        those series can no longer be redone"""
+        changed = set(indices)
+        self.redohistory = [r for r in self.redohistory
+                            if not changed.intersection(r[0])]
+        self.history.append((indices, forward))
+    def undo(self, series=None):
+        """Undoes the latest change, or the latest change to one series
+
+        Parameters
+        ----------
+        series : string
+            The series number, alias or name to undo the latest change
+            of; by default the latest change to the table is undone
+
+        Returns
+        -------
+        Whether there was a change to undo
+        """
+        if series is not None:
+            i = self.find_series(series)
+            if not self._step([i], False):
+                return False
+            self._change([i], False)
+            return True
+        while self.history:
+            indices, forward = self.history.pop()
+            if self._step(indices, not forward):
+                self.redohistory.append((indices, forward))
+                return True
+        return False
+    def redo(self, series=None):
+        """Redoes the latest undo, or the latest undo of one series
+
+        Parameters
+        ----------
+        series : string
+            The series number, alias or name to redo the latest undo
+            of; by default the latest undo to the table is redone
+
+        Returns
+        -------
+        Whether there was an undo to redo
+        """
+        if series is not None:
+            i = self.find_series(series)
+            if not self._step([i], True):
+                return False
+            self._change([i], True)
+            return True
+        while self.redohistory:
+            indices, forward = self.redohistory.pop()
+            if self._step(indices, forward):
+                self.history.append((indices, forward))
+                return True
+        return False
     def ignore(self, toignore):
-        newtable = copy(self)
-        newtable.prevtable = copy(self)
-        newtable.nexttable = None
-        idxtoignore = []
-        for ignorable in toignore:
-            ispresent = False
-            for i in range(len(newtable.SeriesList)):
-                number = str(newtable.SeriesList[i].get_number())
-                if ignorable == number:
-                    ispresent = True
-                    idxtoignore.append(i)
-                    break
-            if not ispresent:
-                raise Exception(ignorable + ' is not present in the table.')
+        idxtoignore = [self.find_series(ignorable)
+                       for ignorable in toignore]
         for i in idxtoignore:
-            newtable.SeriesList[i].ignore()
-        return newtable
+            self.SeriesList[i].ignore()
+        self._change(idxtoignore)
+        return self
     def alias(self, aliasinstructions):
-        newtable = copy(self)
-        newtable.prevtable = copy(self)
-        newtable.nexttable = None
         aliaswords = aliasinstructions.split(' ')
         if len(aliaswords) % 2 != 0:
             raise Exception('Alias indices are not paired with aliases.')
         idxtoalias = []
         aliases = []
         for i in range(round(len(aliaswords)/2)):
+            series_to_alias = aliaswords[i*2]
             try:
-                series_to_alias = int(aliaswords[i*2])
-                idxtoalias.append(series_to_alias)
+                number = int(float(series_to_alias))
             except:
-                raise Exception(aliaswords[i] + ' cannot be converted to '
+                raise Exception(series_to_alias + ' cannot be converted to '
                                 'a series number.')
-            aliases.append(aliaswords[i*2+1])
-        for i in range(len(idxtoalias)):
             iscontained = False
-            for j in range(len(newtable.SeriesList)):
-                if idxtoalias[i] == newtable.SeriesList[j].get_number():
-                    aliasedseries = newtable.SeriesList[j]
-                    aliasedseries.set_alias(aliases[i])
+            for j in range(len(self.SeriesList)):
+                if series_to_alias == self.SeriesList[j].get_key():
+                    idxtoalias.append(j)
                     iscontained = True
                     break
             if not iscontained:
-                raise Exception('Given index ' + str(idxtoalias[i]) + 
+                shared = [s.get_key() for s in self.SeriesList
+                          if s.get_number() == number]
+                if shared:
+                    raise Exception('Several series are numbered ' +
+                                    str(number) + '; use one of ' +
+                                    ', '.join(shared) + '.')
+                raise Exception('Given index ' + series_to_alias +
                                 ' is not in range.')
-        return newtable
-    def convert(self, outpath=None, force=False, interactive=True):
-        if not outpath:
-            outpath = self.pathtable.tablepath
-        print(blue('Converting...'))
+            aliases.append(aliaswords[i*2+1])
+        # Only change anything once the whole instruction is valid
+        for i in range(len(idxtoalias)):
+            self.SeriesList[idxtoalias[i]].set_alias(aliases[i])
+        self._change(idxtoalias)
+        return self
+    def set_backend(self, backend, series=None):
+        """Sets the converter of some or all series
+
+        Parameters
+        ----------
+        backend : string
+            One of BACKENDS
+        series : list
+            The series numbers, aliases or names to set; by default all
+
+        Returns
+        -------
+        The table
+        """
+        if series is None:
+            indices = range(len(self.SeriesList))
+        else:
+            indices = [self.find_series(s) for s in series]
+        for i in indices:
+            self.SeriesList[i].set_backend(backend)
+        return self
+    def add_files(self, files):
+        """Adds files already added to pathtable, growing their series
+        or creating new ones
+
+        Only the series the files belong to are regrouped, and aliases,
+        backends and histories are kept.
+
+        Parameters
+        ----------
+        files : list
+            Files in pathtable which are not in any series yet
+
+        Returns
+        -------
+        The series numbers which changed
+        """
+        if not files:
+            return []
+        index = series_index(self.pathtable, files)
+        serieslist = list(self.SeriesList)
+        changed = []
+        for patient, studies in index.items():
+            for study, series in studies.items():
+                known = self.index.get(patient, {}).get(study, {})
+                for (number, uid), groups in series.items():
+                    group = [f for g in groups.values() for f in g]
+                    s = known.get((number, uid))
+                    if s is None:
+                        s = dcmseries(self.pathtable, group)
+                        serieslist.append(s)
+                    else:
+                        s.set_files(self.pathtable, s.files + group)
+                    changed.append(s)
+        serieslist.sort(key=self._order)
+        self._reorder(serieslist)
+        return sorted(set(s.get_number() for s in changed))
+    def remove_files(self, files):
+        """Removes files from their series, dropping series left empty
+        along with their history
+
+        Parameters
+        ----------
+        files : list
+            Files removed from pathtable
+
+        Returns
+        -------
+        The series numbers which changed
+        """
+        gone = set(files)
+        if not gone:
+            return []
+        serieslist = []
+        changed = []
+        for s in self.SeriesList:
+            remaining = [f for f in s.files if f not in gone]
+            if len(remaining) != len(s.files):
+                changed.append(s.get_number())
+                if not remaining:
+                    continue
+                s.set_files(self.pathtable, remaining)
+            serieslist.append(s)
+        self._reorder(serieslist)
+        return changed
+    def _reorder(self, serieslist):
+        """Replaces SeriesList, keeping the history of the series which
+        remain"""
+        newindex = {id(s): i for i, s in enumerate(serieslist)}
+        def remap(changes):
+            remapped = []
+            for indices, forward in changes:
+                kept = [newindex[id(self.SeriesList[i])] for i in indices
+                        if id(self.SeriesList[i]) in newindex]
+                if kept:
+                    remapped.append((kept, forward))
+            return remapped
+        self.history = remap(self.history)
+        self.redohistory = remap(self.redohistory)
+        self.SeriesList = serieslist
+        self._build_index()
+    def convert(self, outpath=None, force=False, interactive=True, jobs=1,
+                manifest=True, validate=None, batch=1):
+        """Converts every series which is not ignored
+
+        Parameters
+        ----------
+        outpath : string
+            Where to write the niftis; by default the dicom path
+        force : bool
+            Whether to overwrite existing niftis, converting series the
+            manifest says are already converted too
+        interactive : bool
+            Whether to offer to print failure messages; if not, they are
+            always printed
+        jobs : int
+            The number of conversions to run at once; default 1
+        manifest : bool
+            Whether to keep a manifest of conversions in outpath, and
+            skip series already converted from the same inputs under the
+            same name, unless forcing; series converted under the same
+            name from other inputs replace their recorded outputs
+        validate : string
+            Whether to check series before converting them (see
+            validate), and what to do with those which fail: 'skip'
+            them, or 'quarantine' them by converting them into a
+            quarantine directory under outpath; by default series are
+            not checked
+        batch : int
+            The most series to convert in one dcm2niix run; see
+            convert_series
+
+        Returns
+        -------
+        converted : int
+            The number of series converted
+        skipped : int
+            The number of series skipped as already converted
+        failures : int
+            The number of series which failed, would have overwritten
+            files, or were skipped or quarantined by validation
+        """
+        outpath = self._outpath(outpath)
+        converted = 0
+        skipped = 0
         conversion_failures = 0
         conversion_errors = []
         failed_series = []
-        for s in self.SeriesList:
-            if s.is_ignorable():
-                continue
+        toconvert, invalid = self._checked(validate)
+        if invalid:
+            if validate == 'quarantine':
+                quarantine = op.join(outpath, QUARANTINENAME)
+                print(blue('Quarantining to ' + quarantine + '...'))
+                for s, outputs, e in convert_series(invalid, quarantine,
+                                                    force, jobs, batch):
+                    print(yellow(str(s)) if e is None else red(str(s)))
             else:
-                try:
-                    s.convert(outpath, overwrite=force)
-                    print(green(str(s)))
-                except ConversionError as e:
-                    conversion_failures += 1
-                    conversion_errors.append(str(e))
-                    failed_series.append(str(s))
-                    print(red(str(s)))
-                except ValueError as e:
-                    print(red(str(e)))
-                    print(blue('To force convert, use the force option.'))
-                    break
+                print(blue('Skipping ' + str(len(invalid)) +
+                           ' series with problems'))
+        print(blue('Converting...'))
+        if manifest:
+            record, signatures, dirty = self._unconverted(toconvert, outpath,
+                                                          force)
+            skipped = len(toconvert) - len(dirty)
+            toconvert = dirty
+            # Series which changed since they were converted replace
+            # their own outputs, which would otherwise be in the way
+            replaced = [s for s in dirty if not force and record.replaces(s)]
+            for s in replaced:
+                record.discard(s)
+            if replaced:
+                record.save()
+        for s, outputs, e in convert_series(toconvert, outpath, force, jobs,
+                                            batch):
+            if e is None:
+                print(green(str(s)))
+                converted += 1
+                if manifest:
+                    record.record(s, s.get_args(), outputs, signatures[s])
+                    record.save()
+            elif isinstance(e, ConversionError):
+                conversion_failures += 1
+                conversion_errors.append(str(e))
+                failed_series.append(str(s))
+                print(red(str(s)))
+            else:
+                print(red(str(e)))
+                print(blue('To force convert, use the force option.'))
+                return (converted, skipped,
+                        conversion_failures + len(invalid) + 1)
         if conversion_failures:
             print(red(str(conversion_failures) + ' conversion failures'))
+            userinput = 'y'
             if interactive:
                 print('See failure messages? (y/n)')
                 userinput = ''
                 while not (userinput == 'n' or userinput == 'y'):
                     userinput = input('>> ')
-                if userinput == 'y':
-                    for i in range(len(failed_series)):
-                        print(cyan(failed_series[i]))
-                        print(red(conversion_errors[i]))
+            if userinput == 'y':
+                for i in range(len(failed_series)):
+                    print(cyan(failed_series[i]))
+                    print(red(conversion_errors[i]))
+        return converted, skipped, conversion_failures + len(invalid)
     
+    def submit(self, engine, outpath=None, force=False, manifest=True,
+               validate=None):
+        """Queues every series which is not ignored on a conversion
+        engine, which converts them in the background
+
+        Parameters
+        ----------
+        engine : conversionengine
+            The engine to queue the series on
+        outpath, force, manifest, validate
+            See convert; quarantined series are queued too
+
+        Returns
+        -------
+        The number of series queued
+        """
+        outpath = self._outpath(outpath)
+        toconvert, invalid = self._checked(validate)
+        queued = 0
+        if invalid:
+            if validate == 'quarantine':
+                quarantine = op.join(outpath, QUARANTINENAME)
+                print(blue('Quarantining to ' + quarantine + '...'))
+                for s in invalid:
+                    queued += engine.submit(s, quarantine, force)
+            else:
+                print(blue('Skipping ' + str(len(invalid)) +
+                           ' series with problems'))
+        signatures = {}
+        if manifest:
+            # Check against the manifest the engine records into, which
+            # has the jobs already finished even if another is running
+            _, signatures, toconvert = self._unconverted(
+                toconvert, outpath, force, engine.get_manifest(outpath))
+        for s in toconvert:
+            # Series which changed since they were converted replace
+            # their own outputs
+            replace = manifest and engine.get_manifest(outpath).replaces(s)
+            queued += engine.submit(s, outpath, force or replace, manifest,
+                                    signatures.get(s))
+        return queued
+
+    def _outpath(self, outpath):
+        """Returns where to convert to: outpath, or by default the dicom
+        path, or the directory of an archive"""
+        if not outpath:
+            outpath = self.pathtable.tablepath
+            if is_archive(outpath):
+                outpath = op.dirname(outpath)
+        return outpath
+
+    def _checked(self, validate):
+        """Returns the series which are not ignored, and those of them
+        with problems if validate is set, printing the problems"""
+        toconvert = [s for s in self.SeriesList if not s.is_ignorable()]
+        if not validate:
+            return toconvert, []
+        invalid = self.validate()
+        for s in invalid:
+            print(red(str(s)))
+            for p in s.get_problems():
+                print(red('    ' + p))
+        return [s for s in toconvert if s not in invalid], invalid
+
+    def _unconverted(self, series, outpath, force=False, record=None):
+        """Returns the manifest of outpath (record, or read from disk),
+        the input signature of each series and those not already
+        converted, printing the others; forcing converts them all"""
+        with timing.stage('manifest',
+                          files=sum(len(s.files) for s in series)):
+            if record is None:
+                record = conversionmanifest(outpath)
+            signatures = {}
+            dirty = []
+            for s in series:
+                signatures[s] = input_signature(s.get_files())
+                if not force and record.is_current(s, s.get_args(),
+                                                   signatures[s]):
+                    print(cyan(str(s)))
+                else:
+                    dirty.append(s)
+        return record, signatures, dirty
+
+    def validate(self):
+        """Checks every series which is not ignored for missing slices,
+        duplicated files and inconsistent echoes, using the headers
+        already read
+
+        Returns
+        -------
+        A list of the series with problems; each series' problems are
+        kept for get_problems
+        """
+        bad = []
+        toconvert = [s for s in self.SeriesList if not s.is_ignorable()]
+        with timing.stage('validate',
+                          files=sum(len(s.files) for s in toconvert)):
+            for s in toconvert:
+                s.problems = validate_series(
+                    self.pathtable, s.files, s.echo_groups if s.me else None)
+                if s.problems:
+                    bad.append(s)
+        return bad
+
+    def organise(self, outpath, mode='auto', jobs=8, batch=1000):
+        """Lays out the files of every series which is not ignored in a
+        Patient/Study/Series tree, named by alias where there is one
+
+        Parameters
+        ----------
+        outpath : string
+            The root of the tree
+        mode : string
+            How to place files, one of ORGANISE_MODES; by default
+            hardlinked or reflinked where possible and copied otherwise
+        jobs : int
+            The number of files to place at once
+        batch : int
+            The number of files to place between journal writes; an
+            interrupted run resumes after the last batch written
+
+        Returns
+        -------
+        A dict of how many files were placed each way
+        """
+        toplace = [s for s in self.SeriesList if not s.is_ignorable()]
+        pairs = plan_series(toplace)
+        print(blue('Organising ' + str(len(pairs)) + ' files...'))
+
+        def progress(done, total):
+            print('{}/{} files'.format(done, total))
+
+        counts = organise(pairs, outpath, mode=mode, jobs=jobs,
+                          batch=batch, progress=progress)
+        for s in toplace:
+            print(green(str(s)))
+        print(', '.join('{} {}'.format(n, k) for k, n in counts.items()
+                        if n))
+        return counts
+
+
+def _convert_one(series, outpath, overwrite):
+    """Converts a series, returning the files produced and the error
+    raised if any"""
+    try:
+        return series.convert(outpath, overwrite=overwrite), None
+    except (ConversionError, ValueError) as e:
+        return [], e
+
+
+def _convert_batch(series, outpath, overwrite):
+    """Converts several dcm2niix series with one dcm2niix run, returning
+    the files produced and the error raised for each"""
+    if len(series) == 1:
+        return [_convert_one(series[0], outpath, overwrite)]
+    files = [f for s in series for f in s.files]
+    try:
+        with timing.stage('convert', files=len(files)):
+            with staged(files, outpath) as paths:
+                groups = []
+                owners = []
+                for i, s in enumerate(series):
+                    for group in s.get_groups(paths):
+                        groups.append(group)
+                        owners.append(i)
+                results = dcm2niix_batch(groups, outpath, overwrite)
+    except (ConversionError, ValueError, OSError):
+        # One bad series fails the whole run, so find it by converting
+        # each series on its own; this also covers filesystems without
+        # symlinks to stage on
+        return [_convert_one(s, outpath, overwrite) for s in series]
+    outputs = [[] for s in series]
+    errors = [None] * len(series)
+    for i, result in zip(owners, results):
+        if isinstance(result, Exception):
+            errors[i] = errors[i] or result
+        else:
+            outputs[i] += result
+    done = []
+    for s, o, e in zip(series, outputs, errors):
+        if isinstance(e, ConversionError):
+            # e.g. dcm2niix named its outputs otherwise than expected
+            for f in o:
+                os.remove(f)
+            done.append(_convert_one(s, outpath, overwrite))
+        else:
+            done.append((sorted(o), e))
+    return done
+
+
+def _batches(series, batch):
+    """Splits series into lists converted together: up to batch series
+    which use dcm2niix and have their own SeriesInstanceUID, or one which
+    does not or is multi-echo"""
+    units = []
+    current = []
+    for s in series:
+        # dcm2niix names the echoes of a series by their EchoNumbers, and
+        # suffixes them if they share a run, so batching would rename them;
+        # outputs of a batch are told apart by SeriesInstanceUID
+        if s.get_backend() != 'dcm2niix' or s.me or not s.uid:
+            units.append([s])
+            continue
+        if any(s.uid == other.uid for other in current):
+            current = []
+        if not current:
+            units.append(current)
+        current.append(s)
+        if len(current) == batch:
+            current = []
+    return units
+
+
+def convert_series(series, outpath, overwrite=False, jobs=1, batch=1):
+    """Converts several series, running up to jobs conversions at once
+
+    Parameters
+    ----------
+    series : list
+        The dcmseries to convert
+    outpath : string
+        Where to write the niftis
+    overwrite : bool
+        Whether to overwrite existing niftis
+    jobs : int
+        The number of conversions to run at once
+    batch : int
+        The most series which use dcm2niix to convert in one dcm2niix
+        run, saving a process start for each of the others; multi-echo
+        series are always converted on their own, so that they are named
+        the same either way
+
+    Yields
+    ------
+    (series, outputs, error) in the order of the input series, where
+    outputs are the files produced and error is the ConversionError or
+    ValueError raised, or None on success. If the caller stops
+    iterating, conversions not yet started are dropped.
+    """
+    units = _batches(series, max(1, batch or 1))
+    # Where each series' result is: its batch and its place in it
+    places = {s: (u, k) for u, unit in enumerate(units)
+              for k, s in enumerate(unit)}
+    done = {}
+    if jobs is None or jobs <= 1:
+        for s in series:
+            u, k = places[s]
+            if u not in done:
+                done[u] = _convert_batch(units[u], outpath, overwrite)
+            yield (s,) + done[u][k]
+        return
+    # dcm2niix does the work in a subprocess, so threads are enough
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_convert_batch, unit, outpath, overwrite)
+                   for unit in units]
+        try:
+            for s in series:
+                u, k = places[s]
+                yield (s,) + futures[u].result()[k]
+        finally:
+            for future in futures:
+                future.cancel()
+
 
 class dcmseries:
-    def __init__(self, filetable, filegroup, orig=None):
+    def __init__(self, filetable, filegroup, orig=None, echo_groups=None,
+                 echoes=None):
         """Constructor for dcmseries
         Parameters
         ----------
@@ -311,13 +1852,24 @@ class dcmseries:
             An array of filenames that belong in this series
         tocopy
             A series from which to copy information
+        echo_groups, echoes
+            The files grouped by EchoTime and the sorted echo times, if
+            already known; otherwise they are grouped here
         """
         if orig:
             self.name = orig.name
             self.number = orig.number
             self.start = orig.start
+            self.patient = orig.patient
+            self.study = orig.study
+            self.uid = orig.uid
+            self.key = orig.key
             self.files = orig.files
             self.alias = copy(orig.alias)
+            self.past = list(orig.past)
+            self.future = list(orig.future)
+            self.backend = orig.backend
+            self.problems = orig.problems
             if orig.me:
                 self.me = True
                 self.echo_groups = orig.echo_groups
@@ -325,25 +1877,86 @@ class dcmseries:
             else:
                 self.me = False
         else:
-            header = filetable.access(filegroup[0])
-            self.name = header.SeriesDescription
-            self.number = int(header.SeriesNumber)
-            self.start = header.SeriesTime
-            self.files = filegroup
+            first = filegroup[0]
+            self.name = str(filetable.get_value(first, 'SeriesDescription'))
+            self.number = int(filetable.get_value(first, 'SeriesNumber'))
+            self.start = str(filetable.get_value(first, 'SeriesTime'))
+            ids = [filetable.optional_values(a, [first])[0]
+                   for a in HIERARCHY_TAGS]
+            self.patient, self.study, self.uid = [
+                str(v) if v is not None else '' for v in ids]
+            # The identifier shown and typed; seriestable makes it unique
+            self.key = str(self.number)
             self.alias = None
-            # Determine if multi-echo
-            groups, echoes = filetable.group_by_attribute('EchoTime',
-                                                          filegroup)
-            if len(echoes) > 1:
-                self.echo_groups = groups
-                self.echoes = echoes
-                self.me = True
-            else:
-                self.me = False
+            # Previous and undone aliases, latest last
+            self.past = []
+            self.future = []
+            self.backend = 'dcm2niix'
+            self.set_files(filetable, filegroup, echo_groups, echoes)
+
+    def set_files(self, filetable, filegroup, echo_groups=None,
+                  echoes=None):
+        """Sets the files of this series and determines if it is
+        multi-echo
+
+        Parameters
+        ----------
+        filetable
+            The filetable for this series' path
+        filegroup
+            The filenames that belong in this series
+        echo_groups, echoes
+            See the constructor
+        """
+        self.files = filegroup
+        # Problems found by seriestable.validate; None until checked
+        self.problems = None
+        if echo_groups is None:
+            with timing.stage('echo', files=len(filegroup)):
+                echo_groups, echoes = filetable.group_by_attribute(
+                    'EchoTime', filegroup)
+        if len(echoes) > 1:
+            self.echo_groups = echo_groups
+            self.echoes = echoes
+            self.me = True
+        else:
+            self.me = False
 
     def __copy__(self):
         return dcmseries(None, None, self)
 
+    def get_state(self, rowmap):
+        """Returns the series as plain values, with its files as rows
+
+        Parameters
+        ----------
+        rowmap : dict
+            A dict where each filename hashes to its row in the table
+        """
+        state = {a: getattr(self, a) for a in SERIES_STATE}
+        state['files'] = [rowmap[f] for f in self.files]
+        if self.me:
+            state['echo_groups'] = [[rowmap[f] for f in g]
+                                    for g in self.echo_groups]
+            state['echoes'] = self.echoes
+        return state
+
+    @classmethod
+    def from_state(cls, filetable, state):
+        """Builds a series from get_state, taking filenames from the
+        rows of filetable"""
+        series = cls.__new__(cls)
+        for a in SERIES_STATE:
+            setattr(series, a, state[a])
+        filelist = filetable.filelist
+        series.files = [filelist[i] for i in state['files']]
+        series.me = 'echo_groups' in state
+        if series.me:
+            series.echo_groups = [[filelist[i] for i in g]
+                                  for g in state['echo_groups']]
+            series.echoes = state['echoes']
+        return series
+
 
     def __str__(self):
         """String representation of the dcmseries
@@ -352,34 +1965,210 @@ class dcmseries:
             e = 'ME'
         else:
             e = 'SE'
-        style = '{:3d}\t{:35s}\t{:15s}\t{:5d}\t{:2s}'
+        style = '{:>3s}\t{:35s}\t{:15s}\t{:5d}\t{:2s}'
         if self.alias:
-            return style.format(self.number, self.alias, self.start,
+            return style.format(self.key, self.alias, self.start,
                                 len(self.files), e)
         else:
-            return style.format(self.number, self.name, self.start,
+            return style.format(self.key, self.name, self.start,
                                 len(self.files), e)
 
     def ignore(self):
         """Makes this dicom series ignored in printing"""
-        self.alias = ''
-    def convert(self, outpath, overwrite=False):
-        """Converts this series"""
+        self.set_alias('')
+    def get_outname(self):
+        """Returns the name this series is converted to
+        Returns
+        -------
+        The alias or series name, with an echo placeholder if multi-echo.
+        Unaliased series which share their number with another are told
+        apart by their key.
+        """
         if self.alias:
             fname = self.alias
+        elif self.key != str(self.number):
+            fname = self.name + '_' + self.key.replace('.', '-')
         else:
             fname = self.name
         if self.me:
             fname += '_echo-%e'
+        return fname
+
+    def get_dirname(self):
+        """Returns the directory name this series is organised into: its
+        alias, or its key and name
+        """
+        if self.alias:
+            return safe_name(self.alias)
+        return safe_name(self.key.replace('.', '-') + '_' + self.name)
+
+    def get_problems(self):
+        """Returns the problems found by seriestable.validate, or None
+        if the series has not been checked"""
+        return self.problems
+
+    def get_args(self):
+        """Returns the dcm2niix arguments this series is converted with,
+        and the backend if it is not dcm2niix"""
+        args = ['-f', self.get_outname()] + DCM2NIIX_OPTIONS
+        if self.backend != 'dcm2niix':
+            args += ['--backend', self.backend]
+        return args
+
+    def set_backend(self, backend):
+        """Sets the converter this series is converted with
+
+        Parameters
+        ----------
+        backend : string
+            One of BACKENDS
+        """
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend ' + str(backend) +
+                             '; choose from ' + ', '.join(BACKENDS))
+        self.backend = backend
+
+    def get_backend(self):
+        """Returns the converter this series is converted with"""
+        return self.backend
+
+    def _numpy_convert(self, outpath, overwrite, paths):
+        """Converts this series with numpy, removing any echoes written
+        if a later one cannot be converted"""
+        fname = self.get_outname()
+        compress = self.backend == 'numpy-gz'
+        if not self.me:
+            return numpy_convert(self._inputs(self.files, paths), fname,
+                                 outpath, overwrite=overwrite,
+                                 compress=compress)
+        outputs = []
+        try:
             for i in range(len(self.echoes)):
-                dcm2niix(self.echo_groups[i], fname, outpath,
-                         overwrite=overwrite)
+                outputs += numpy_convert(self._inputs(self.echo_groups[i],
+                                                      paths),
+                                         fname.replace('%e', str(i + 1)),
+                                         outpath, overwrite=overwrite,
+                                         compress=compress)
+        except UnsupportedSeries:
+            for f in outputs:
+                os.remove(f)
+            raise
+        return outputs
+
+    def convert(self, outpath, overwrite=False):
+        """Converts this series, with dcm2niix if the numpy backend
+        cannot handle it
+
+        Returns
+        -------
+        A list of the files produced
+        """
+        with timing.stage('convert', files=len(self.files)):
+            # Archive members are extracted for the conversion only
+            with staged(self.files, outpath) as paths:
+                return self._convert(outpath, overwrite, paths)
+
+    def get_groups(self, paths=None):
+        """Returns the (files, output name, SeriesInstanceUID) of each
+        conversion dcm2niix runs for this series in a batch, see
+        dcm2niix_batch
+
+        Parameters
+        ----------
+        paths : dict
+            Staged archive members, see archive.staged
+
+        Raises
+        ------
+        ValueError for a multi-echo series, whose echoes are numbered by
+        dcm2niix and so are only converted on their own
+        """
+        if self.me:
+            raise ValueError('Multi-echo series ' + str(self.number) +
+                             ' cannot be converted in a batch')
+        return [(self._inputs(self.files, paths), self.get_outname(),
+                 self.uid)]
+
+    async def convert_async(self, outpath, overwrite=False):
+        """Converts this series like convert, without blocking an event
+        loop; cancelling it stops dcm2niix
+
+        The numpy backend and archive members are converted with convert
+        in a thread instead, which cannot be stopped once started.
+        """
+        if (self.backend != 'dcm2niix' or
+                any(is_member(f) for f in self.files)):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.convert, outpath,
+                                              overwrite)
+        fname = self.get_outname()
+        with timing.stage('convert', files=len(self.files)):
+            if not self.me:
+                return await dcm2niix_async(self.files, fname, outpath,
+                                            overwrite=overwrite)
+            existing = set(conversion_outputs(fname, outpath))
+            outputs = []
+            try:
+                for i in range(len(self.echoes)):
+                    outputs += await dcm2niix_async(
+                        self.echo_groups[i], fname, outpath,
+                        overwrite=overwrite, checkexisting=(i == 0))
+            except asyncio.CancelledError:
+                # dcm2niix_async only removes the echo it was converting;
+                # the echoes before it would stop a requeue too
+                for f in set(outputs) - existing:
+                    if op.exists(f):
+                        os.remove(f)
+                raise
+            return sorted(set(outputs))
+
+    def _inputs(self, files, paths):
+        """Returns the files to convert, staged where they are archive
+        members"""
+        if not paths:
+            return files
+        return [paths.get(f, f) for f in files]
+
+    def _convert(self, outpath, overwrite, paths):
+        if self.backend != 'dcm2niix':
+            try:
+                with timing.stage('numpy', files=len(self.files)):
+                    return self._numpy_convert(outpath, overwrite, paths)
+            except UnsupportedSeries:
+                pass
+        fname = self.get_outname()
+        if self.me:
+            outputs = []
+            for i in range(len(self.echoes)):
+                # Only the first echo may find existing files; later ones
+                # would find the echoes just converted
+                outputs += dcm2niix(self._inputs(self.echo_groups[i], paths),
+                                    fname, outpath, overwrite=overwrite,
+                                    checkexisting=(i == 0))
+            return sorted(set(outputs))
         else:
-            dcm2niix(self.files, fname, outpath, overwrite=overwrite)
+            return dcm2niix(self._inputs(self.files, paths), fname, outpath,
+                            overwrite=overwrite)
 
 
     def set_alias(self, alias):
+        """Sets the alias, dropping any undone aliases"""
+        self.past.append(self.alias)
+        self.future = []
         self.alias = alias
+    def can_step(self, forward):
+        """Returns whether there is an alias to redo (forward) or undo"""
+        if forward:
+            return len(self.future) > 0
+        return len(self.past) > 0
+    def step(self, forward):
+        """Redoes (forward) or undoes the latest alias change"""
+        if forward:
+            self.past.append(self.alias)
+            self.alias = self.future.pop()
+        else:
+            self.future.append(self.alias)
+            self.alias = self.past.pop()
     def get_number(self):
         """Returns the series number
         Returns
@@ -387,6 +2176,20 @@ class dcmseries:
         The series number
         """
         return self.number
+    def get_key(self):
+        """Returns the identifier of the series in its table: its number,
+        or its number and a counter if other series share the number
+        """
+        return self.key
+    def get_patient(self):
+        """Returns the PatientID, or '' if the files have none"""
+        return self.patient
+    def get_study(self):
+        """Returns the StudyInstanceUID, or '' if the files have none"""
+        return self.study
+    def get_uid(self):
+        """Returns the SeriesInstanceUID, or '' if the files have none"""
+        return self.uid
     def get_name(self):
         """Returns the series description/name as it is in the header
         Returns
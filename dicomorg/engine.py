@@ -0,0 +1,340 @@
+"""Converting series in the background while the shell stays usable
+
+A conversionengine runs an asyncio event loop in a thread of its own,
+with up to jobs conversions at a time. Series are queued in order, and
+can be cancelled, whether queued or running, or moved to the front of
+the queue while others convert. Each series is printed when it starts
+and finishes, with how long it took:
+
+    engine = conversionengine(jobs=4)
+    table.submit(engine, outpath)
+    engine.prioritise(table.SeriesList[3])
+    engine.close()    # waits for the rest
+
+A series is converted under the alias it has when its conversion
+starts, so aliases can still be edited while it is queued.
+"""
+
+import time
+import os.path as op
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Future
+
+from .colors import *
+from .manifest import conversionmanifest
+
+# What a conversion can be doing; the first three are still to finish
+JOB_STATES = ('queued', 'running', 'cancelling', 'done', 'failed',
+              'cancelled')
+
+
+def _identity(series):
+    """Returns what tells a series apart across copies of its table"""
+    return (series.get_patient(), series.get_study(), series.get_number(),
+            series.get_uid())
+
+
+class conversionjob:
+    """A series queued on a conversionengine
+
+    Attributes
+    ----------
+    series : dcmseries
+        The series
+    outpath : string
+        Where it is converted to
+    state : string
+        One of JOB_STATES
+    order : int
+        Its place in the queue; lower goes first
+    seconds : float
+        How long it has been converting, or took
+    outputs : list
+        The files produced, once done
+    error : Exception
+        Why it failed, if it did
+    """
+    def __init__(self, series, outpath, overwrite, record, signature,
+                 order):
+        self.series = series
+        self.outpath = outpath
+        self.overwrite = overwrite
+        self.record = record
+        self.signature = signature
+        self.state = 'queued'
+        self.order = order
+        self.started = None
+        self.args = None
+        self.seconds = 0.0
+        self.outputs = []
+        self.error = None
+        self.task = None
+
+    def get_seconds(self):
+        """Returns how long the series has been converting, or took"""
+        if self.state in ('running', 'cancelling'):
+            return time.perf_counter() - self.started
+        return self.seconds
+
+    def __str__(self):
+        line = '{}\t{:9s}'.format(str(self.series), self.state)
+        if self.state not in ('queued', 'cancelled'):
+            line += '\t{:.1f} s'.format(self.get_seconds())
+        return line
+
+
+class conversionengine:
+    """Converts series in the background, up to jobs at once
+
+    Attributes
+    ----------
+    jobs : int
+        The most conversions to run at once
+    history : list
+        Every conversionjob, in the order submitted
+    """
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs or 1)
+        self.history = []
+        # The latest job of each series, by _identity
+        self._latest = {}
+        # One manifest per output path, so that jobs finishing in any
+        # order all end up in it
+        self._manifests = {}
+        self._manifestlock = threading.Lock()
+        self._next = itertools.count()
+        self._front = itertools.count(-1, -1)
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,),
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [self.loop.create_task(self._worker())
+                         for _ in range(self.jobs)]
+        ready.set()
+        self.loop.run_forever()
+
+    def _call(self, function, *args):
+        """Runs a function in the loop's thread, returning its result,
+        so that jobs are only ever changed there"""
+        result = Future()
+
+        def call():
+            try:
+                result.set_result(function(*args))
+            except Exception as e:
+                result.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return result.result()
+
+    def _check_idle(self):
+        if not any(j.state in JOB_STATES[:3]
+                   for j in self._latest.values()):
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            order, job = await self._queue.get()
+            # Cancelled, replaced and reprioritised jobs leave stale
+            # entries behind
+            if job.state != 'queued' or job.order != order:
+                continue
+            job.state = 'running'
+            job.started = time.perf_counter()
+            # The name and options it converts with, for the manifest
+            job.args = job.series.get_args()
+            print(blue(str(job.series) + '\tstarted'))
+            job.task = self.loop.create_task(
+                job.series.convert_async(job.outpath, job.overwrite))
+            try:
+                job.outputs = await job.task
+                if job.record is not None:
+                    with self._manifestlock:
+                        job.record.record(job.series, job.args,
+                                          job.outputs, job.signature)
+                        job.record.save()
+            except asyncio.CancelledError:
+                if job.state != 'cancelling':
+                    raise
+                job.state = 'cancelled'
+                job.seconds = time.perf_counter() - job.started
+                print(yellow(str(job)))
+            except Exception as e:
+                # Anything else, including failing to save the manifest,
+                # would stop this worker for good
+                job.state = 'failed'
+                job.error = e
+                job.seconds = time.perf_counter() - job.started
+                print(red(str(job)))
+                print(red('    ' + str(e).strip().replace('\n', '\n    ')))
+            else:
+                job.state = 'done'
+                job.seconds = time.perf_counter() - job.started
+                print(green(str(job)))
+            finally:
+                job.task = None
+                self._check_idle()
+
+    def submit(self, series, outpath, overwrite=False, manifest=False,
+               signature=None):
+        """Queues a series to convert
+
+        Parameters
+        ----------
+        series : dcmseries
+            The series; a queued conversion of the same series is
+            replaced
+        outpath : string
+            Where to write the niftis
+        overwrite : bool
+            Whether to overwrite existing niftis
+        manifest : bool
+            Whether to record the conversion in the manifest of outpath,
+            see get_manifest
+        signature : list
+            The input signature of the series, for the manifest
+
+        Returns
+        -------
+        Whether the series was queued; it is not if it is converting
+        """
+        if self._closed:
+            raise ValueError('The conversion engine is closed')
+        record = self.get_manifest(outpath) if manifest else None
+        return self._call(self._submit, series, outpath, overwrite, record,
+                          signature)
+
+    def get_manifest(self, outpath):
+        """Returns the manifest of an output path, which every series
+        converted there is recorded in as it finishes
+
+        Check whether series are already converted against it rather
+        than the manifest on disk, which may not have every job yet.
+        """
+        outpath = op.abspath(outpath)
+        with self._manifestlock:
+            if outpath not in self._manifests:
+                self._manifests[outpath] = conversionmanifest(outpath)
+            return self._manifests[outpath]
+
+    def _submit(self, series, outpath, overwrite, record, signature):
+        key = _identity(series)
+        old = self._latest.get(key)
+        if old is not None and old.state in ('running', 'cancelling'):
+            print(red(str(series) + '\tis already converting'))
+            return False
+        if old is not None and old.state == 'queued':
+            old.state = 'cancelled'
+        job = conversionjob(series, outpath, overwrite, record, signature,
+                            next(self._next))
+        self._latest[key] = job
+        self.history.append(job)
+        self._idle.clear()
+        self._queue.put_nowait((job.order, job))
+        return True
+
+    def cancel(self, series=None):
+        """Cancels the conversion of a series, or of every series
+
+        A running dcm2niix is killed and its partial outputs removed.
+
+        Returns
+        -------
+        The number of conversions cancelled
+        """
+        return self._call(self._cancel, series)
+
+    def _cancel(self, series):
+        if series is None:
+            jobs = list(self._latest.values())
+        else:
+            jobs = [self._latest.get(_identity(series))]
+        cancelled = 0
+        for job in jobs:
+            if job is None:
+                continue
+            if job.state == 'queued':
+                job.state = 'cancelled'
+                print(yellow(str(job)))
+                cancelled += 1
+            elif job.state == 'running':
+                job.state = 'cancelling'
+                job.task.cancel()
+                cancelled += 1
+        self._check_idle()
+        return cancelled
+
+    def prioritise(self, series):
+        """Moves a queued series to the front of the queue
+
+        Returns
+        -------
+        Whether the series was queued
+        """
+        return self._call(self._prioritise, series)
+
+    def _prioritise(self, series):
+        job = self._latest.get(_identity(series))
+        if job is None or job.state != 'queued':
+            return False
+        job.order = next(self._front)
+        self._queue.put_nowait((job.order, job))
+        return True
+
+    def get_jobs(self):
+        """Returns the latest job of each series: running ones first,
+        then queued ones in the order they will run, then the rest"""
+        def order(job):
+            rank = {'running': 0, 'cancelling': 0, 'queued': 1}
+            return rank.get(job.state, 2), job.order
+        return self._call(lambda: sorted(self._latest.values(), key=order))
+
+    def busy(self):
+        """Returns the number of series queued or converting"""
+        return self._call(lambda: sum(j.state in JOB_STATES[:3]
+                                      for j in self._latest.values()))
+
+    def wait(self, timeout=None):
+        """Waits for every queued series to finish
+
+        Returns
+        -------
+        Whether they all have
+        """
+        return self._idle.wait(timeout)
+
+    def close(self, cancel=False):
+        """Stops the engine once every series has finished
+
+        Parameters
+        ----------
+        cancel : bool
+            Whether to cancel the series still queued or converting
+            instead of waiting for them
+        """
+        if self._closed:
+            return
+        if cancel:
+            self.cancel()
+        self.wait()
+        self._closed = True
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
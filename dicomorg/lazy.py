@@ -0,0 +1,55 @@
+"""Importing heavy dependencies only when they are first used
+
+pydicom and numpy take most of the time dicomorg needs to start, while
+a session resumed from a snapshot, or a command printing its help,
+never touches them. A lazy module is imported on its first attribute
+access, so the modules using it keep the usual pydicom.dcmread style.
+"""
+
+import sys
+import importlib
+import importlib.util
+
+
+class lazymodule:
+    """Stands in for a module until one of its attributes is used
+
+    Importing goes through the import lock, so threads reading headers
+    may all touch the module first. Each attribute is looked up once and
+    then kept, so later uses cost no more than a module's.
+    """
+    def __init__(self, name):
+        self._lazyname = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._lazyname)
+        value = getattr(module, attribute)
+        setattr(self, attribute, value)
+        return value
+
+    def __repr__(self):
+        return '<lazy module ' + repr(self._lazyname) + '>'
+
+
+def lazy_import(name):
+    """Returns a module which is only imported when first used
+
+    Parameters
+    ----------
+    name : string
+        The module to import, e.g. 'pydicom'
+
+    Returns
+    -------
+    The module if it is already imported, a lazymodule standing in for
+    it, or None if it is not installed
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None:
+        return None
+    return lazymodule(name)
@@ -0,0 +1,151 @@
+"""A record of converted series, so unchanged series can be skipped"""
+
+import os
+import os.path as op
+import json
+import hashlib
+
+from .archive import stat_file
+from .convert import output_pattern
+
+MANIFESTNAME = '.dicomorg_manifest.json'
+MANIFESTVERSION = 1
+
+
+def input_signature(files):
+    """Returns a digest of a set of input files' paths, sizes and mtimes
+
+    Parameters
+    ----------
+    files : list
+        The input filenames
+
+    Returns
+    -------
+    A hex digest which changes whenever a file is added, removed or
+    modified
+    """
+    digest = hashlib.sha1()
+    for f in sorted(files):
+        try:
+            # Archive members change with their archive
+            stat = stat_file(f)
+            digest.update('{}\t{}\t{}\n'.format(f, stat.st_size,
+                                                stat.st_mtime_ns).encode())
+        except OSError:
+            digest.update('{}\tmissing\n'.format(f).encode())
+    return digest.hexdigest()
+
+
+class conversionmanifest:
+    """The conversions made into an output directory
+
+    Attributes
+    ----------
+    manifestfile : string
+        The file the manifest is stored in
+    entries : dict
+        A dict where each series key (see dcmseries.get_key) hashes to a
+        dict with the output name, the input signature and file count,
+        the dcm2niix arguments and the files produced
+    """
+    def __init__(self, outpath):
+        self.outpath = op.abspath(outpath)
+        self.manifestfile = op.join(self.outpath, MANIFESTNAME)
+        self.entries = {}
+        try:
+            with open(self.manifestfile) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return
+        if contents.get('version') == MANIFESTVERSION:
+            self.entries = contents['entries']
+
+    def save(self):
+        """Writes the manifest to disk"""
+        os.makedirs(self.outpath, exist_ok=True)
+        tempname = self.manifestfile + '.tmp'
+        with open(tempname, 'w') as f:
+            json.dump({'version': MANIFESTVERSION, 'entries': self.entries},
+                      f, indent=1, sort_keys=True)
+        os.replace(tempname, self.manifestfile)
+
+    def is_current(self, series, args, signature=None):
+        """Returns whether a series is already converted from its current
+        inputs, under its current name and arguments
+
+        Parameters
+        ----------
+        series : dcmseries
+            The series to check
+        args : list
+            The dcm2niix arguments the series would be converted with
+        signature : string
+            The input signature, if already computed
+        """
+        entry = self.entries.get(series.get_key())
+        if not entry:
+            return False
+        if (entry['name'] != series.get_outname() or
+                entry['args'] != args or
+                entry['nfiles'] != len(series.get_files())):
+            return False
+        for f in entry['outputs']:
+            if not op.exists(op.join(self.outpath, f)):
+                return False
+        if signature is None:
+            signature = input_signature(series.get_files())
+        return entry['inputs'] == signature
+
+    def replaces(self, series):
+        """Returns whether converting a series would replace outputs it
+        was converted to before under the same name, e.g. since files were
+        added to it"""
+        entry = self.entries.get(series.get_key())
+        return bool(entry) and entry['name'] == series.get_outname()
+
+    def discard(self, series):
+        """Removes the outputs recorded for a series and forgets it
+
+        Only files named as the series' outputs are removed, since older
+        manifests may have recorded files of series sharing a prefix.
+
+        Returns
+        -------
+        The files removed
+        """
+        entry = self.entries.pop(series.get_key(), None)
+        if not entry:
+            return []
+        pattern = output_pattern(entry['name'])
+        removed = []
+        for f in entry['outputs']:
+            fname = op.join(self.outpath, f)
+            if pattern.match(op.basename(fname)) and op.exists(fname):
+                os.remove(fname)
+                removed.append(fname)
+        return removed
+
+    def record(self, series, args, outputs, signature=None):
+        """Records a successful conversion
+
+        Parameters
+        ----------
+        series : dcmseries
+            The series converted
+        args : list
+            The dcm2niix arguments it was converted with
+        outputs : list
+            The files produced
+        signature : string
+            The input signature, if already computed
+        """
+        if signature is None:
+            signature = input_signature(series.get_files())
+        self.entries[series.get_key()] = {
+            'name': series.get_outname(),
+            'inputs': signature,
+            'nfiles': len(series.get_files()),
+            'args': args,
+            'outputs': sorted(op.relpath(f, self.outpath) for f in outputs),
+        }
@@ -0,0 +1,312 @@
+"""An in-process dicom to nifti converter for simple, uncompressed series
+
+This handles the common case of single-frame, uncompressed 2D slices
+which stack into a 3D or 4D volume. Anything else raises
+UnsupportedSeries, so that callers can fall back to dcm2niix.
+"""
+
+import os
+import os.path as op
+import json
+import gzip
+import math
+import struct
+
+from .lazy import lazy_import
+
+pydicom = lazy_import('pydicom')
+np = lazy_import('numpy')
+
+# Transfer syntaxes whose pixel data can be mapped straight from disk
+UNCOMPRESSED = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1')
+IMPLICIT_VR = '1.2.840.10008.1.2'
+PIXELDATA_TAG = b'\xe0\x7f\x10\x00'
+
+# (BitsAllocated, PixelRepresentation) to numpy type and nifti datatype
+DATATYPES = {(8, 0): ('<u1', 2), (8, 1): ('<i1', 256),
+             (16, 0): ('<u2', 512), (16, 1): ('<i2', 4),
+             (32, 0): ('<u4', 768), (32, 1): ('<i4', 8)}
+
+NIFTI_HEADER = '<i10s18sihcb8h3f4h8f3fhbb4f2i80s24s2h6f4f4f4f16s4s'
+NIFTI_UNITS = 2 | 8  # millimetres and seconds
+
+# Header attributes copied to the sidecar, with a scale to BIDS units
+SIDECAR_FIELDS = [('Modality', None), ('MagneticFieldStrength', None),
+                  ('Manufacturer', None), ('ManufacturerModelName', None),
+                  ('SeriesDescription', None), ('ProtocolName', None),
+                  ('ImageType', None), ('SeriesNumber', None),
+                  ('AcquisitionTime', None), ('SliceThickness', None),
+                  ('SpacingBetweenSlices', None), ('EchoTime', 0.001),
+                  ('RepetitionTime', 0.001), ('InversionTime', 0.001),
+                  ('FlipAngle', None)]
+
+
+class UnsupportedSeries(Exception):
+    pass
+
+
+def _plain(value, scale=None):
+    """Converts a header value to something json can write"""
+    if isinstance(value, pydicom.multival.MultiValue):
+        return [_plain(v, scale) for v in value]
+    if isinstance(value, (int, float)):
+        value = float(value) if scale or isinstance(value, float) \
+            else int(value)
+        return value * scale if scale else value
+    return str(value)
+
+
+def _read_slice(fname):
+    """Reads the header of a slice and where its pixel data starts"""
+    with open(fname, 'rb') as f:
+        header = pydicom.dcmread(f, stop_before_pixels=True)
+        start = f.tell()
+        element = f.read(12)
+    try:
+        syntax = header.file_meta.TransferSyntaxUID
+    except AttributeError:
+        raise UnsupportedSeries(fname + ' has no transfer syntax')
+    if syntax not in UNCOMPRESSED:
+        raise UnsupportedSeries(fname + ' is compressed')
+    if element[:4] != PIXELDATA_TAG:
+        raise UnsupportedSeries(fname + ' has no pixel data')
+    if syntax == IMPLICIT_VR:
+        length = struct.unpack('<I', element[4:8])[0]
+        offset = start + 8
+    else:
+        length = struct.unpack('<I', element[8:12])[0]
+        offset = start + 12
+    return header, offset, length
+
+
+def _check(headers, attribute):
+    """Returns an attribute which must be the same in every slice"""
+    try:
+        values = [tuple(h.get(attribute)) if isinstance(
+            h.get(attribute), pydicom.multival.MultiValue)
+            else h.get(attribute) for h in headers]
+    except TypeError:
+        raise UnsupportedSeries(attribute + ' is malformed')
+    if values[0] is None or any(v != values[0] for v in values):
+        raise UnsupportedSeries(attribute + ' is missing or varies')
+    return values[0]
+
+
+def _quaternion(rotation):
+    """Returns the nifti quaternion (b, c, d) and qfac of a rotation"""
+    r = rotation.copy()
+    qfac = 1.0
+    if np.linalg.det(r) < 0:
+        r[:, 2] = -r[:, 2]
+        qfac = -1.0
+    a = r[0, 0] + r[1, 1] + r[2, 2] + 1
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r[2, 1] - r[1, 2]) / a
+        c = 0.25 * (r[0, 2] - r[2, 0]) / a
+        d = 0.25 * (r[1, 0] - r[0, 1]) / a
+    else:
+        xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+        yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+        zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r[0, 1] + r[1, 0]) / b
+            d = 0.25 * (r[0, 2] + r[2, 0]) / b
+            a = 0.25 * (r[2, 1] - r[1, 2]) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r[0, 1] + r[1, 0]) / c
+            d = 0.25 * (r[1, 2] + r[2, 1]) / c
+            a = 0.25 * (r[0, 2] - r[2, 0]) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r[0, 2] + r[2, 0]) / d
+            c = 0.25 * (r[1, 2] + r[2, 1]) / d
+            a = 0.25 * (r[1, 0] - r[0, 1]) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return (b, c, d), qfac
+
+
+def nifti_header(shape, datatype, bitpix, affine, zooms, tr=0.0,
+                 slope=1.0, inter=0.0, description=''):
+    """Packs a single-file NIfTI-1 header and empty extension block
+
+    Parameters
+    ----------
+    shape : tuple
+        The 3 or 4 data dimensions
+    datatype, bitpix : int
+        The NIfTI datatype code and its bits per voxel
+    affine : array
+        The 4 x 4 voxel to RAS+ millimetre transform
+    zooms : tuple
+        The voxel sizes in millimetres
+    tr : float
+        The repetition time in seconds, for 4D data
+    slope, inter : float
+        The intensity scaling
+    description : string
+        A short description
+
+    Returns
+    -------
+    The 352 bytes which precede the data
+    """
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    (b, c, d), qfac = _quaternion(affine[:3, :3] / np.array(zooms))
+    pixdim = [qfac] + list(zooms) + [tr, 0.0, 0.0, 0.0]
+    header = struct.pack(
+        NIFTI_HEADER, 348, b'', b'', 0, 0, b'r', 0, *dim, 0.0, 0.0, 0.0,
+        0, datatype, bitpix, 0, *pixdim, 352.0, slope, inter, 0, 0,
+        NIFTI_UNITS, 0.0, 0.0, 0.0, 0.0, 0, 0,
+        description.encode('ascii', 'replace')[:79], b'', 1, 1, b, c, d,
+        *affine[:3, 3], *affine[0], *affine[1], *affine[2], b'', b'n+1\0')
+    return header + b'\0\0\0\0'
+
+
+def _stack(files):
+    """Reads slices into a (volumes, slices, rows, columns) array
+
+    Returns the array, the voxel to RAS+ affine, the voxel sizes, the
+    repetition time in seconds, the nifti datatype and bits per voxel,
+    the intensity scaling and the first header
+    """
+    slices = [_read_slice(f) for f in files]
+    headers = [s[0] for s in slices]
+    if _check(headers, 'SamplesPerPixel') != 1:
+        raise UnsupportedSeries('only single-channel images are supported')
+    if 'MOSAIC' in [str(t).upper() for t in headers[0].get('ImageType', [])]:
+        raise UnsupportedSeries('mosaics are not supported')
+    if headers[0].get('NumberOfFrames', 1) not in (None, '', 1, '1'):
+        raise UnsupportedSeries('multi-frame images are not supported')
+    rows = _check(headers, 'Rows')
+    columns = _check(headers, 'Columns')
+    bits = _check(headers, 'BitsAllocated')
+    representation = _check(headers, 'PixelRepresentation')
+    orientation = np.array(_check(headers, 'ImageOrientationPatient'),
+                           dtype=float)
+    spacing = np.array(_check(headers, 'PixelSpacing'), dtype=float)
+    slope = float(_check(headers, 'RescaleSlope')) \
+        if 'RescaleSlope' in headers[0] else 1.0
+    inter = float(_check(headers, 'RescaleIntercept')) \
+        if 'RescaleIntercept' in headers[0] else 0.0
+    try:
+        dtype, datatype = DATATYPES[(bits, representation)]
+    except KeyError:
+        raise UnsupportedSeries('unsupported pixel type')
+    nbytes = rows * columns * np.dtype(dtype).itemsize
+    if any(s[2] < nbytes for s in slices):
+        raise UnsupportedSeries('pixel data is shorter than the image')
+
+    # Order slices along the normal, then volumes by acquisition
+    rowcos, colcos = orientation[:3], orientation[3:]
+    normal = np.cross(rowcos, colcos)
+    try:
+        positions = [np.array(h.ImagePositionPatient, dtype=float)
+                     for h in headers]
+    except AttributeError:
+        raise UnsupportedSeries('ImagePositionPatient is missing')
+    distances = [round(float(np.dot(p, normal)), 3) for p in positions]
+    order = sorted(range(len(files)), key=lambda i: (
+        distances[i], int(headers[i].get('AcquisitionNumber') or 0),
+        int(headers[i].get('InstanceNumber') or 0)))
+    unique = sorted(set(distances))
+    nslices = len(unique)
+    nvolumes = len(files) // nslices
+    if nslices * nvolumes != len(files) or any(
+            distances.count(d) != nvolumes for d in unique):
+        raise UnsupportedSeries('slices do not form complete volumes')
+
+    data = np.empty((nvolumes, nslices, rows, columns), dtype=dtype)
+    for n, i in enumerate(order):
+        pixels = np.memmap(files[i], dtype=dtype, mode='r',
+                           offset=slices[i][1], shape=(rows, columns))
+        data[n % nvolumes, n // nvolumes] = pixels
+        del pixels
+
+    # Columns of the affine: along a row, down a column and across slices
+    first = positions[order[0]]
+    if nslices > 1:
+        step = (positions[order[-1]] - first) / (nslices - 1)
+    else:
+        thickness = float(headers[0].get('SliceThickness') or 1.0)
+        step = normal * thickness
+    affine = np.eye(4)
+    affine[:3, 0] = rowcos * spacing[1]
+    affine[:3, 1] = colcos * spacing[0]
+    affine[:3, 2] = step
+    affine[:3, 3] = first
+    # Dicom is LPS+, nifti is RAS+
+    affine[:2] *= -1
+    zooms = (float(spacing[1]), float(spacing[0]),
+             float(np.linalg.norm(step)))
+    tr = float(headers[0].get('RepetitionTime') or 0) / 1000
+    return (data, affine, zooms, tr, datatype, np.dtype(dtype).itemsize * 8,
+            slope, inter, headers[0])
+
+
+def sidecar(header):
+    """Returns a BIDS-style sidecar dict for a series' first header"""
+    fields = {}
+    for attribute, scale in SIDECAR_FIELDS:
+        value = header.get(attribute)
+        if value is not None and value != '':
+            fields[attribute] = _plain(value, scale)
+    fields['ConversionSoftware'] = 'dicomorg'
+    return fields
+
+
+def numpy_convert(files, fname, path, overwrite=False, compress=False):
+    """Converts one volume's files to nifti without dcm2niix
+
+    Parameters
+    ----------
+    files : list
+        The files of the volume (or time series)
+    fname : string
+        The output name, without extension
+    path : string
+        The output directory
+    overwrite : bool
+        Whether to overwrite existing files
+    compress : bool
+        Whether to gzip the nifti
+
+    Returns
+    -------
+    A list of the files produced
+
+    Raises
+    ------
+    UnsupportedSeries if the files cannot be converted here
+    ValueError if the output exists and overwrite is False
+    """
+    if np is None:
+        raise UnsupportedSeries('numpy is not installed')
+    niiname = op.join(path, fname + ('.nii.gz' if compress else '.nii'))
+    jsonname = op.join(path, fname + '.json')
+    for f in (niiname, jsonname):
+        if op.exists(f) and not overwrite:
+            raise ValueError('File ' + op.join(path, fname) +
+                             ' would be overwritten.')
+
+    (data, affine, zooms, tr, datatype, bitpix, slope, inter,
+     first) = _stack(files)
+    nvolumes, nslices, rows, columns = data.shape
+    shape = (columns, rows, nslices)
+    if nvolumes > 1:
+        shape += (nvolumes,)
+    header = nifti_header(shape, datatype, bitpix, affine, zooms, tr,
+                          slope, inter, str(first.get('SeriesDescription',
+                                                      '')))
+    os.makedirs(path, exist_ok=True)
+    # (volumes, slices, rows, columns) in C order is nifti's order
+    opener = gzip.open if compress else open
+    with opener(niiname, 'wb') as f:
+        f.write(header)
+        f.write(data.tobytes())
+    with open(jsonname, 'w') as f:
+        json.dump(sidecar(first), f, indent=1)
+    return [niiname, jsonname]
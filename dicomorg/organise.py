@@ -0,0 +1,252 @@
+"""Laying out dicoms on disk in a Patient/Study/Series tree
+
+Files are placed with hardlinks or reflinks where the filesystem allows,
+so that no bytes are copied, and copied otherwise; archive members are
+extracted, a batch at a time per archive. Placements run a
+batch at a time on a pool of threads, and each finished batch is
+appended to a journal in the output directory, so an interrupted run
+picks up where it stopped.
+"""
+
+import os
+import os.path as op
+import re
+import errno
+import shutil
+import filecmp
+from concurrent.futures import ThreadPoolExecutor
+
+from . import timing
+from .archive import is_member, extract_members
+
+JOURNALNAME = '.dicomorg_organise.tsv'
+
+# How files may be placed; auto hardlinks, reflinks or copies, whichever
+# works first
+ORGANISE_MODES = ('auto', 'hardlink', 'reflink', 'copy')
+
+# How a file can end up placed
+PLACEMENTS = ('hardlink', 'reflink', 'copy', 'extract', 'existing')
+
+# The ioctl which clones a file's extents on Linux filesystems with
+# reflinks, such as btrfs and xfs
+FICLONE = 0x40049409
+
+# Errors meaning a link cannot be made here, rather than that it failed
+NOLINK = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK,
+          errno.ENOTTY, errno.EINVAL)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def safe_name(value, default='unknown'):
+    """Returns a value as a name usable as a single directory"""
+    name = re.sub(r'[^\w.+-]+', '_', str(value or '')).strip('._')
+    return name or default
+
+
+def reflink(src, dst):
+    """Makes dst share src's data without copying it
+
+    Raises
+    ------
+    OSError if the filesystem or platform cannot
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported', dst)
+    with open(src, 'rb') as s, open(dst, 'xb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def _same(src, dst):
+    """Returns whether dst already holds src, linked or copied
+
+    A link is the same file; a copy or reflink must have the same bytes,
+    since slices of one series are often all the same size.
+    """
+    try:
+        if op.samefile(src, dst):
+            return True
+        return filecmp.cmp(src, dst, shallow=False)
+    except OSError:
+        return False
+
+
+def place(src, dst, mode='auto'):
+    """Places a file, without copying its bytes where possible
+
+    Parameters
+    ----------
+    src : string
+        The file to place
+    dst : string
+        Where to place it; its directory must exist
+    mode : string
+        One of ORGANISE_MODES
+
+    Returns
+    -------
+    How the file was placed: 'hardlink', 'reflink', 'copy' or 'existing'
+    if dst already held it
+
+    Raises
+    ------
+    FileExistsError if dst holds a different file
+    """
+    if op.lexists(dst):
+        if _same(src, dst):
+            return 'existing'
+        raise FileExistsError(errno.EEXIST, 'A different file is in the '
+                              'way', dst)
+    if mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if mode == 'hardlink' or e.errno not in NOLINK:
+                raise
+    if mode in ('auto', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if mode == 'reflink' or e.errno not in NOLINK:
+                raise
+    # Copy under a temporary name, so that dst is only ever complete
+    tempname = op.join(op.dirname(dst), '.tmp.' + op.basename(dst))
+    try:
+        shutil.copyfile(src, tempname)
+        shutil.copystat(src, tempname)
+        os.replace(tempname, dst)
+    except BaseException:
+        if op.exists(tempname):
+            os.remove(tempname)
+        raise
+    return 'copy'
+
+
+def read_journal(outpath):
+    """Returns the set of destinations, relative to outpath, which an
+    earlier run finished"""
+    done = set()
+    try:
+        with open(op.join(outpath, JOURNALNAME)) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # A line cut short by a crash is simply redone
+                if len(fields) >= 3 and fields[-1] in PLACEMENTS:
+                    done.add(fields[-2])
+    except OSError:
+        pass
+    return done
+
+
+def plan_series(series):
+    """Returns where each file of each series goes
+
+    Parameters
+    ----------
+    series : list
+        The dcmseries to lay out
+
+    Returns
+    -------
+    A list of (source, destination) pairs with destinations relative to
+    the root of the tree, as Patient/Study/Series/filename. Files which
+    share a name within a series are numbered, so the plan is the same
+    on every run.
+    """
+    pairs = []
+    for s in series:
+        directory = op.join(safe_name(s.get_patient()),
+                            safe_name(s.get_study()), s.get_dirname())
+        names = set()
+        for f in sorted(s.get_files()):
+            name = safe_name(op.basename(f), 'file')
+            stem, n = name, 1
+            while name in names:
+                n += 1
+                name = '{}_{}'.format(stem, n)
+            names.add(name)
+            pairs.append((f, op.join(directory, name)))
+    return pairs
+
+
+def organise(pairs, outpath, mode='auto', jobs=8, batch=1000,
+             progress=None):
+    """Places files in a tree as a resumable job
+
+    Parameters
+    ----------
+    pairs : list
+        (source, destination) pairs as returned by plan_series
+    outpath : string
+        The root of the tree, which holds the journal
+    mode : string
+        One of ORGANISE_MODES
+    jobs : int
+        The number of files to place at once
+    batch : int
+        The number of files to place between journal writes
+    progress : callable
+        Called with the number of files done and the total after each
+        batch
+
+    Returns
+    -------
+    A dict of how many files were placed each way, with 'journal' for
+    those an earlier run had placed
+    """
+    if mode not in ORGANISE_MODES:
+        raise ValueError('Mode must be one of ' + ', '.join(ORGANISE_MODES))
+    outpath = op.abspath(outpath)
+    os.makedirs(outpath, exist_ok=True)
+    done = read_journal(outpath)
+    counts = dict.fromkeys(PLACEMENTS, 0)
+    counts['journal'] = 0
+    todo = []
+    for src, dst in pairs:
+        if dst in done:
+            counts['journal'] += 1
+        else:
+            todo.append((src, dst))
+    for d in sorted(set(op.dirname(dst) for src, dst in todo)):
+        os.makedirs(op.join(outpath, d), exist_ok=True)
+
+    def _place(pair):
+        src, dst = pair[0], op.join(outpath, pair[1])
+        if is_member(src):
+            # Extracted whole or not at all, so one there is complete
+            return 'existing' if op.lexists(dst) else None
+        return place(src, dst, mode)
+
+    finished = counts['journal']
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool, \
+            open(op.join(outpath, JOURNALNAME), 'a') as journal:
+        for start in range(0, len(todo), batch):
+            chunk = todo[start:start + batch]
+            with timing.stage('organise', files=len(chunk)):
+                methods = list(pool.map(_place, chunk))
+                members = [(src, op.join(outpath, dst))
+                           for (src, dst), m in zip(chunk, methods)
+                           if m is None]
+                if members:
+                    extract_members(members)
+            methods = [m or 'extract' for m in methods]
+            for (src, dst), method in zip(chunk, methods):
+                counts[method] += 1
+                journal.write('{}\t{}\t{}\n'.format(src, dst, method))
+            journal.flush()
+            os.fsync(journal.fileno())
+            finished += len(chunk)
+            if progress:
+                progress(finished, len(pairs))
+    return counts
@@ -0,0 +1,366 @@
+"""Converting series while their directory is still being read"""
+
+import os
+import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .dcmutil import (dcmtable, dcmtable_light, seriestable, dcmseries,
+                      LIGHT_TAGS, HIERARCHY_TAGS, _convert_one)
+from .manifest import conversionmanifest
+from .archive import is_archive
+from .template import apply_template, template_aliases
+from .colors import *
+
+# Tags hinting how many files each echo of a series will have
+HINT_TAGS = ['ImagesInAcquisition', 'NumberOfTemporalPositions']
+
+
+def _value(table, fname, attribute):
+    """Returns an attribute of a file, or None if it does not have it"""
+    try:
+        return table.get_value(fname, attribute)
+    except (AttributeError, KeyError):
+        return None
+
+
+def series_key(table, fname):
+    """Returns the series a file belongs to
+
+    Returns
+    -------
+    A (SeriesNumber, PatientID, StudyInstanceUID, SeriesInstanceUID)
+    tuple, with '' for identifiers the file does not have
+    """
+    ids = [table.optional_values(a, [fname])[0] for a in HIERARCHY_TAGS]
+    return (int(table.get_value(fname, 'SeriesNumber')),) + tuple(
+        str(v) if v is not None else '' for v in ids)
+
+
+def expected_files(table, fname):
+    """Returns how many files each echo of a file's series should have
+
+    Parameters
+    ----------
+    table : dcmtable
+        The table the file is in
+    fname : string
+        The file
+
+    Returns
+    -------
+    ImagesInAcquisition times NumberOfTemporalPositions, or None if the
+    header does not say
+    """
+    images = _value(table, fname, 'ImagesInAcquisition')
+    if not images:
+        return None
+    positions = _value(table, fname, 'NumberOfTemporalPositions') or 1
+    return int(images) * int(positions)
+
+
+class streamconverter:
+    """Converts series as soon as all their files have been read
+
+    Pass an instance as the callback of a dcmtable. A series is sent to
+    conversion once every echo has as many files as its header hints
+    say and a batch of files has been read without any for it, since
+    the hints do not say how many echoes to expect. A series is also
+    sent once no file has arrived for it for a quiet period. Series
+    which gain files after being sent are converted again by finish.
+
+    Attributes
+    ----------
+    series : dict
+        A dict where each series key (see series_key) hashes to a dict
+        of its files by EchoTime
+    dispatched : dict
+        A dict where each series key hashes to the number of files it
+        was sent with, its dcmseries and its conversion future (None if
+        it was not converted)
+    reported : dict
+        A dict where each series key hashes to the number of files it
+        was reported with by collect
+    """
+    def __init__(self, outpath, jobs=1, quiet=None, aliases=None,
+                 force=False, manifest=True, backend='dcm2niix'):
+        """Constructor for streamconverter
+        Parameters
+        ----------
+        outpath : string
+            Where to write the niftis
+        jobs : int
+            The number of conversions to run at once
+        quiet : float
+            Seconds without new files after which a series is converted
+            even if its hints say it is incomplete; None waits for the
+            end of the scan
+        aliases : dict
+            Series keys (see dcmseries.get_key) hashing to their aliases,
+            or to '' if they should be ignored; see template_aliases
+        force : bool
+            Whether to overwrite existing niftis, converting series the
+            manifest says are already converted too
+        manifest : bool
+            Whether to skip series already converted, and record
+            conversions, as seriestable.convert does
+        backend : string
+            The converter to use; one of BACKENDS
+        """
+        self.outpath = outpath
+        self.quiet = quiet
+        self.aliases = aliases or {}
+        self.force = force
+        self.backend = backend
+        self.record = conversionmanifest(outpath) if manifest else None
+        self.pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.series = {}
+        self.expected = {}
+        self.lastseen = {}
+        self.dispatched = {}
+        self.reported = {}
+
+    def __call__(self, table, files):
+        now = time.monotonic()
+        touched = set()
+        for f in files:
+            key = series_key(table, f)
+            echo = table.get_value(f, 'EchoTime')
+            groups = self.series.setdefault(key, {})
+            groups.setdefault(echo, []).append(f)
+            self.lastseen[key] = now
+            if self.expected.get(key) is None:
+                self.expected[key] = expected_files(table, f)
+            touched.add(key)
+        for key in sorted(self.series):
+            if key in touched:
+                continue
+            if self._complete(key):
+                self._dispatch(table, key)
+            elif (self.quiet is not None and
+                    now - self.lastseen[key] >= self.quiet):
+                self._dispatch(table, key)
+
+    def remove(self, table, files):
+        """Forgets files which have been deleted, so that their series
+        are converted again without them
+
+        Parameters
+        ----------
+        table : dcmtable
+            The table the files are still in
+        files : list
+            The deleted files
+        """
+        for f in files:
+            key = series_key(table, f)
+            echo = table.get_value(f, 'EchoTime')
+            groups = self.series.get(key, {})
+            if f in groups.get(echo, ()):
+                groups[echo].remove(f)
+                if not groups[echo]:
+                    del groups[echo]
+            self.lastseen[key] = time.monotonic()
+        for key in [k for k, g in self.series.items() if not g]:
+            del self.series[key]
+            self.dispatched.pop(key, None)
+            self.reported.pop(key, None)
+
+    def _complete(self, key):
+        expected = self.expected[key]
+        if not expected:
+            return False
+        return all(len(g) >= expected for g in self.series[key].values())
+
+    def _key(self, key):
+        """Returns the key of a series as seriestable gives it, among the
+        series seen so far"""
+        # Series from other studies may share the number
+        shared = sorted(k for k in self.series if k[0] == key[0])
+        if len(shared) == 1:
+            return str(key[0])
+        return str(key[0]) + '.' + str(shared.index(key) + 1)
+
+    def _retract(self, previous):
+        """Removes what a series was converted to under a key it no
+        longer has, and its manifest entry"""
+        s, future = previous[1:]
+        if future is None:
+            return
+        outputs, e = future.result()
+        for f in outputs:
+            if op.exists(f):
+                os.remove(f)
+        entry = self.record.entries.get(s.get_key()) if self.record else None
+        if entry and entry['name'] == s.get_outname():
+            del self.record.entries[s.get_key()]
+
+    def _dispatch(self, table, key):
+        """Sends a series to conversion, unless it was already sent with
+        the same files under the same key"""
+        groups = self.series[key]
+        nfiles = sum(len(g) for g in groups.values())
+        previous = self.dispatched.get(key)
+        # A series arriving later may share the number, renumbering this
+        # one, so its template alias and manifest entry would be wrong
+        name = self._key(key)
+        if previous and previous[0] == nfiles and \
+                previous[1].get_key() == name:
+            return
+        echoes = sorted(groups)
+        echo_groups = [list(groups[e]) for e in echoes]
+        files = [f for g in echo_groups for f in g]
+        s = dcmseries(table, files, echo_groups=echo_groups, echoes=echoes)
+        s.set_backend(self.backend)
+        s.key = name
+        if previous and previous[1].get_key() != name:
+            if previous[2] is not None:
+                previous[2].result()
+            self._retract(previous)
+            self.reported.pop(key, None)
+        alias = self.aliases.get(s.get_key())
+        future = None
+        if alias == '':
+            s.ignore()
+        else:
+            if alias:
+                s.set_alias(alias)
+            # Files arrived after the series was sent, or since an
+            # earlier run converted it, so its earlier output is ours to
+            # replace
+            overwrite = self.force or bool(self.record and
+                                           self.record.replaces(s))
+            if previous:
+                overwrite = True
+                if previous[2] is not None:
+                    previous[2].result()
+            if not (self.record and not self.force and
+                    self.record.is_current(s, s.get_args())):
+                future = self.pool.submit(_convert_one, s, self.outpath,
+                                          overwrite)
+        self.dispatched[key] = (nfiles, s, future)
+
+    def collect(self, wait=False):
+        """Reports the conversions which have finished since the last
+        call, in series order, and records them in the manifest
+
+        Parameters
+        ----------
+        wait : bool
+            Whether to wait for every dispatched conversion
+
+        Returns
+        -------
+        converted : int
+            The number of series converted
+        skipped : int
+            The number of series skipped as already converted
+        failures : int
+            The number of series which failed or would have overwritten
+            files
+        """
+        converted = 0
+        skipped = 0
+        failures = 0
+        for key in sorted(self.dispatched):
+            nfiles, s, future = self.dispatched[key]
+            if self.reported.get(key) == nfiles:
+                continue
+            if s.is_ignorable():
+                self.reported[key] = nfiles
+                continue
+            if future is None:
+                print(cyan(str(s)))
+                skipped += 1
+                self.reported[key] = nfiles
+                continue
+            if not (wait or future.done()):
+                continue
+            outputs, e = future.result()
+            self.reported[key] = nfiles
+            if e is None:
+                print(green(str(s)))
+                converted += 1
+                if self.record:
+                    self.record.record(s, s.get_args(), outputs)
+            else:
+                print(red(str(s)))
+                print(red(str(e)))
+                failures += 1
+        if self.record and converted:
+            self.record.save()
+        return converted, skipped, failures
+
+    def finish(self, table):
+        """Converts every series not yet sent, waits for all conversions
+        and reports those not yet reported in series order
+
+        Parameters
+        ----------
+        table : dcmtable
+            The completely read table
+
+        Returns
+        -------
+        The converted, skipped and failed counts, as from collect
+        """
+        for key in sorted(self.series):
+            self._dispatch(table, key)
+        counts = self.collect(wait=True)
+        self.pool.shutdown()
+        return counts
+
+
+def stream_convert(path, outpath=None, jobs=1, quiet=None,
+                   instructions=None, force=False, manifest=True,
+                   light=False, backend='dcm2niix', tags=None,
+                   **tableargs):
+    """Reads a directory and converts its series, starting conversions
+    while the directory is still being read
+
+    Parameters
+    ----------
+    path : string
+        The directory to read dicoms from
+    outpath : string
+        Where to write the niftis; by default path
+    jobs, quiet, force, manifest, backend
+        See streamconverter
+    instructions : list
+        Template instructions to apply before converting, as returned
+        by read_template
+    light : bool
+        Whether to read a dcmtable_light rather than a dcmtable
+    tags : list
+        With light, tags to keep besides those the series need, e.g.
+        INDEXED_TAGS to export the table
+    tableargs
+        Passed on to the table
+
+    Returns
+    -------
+    table : seriestable
+        The series of the whole directory, with the template applied
+    counts : tuple
+        The converted, skipped and failed counts, as from finish
+    """
+    if not outpath:
+        outpath = op.abspath(path)
+        if is_archive(outpath):
+            outpath = op.dirname(outpath)
+    instructions = instructions or []
+    converter = streamconverter(outpath, jobs=jobs, quiet=quiet,
+                                aliases=template_aliases(instructions),
+                                force=force, manifest=manifest,
+                                backend=backend)
+    print(blue('Converting while reading...'))
+    if light:
+        tags = list(dict.fromkeys(LIGHT_TAGS + HINT_TAGS + list(tags or [])))
+        table = dcmtable_light(path, tags=tags, callback=converter,
+                               **tableargs)
+    else:
+        table = dcmtable(path, callback=converter, **tableargs)
+    counts = converter.finish(table)
+    thistable = apply_template(seriestable(table), instructions)
+    thistable.set_backend(backend)
+    return thistable, counts
@@ -0,0 +1,183 @@
+"""Cheap checks of which files in a directory are dicoms"""
+
+import os
+import zlib
+from fnmatch import fnmatch
+
+# Reasons a file is skipped without being parsed
+SKIP_DIRECTORY = 'directory'
+SKIP_SPECIAL = 'not a regular file'
+SKIP_SMALL = 'too small'
+SKIP_NOPREFIX = 'no DICM prefix'
+SKIP_UNREADABLE = 'unreadable'
+SKIP_EXCLUDED = 'excluded'
+# Reason a file is skipped after failing to parse
+SKIP_INVALID = 'invalid dicom'
+
+PREAMBLE_LENGTH = 128
+PREFIX = b'DICM'
+
+# How the files of a tree may be split into shards: each file by the hash
+# of its relative path, or each top-level entry by the hash of its name
+SHARD_MODES = ('hash', 'directory')
+
+# The little-endian groups a dicom without a preamble may start with:
+# file meta information (0002) or identifying information (0008)
+PREAMBLELESS_GROUPS = (b'\x02\x00', b'\x08\x00')
+
+
+def _matches(relpath, patterns):
+    """Returns whether a relative path or its basename matches any glob"""
+    name = relpath.rsplit('/', 1)[-1]
+    for pattern in patterns:
+        if fnmatch(relpath, pattern) or fnmatch(name, pattern):
+            return True
+    return False
+
+
+def shard_of(relpath, count):
+    """Returns which of count shards a relative path belongs to
+
+    The hash is the same on every host and python, so shards can be
+    indexed on different machines.
+    """
+    return zlib.crc32(relpath.encode('utf-8', 'surrogateescape')) % count
+
+
+def walk_files(path, maxdepth=0, include=None, exclude=None, ignore=(),
+               skipped=None, shard=None, shardby='hash'):
+    """Yields the regular files under a directory, streaming them
+
+    Each directory is listed with os.scandir and sorted on its own, so
+    the order is deterministic while only one directory listing per
+    level is held in memory.
+
+    Parameters
+    ----------
+    path : string
+        The directory to walk
+    maxdepth : int
+        How many levels of subdirectories to descend into; 0 only lists
+        path itself and None descends without limit
+    include : list
+        Globs of files to yield, matched against the path relative to
+        path or the filename; by default all files
+    exclude : list
+        Globs of files and directories to leave out, matched likewise
+    ignore : tuple
+        Prefixes of filenames to leave out silently, such as our own
+        sidecars
+    skipped : dict
+        If given, each reason an entry is left out hashes to the number
+        of entries left out for it
+    shard : tuple
+        If given, (index, count): only the files of that shard of count
+        are yielded, and files of other shards are left out silently
+    shardby : string
+        How files are assigned to shards, one of SHARD_MODES. By
+        directory, other shards' subdirectories are not walked at all.
+
+    Yields
+    ------
+    The absolute path of each file
+    """
+    if skipped is None:
+        skipped = {}
+    ignore = tuple(ignore)
+
+    def skip(reason):
+        skipped[reason] = skipped.get(reason, 0) + 1
+
+    def walk(dirpath, relpath, depth):
+        try:
+            with os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            skip(SKIP_UNREADABLE)
+            return
+        for entry in entries:
+            if entry.name.startswith(ignore):
+                continue
+            rel = relpath + entry.name
+            if (shard and shardby == 'directory' and depth == 0 and
+                    shard_of(rel, shard[1]) != shard[0]):
+                continue
+            if exclude and _matches(rel, exclude):
+                skip(SKIP_EXCLUDED)
+                continue
+            try:
+                isfile = entry.is_file()
+                isdir = not isfile and entry.is_dir()
+            except OSError:
+                skip(SKIP_UNREADABLE)
+                continue
+            if isfile:
+                if (shard and shardby == 'hash' and
+                        shard_of(rel, shard[1]) != shard[0]):
+                    continue
+                if include and not _matches(rel, include):
+                    skip(SKIP_EXCLUDED)
+                else:
+                    yield entry.path
+            elif isdir:
+                if maxdepth is None or depth < maxdepth:
+                    yield from walk(entry.path, rel + '/', depth + 1)
+                else:
+                    skip(SKIP_DIRECTORY)
+            else:
+                skip(SKIP_SPECIAL)
+
+    return walk(os.path.abspath(path), '', 0)
+
+
+def classify(fname, preambleless=False):
+    """Checks whether a file looks like a dicom without parsing it
+
+    Parameters
+    ----------
+    fname : string
+        The file to check
+    preambleless : bool
+        Whether to accept files without the 128-byte preamble and DICM
+        prefix, if they start with a dicom group. These must be read with
+        pydicom's force option.
+
+    Returns
+    -------
+    reason : string
+        Why the file is not a dicom, or None if it may be one
+    force : bool
+        Whether the file must be read with force
+    """
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read(PREAMBLE_LENGTH + len(PREFIX))
+    except IsADirectoryError:
+        return SKIP_DIRECTORY, False
+    except OSError:
+        return SKIP_UNREADABLE, False
+    return classify_start(data, preambleless)
+
+
+def classify_start(data, preambleless=False):
+    """Checks whether the start of a file looks like a dicom
+
+    Parameters
+    ----------
+    data : bytes
+        The file's contents, or at least its first 132 bytes
+    preambleless : bool
+        See classify
+
+    Returns
+    -------
+    See classify
+    """
+    data = data[:PREAMBLE_LENGTH + len(PREFIX)]
+    if data[PREAMBLE_LENGTH:] == PREFIX:
+        return None, False
+    if preambleless and data[:2] in PREAMBLELESS_GROUPS:
+        return None, True
+    if len(data) < PREAMBLE_LENGTH + len(PREFIX):
+        return SKIP_SMALL, False
+    return SKIP_NOPREFIX, False
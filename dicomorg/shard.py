@@ -0,0 +1,307 @@
+"""Reading a very large tree as independent shards and merging them
+
+The files of a tree are split into shards deterministically (see
+scan.shard_of), so each shard can be read by a different process or
+host into a partial index file, e.g. on a shared filesystem:
+
+    index_shard(path, 0, 8, 'part0.idx')    # on each of 8 nodes
+    table = merge_indices(glob('part*.idx'))
+
+The merged table is a dcmtable_light with the same files as reading
+the whole tree at once, in the order the tree is walked, and can itself
+be written as a complete index (a single shard of one) to load later.
+sharded_table does both steps with local processes.
+
+Indices are plain JSON, since a shared filesystem is written by many:
+reading one never runs code.
+"""
+
+import os
+import os.path as op
+import sys
+import json
+import base64
+import heapq
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .dcmutil import dcmtable_light, compact_value, LIGHT_TAGS
+from .scan import SHARD_MODES
+from . import timing
+
+INDEXVERSION = 2
+
+# What every index holds
+INDEXKEYS = ('version', 'path', 'shards', 'count', 'by', 'tags',
+             'preambleless', 'filelist', 'columns', 'skipped')
+
+
+def encode_value(value):
+    """Stores the bytes values JSON cannot, for json.dump's default"""
+    if isinstance(value, bytes):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError(repr(value) + ' cannot be stored as JSON')
+
+
+def decode_value(value):
+    """Reads the values encode_value stores, for json.load's
+    object_hook"""
+    if list(value) == ['bytes']:
+        return base64.b64decode(value['bytes'])
+    return value
+
+
+def compact_json(value):
+    """Returns a value read from JSON as compact_value returns it: lists
+    of multiple values as tuples, and strings interned"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(compact_json(v) for v in value)
+    return value
+
+
+def table_columns(table, tags=None):
+    """Returns the tags and columns of values of a table
+
+    Parameters
+    ----------
+    table : dcmtable
+        A dcmtable_light keeps its own tags; a dcmtable keeps tags, by
+        default LIGHT_TAGS, as compact_value returns them
+    tags : list
+        The tags to keep from a dcmtable
+
+    Returns
+    -------
+    (tags, columns) where columns hashes each tag to a list of values,
+    one per file
+    """
+    if isinstance(table, dcmtable_light):
+        tags = table.tags
+        return tags, {t: table.optional_values(t) for t in tags}
+    tags = LIGHT_TAGS if tags is None else tags
+    return tags, {t: [compact_value(v) for v in table.optional_values(t)]
+                  for t in tags}
+
+
+def write_index(table, fname, shards=None, count=1, shardby='hash'):
+    """Writes the columns of a table to a partial index file
+
+    Parameters
+    ----------
+    table : dcmtable
+        The table read from a shard; a dcmtable keeps LIGHT_TAGS
+    fname : string
+        The index file to write
+    shards : list
+        The shard indices the table holds; by default all of count
+    count : int
+        The number of shards the tree is split into
+    shardby : string
+        How the tree is split, one of SHARD_MODES
+    """
+    tags, columns = table_columns(table)
+    contents = {'version': INDEXVERSION, 'path': table.tablepath,
+                'shards': sorted(shards if shards is not None
+                                 else range(count)),
+                'count': count, 'by': shardby, 'tags': list(tags),
+                'preambleless': table.preambleless,
+                'filelist': table.filelist, 'columns': columns,
+                'skipped': table.skipped}
+    tempname = fname + '.tmp'
+    with open(tempname, 'w') as f:
+        json.dump(contents, f, default=encode_value, separators=(',', ':'))
+    os.replace(tempname, fname)
+
+
+def read_index(fname):
+    """Reads a partial index file
+
+    Raises
+    ------
+    ValueError if the file is not an index of this version
+    """
+    try:
+        with open(fname) as f:
+            contents = json.load(f, object_hook=decode_value)
+    except ValueError as e:
+        raise ValueError('Index ' + fname + ' is unreadable: ' + str(e))
+    if (not isinstance(contents, dict) or
+            contents.get('version') != INDEXVERSION or
+            not all(k in contents for k in INDEXKEYS)):
+        raise ValueError('Index ' + fname + ' is not a dicomorg index of '
+                         'version ' + str(INDEXVERSION))
+    try:
+        columns = {t: [compact_json(v) for v in contents['columns'][t]]
+                   for t in contents['tags']}
+    except (KeyError, TypeError) as e:
+        raise ValueError('Index ' + fname + ' is malformed: no column ' +
+                         str(e))
+    if any(len(c) != len(contents['filelist']) for c in columns.values()):
+        raise ValueError('Index ' + fname + ' is malformed: its columns '
+                         'and files differ in length')
+    contents['columns'] = columns
+    contents['tags'] = list(contents['tags'])
+    return contents
+
+
+def _order(path):
+    """Returns a sort key which puts filenames in walk_files order"""
+    def key(fname):
+        return op.relpath(fname, path).split(os.sep)
+    return key
+
+
+def _rows(part, key):
+    """Yields (sort key, filename, part, row) for each file of a part"""
+    for i, f in enumerate(part['filelist']):
+        yield key(f), f, part, i
+
+
+def merge_indices(fnames, headerentries=128, headerbytes=None):
+    """Merges partial index files into one table
+
+    Parameters
+    ----------
+    fnames : list
+        The index files; together they must hold every shard of one
+        tree exactly once
+    headerentries, headerbytes
+        See dcmtable_light
+
+    Returns
+    -------
+    A dcmtable_light of the whole tree, with files in the order the
+    tree is walked
+
+    Raises
+    ------
+    ValueError if the indices are of different trees, tags or splits,
+    or shards are missing or repeated
+    """
+    if not fnames:
+        raise ValueError('No indices to merge')
+    parts = [read_index(f) for f in fnames]
+    first = parts[0]
+    for fname, p in zip(fnames, parts):
+        for k in ('path', 'count', 'by', 'tags'):
+            if p[k] != first[k]:
+                raise ValueError('Index ' + fname + ' has a different ' + k +
+                                 ' from ' + fnames[0])
+    shards = sorted(i for p in parts for i in p['shards'])
+    if shards != list(range(first['count'])):
+        missing = sorted(set(range(first['count'])).difference(shards))
+        raise ValueError('Indices hold shards ' +
+                         ', '.join(str(i) for i in shards) +
+                         (' (missing ' + ', '.join(str(i) for i in missing)
+                          + ')' if missing else '') + ' of ' +
+                         str(first['count']))
+    tags = first['tags']
+    with timing.stage('merge', files=sum(len(p['filelist'])
+                                         for p in parts)):
+        # Each shard is already in walk order, so a k-way merge is enough
+        key = _order(first['path'])
+        rows = heapq.merge(*[_rows(p, key) for p in parts],
+                           key=lambda r: r[:2])
+        filelist = []
+        columns = {t: [] for t in tags}
+        lists = [(columns[t], t) for t in tags]
+        for _, f, p, i in rows:
+            filelist.append(f)
+            for values, t in lists:
+                values.append(p['columns'][t][i])
+        skipped = {}
+        for p in parts:
+            for reason, n in p['skipped'].items():
+                skipped[reason] = skipped.get(reason, 0) + n
+    table = dcmtable_light.from_columns(first['path'], filelist, columns,
+                                        preambleless=first['preambleless'],
+                                        headerentries=headerentries,
+                                        headerbytes=headerbytes)
+    table.skipped = skipped
+    return table
+
+
+def index_shard(path, index, count, fname, shardby='hash', tags=None,
+                **tableargs):
+    """Reads one shard of a tree and writes its partial index
+
+    Parameters
+    ----------
+    path : string
+        The root of the tree
+    index : int
+        Which shard to read, from 0 to count - 1
+    count : int
+        The number of shards
+    fname : string
+        The index file to write
+    shardby : string
+        How the tree is split, one of SHARD_MODES
+    tags : list
+        The tags to keep; by default LIGHT_TAGS
+    tableargs
+        Passed on to dcmtable_light, e.g. workers or maxdepth
+
+    Returns
+    -------
+    fname
+    """
+    if shardby not in SHARD_MODES:
+        raise ValueError('Shards must be split by one of ' +
+                         ', '.join(SHARD_MODES))
+    if not 0 <= index < count:
+        raise ValueError('Shard ' + str(index) + ' is not one of ' +
+                         str(count))
+    table = dcmtable_light(path, tags=tags, shard=(index, count),
+                           shardby=shardby, **tableargs)
+    write_index(table, fname, [index], count, shardby)
+    return fname
+
+
+def _index_task(task):
+    path, index, count, fname, shardby, tags, tableargs = task
+    return index_shard(path, index, count, fname, shardby, tags,
+                       **tableargs)
+
+
+def sharded_table(path, shards=2, shardby='hash', tags=None, workdir=None,
+                  headerentries=128, headerbytes=None, **tableargs):
+    """Reads a tree with a process per shard and merges the shards
+
+    Parameters
+    ----------
+    path : string
+        The root of the tree
+    shards : int
+        The number of shards, and of processes
+    shardby, tags, tableargs
+        See index_shard
+    workdir : string
+        Where to keep the partial indices; by default a temporary
+        directory which is removed afterwards
+    headerentries, headerbytes
+        See dcmtable_light
+
+    Returns
+    -------
+    The merged dcmtable_light
+    """
+    path = op.abspath(path)
+    if not op.exists(path):
+        raise ValueError('Path to read dicoms from does not exist')
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix='dicomorg-shards.')
+    try:
+        tasks = [(path, i, shards, op.join(workdir, 'shard{}.idx'.format(i)),
+                  shardby, tags, tableargs) for i in range(shards)]
+        with timing.stage('shards'):
+            with ProcessPoolExecutor(max_workers=shards) as pool:
+                fnames = list(pool.map(_index_task, tasks))
+        return merge_indices(fnames, headerentries, headerbytes)
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
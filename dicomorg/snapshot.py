@@ -0,0 +1,202 @@
+"""Saving an interactive session so it can be resumed at once
+
+A snapshot holds the columns of values a seriestable needs, its series
+with their files as row numbers, and their aliases, ignores, backends
+and undo history. Loading one builds a dcmtable_light and seriestable
+straight from those values, so no file is read, pydicom is not even
+imported, and the session continues exactly where it stopped.
+
+A snapshot is only used while the tree it was taken of has the same
+files: the modification times of the directories holding them, and of
+their parents, are kept with it. Otherwise the tree is read again and
+the aliases, ignores and backends of the series still there are
+carried over. Changing a file in place does not change its directory,
+so take a fresh snapshot after rewriting dicoms.
+
+Snapshots live next to the dicoms by default, where anyone who can
+write the data can write them too, so they are plain JSON: loading one
+never runs code, and one of another tree is refused.
+"""
+
+import os
+import os.path as op
+import json
+
+from .dcmutil import dcmtable_light, seriestable, LIGHT_TAGS
+from .validate import VALIDATION_TAGS
+from .database import INDEXED_TAGS
+from .shard import table_columns, encode_value, decode_value, compact_json
+from .archive import stat_file
+from . import timing
+
+SNAPSHOTVERSION = 2
+
+# The tags a snapshot of a dcmtable keeps, so the resumed session can
+# still sort, validate and export its series
+SNAPSHOT_TAGS = list(dict.fromkeys(LIGHT_TAGS + VALIDATION_TAGS +
+                                   list(INDEXED_TAGS)))
+
+
+class StaleSnapshot(ValueError):
+    """A snapshot of a tree which has changed since
+
+    Attributes
+    ----------
+    state : dict
+        The series saved in the snapshot, to carry over to a table read
+        again with seriestable.restore
+    """
+    def __init__(self, message, state):
+        ValueError.__init__(self, message)
+        self.state = state
+
+
+def tree_state(path, filelist, fname=None):
+    """Returns what shows whether files were added to or removed from a
+    tree
+
+    Parameters
+    ----------
+    path : string
+        The root of the tree
+    filelist : list
+        The files of the tree
+    fname : string
+        The snapshot; the directory it is written to is listed instead,
+        without the snapshot, since writing it changes the directory
+
+    Returns
+    -------
+    A dict where each directory holding files, each of their parents up
+    to path, and path itself hash to their modification time, or for
+    the snapshot's directory to the sorted list of its entries
+
+    Raises
+    ------
+    OSError if a directory no longer exists
+    """
+    root = op.abspath(path)
+    dirs = {root}
+    for d in set(op.dirname(f) for f in filelist):
+        while d not in dirs and len(d) > len(root):
+            dirs.add(d)
+            d = op.dirname(d)
+    own = op.dirname(fname) if fname else None
+    state = {}
+    for d in dirs:
+        if d == own:
+            name = op.basename(fname)
+            state[d] = sorted(n for n in os.listdir(d)
+                              if not n.startswith(name))
+        else:
+            state[d] = stat_file(d).st_mtime_ns
+    return state
+
+
+def save_snapshot(table, fname, settings=None):
+    """Writes a seriestable to a snapshot
+
+    Parameters
+    ----------
+    table : seriestable
+        The session to save
+    fname : string
+        The snapshot to write, e.g. from cache.snapshot_location
+    settings : dict
+        How the table was read, e.g. maxdepth and include; a snapshot is
+        only loaded with the same settings
+    """
+    pathtable = table.pathtable
+    tags, columns = table_columns(pathtable, SNAPSHOT_TAGS)
+    with timing.stage('snapshot', files=len(pathtable.filelist)):
+        contents = {'version': SNAPSHOTVERSION,
+                    'path': pathtable.tablepath,
+                    'settings': settings or {},
+                    'tree': tree_state(pathtable.tablepath,
+                                       pathtable.filelist, fname),
+                    'tags': list(tags),
+                    'preambleless': pathtable.preambleless,
+                    'filelist': pathtable.filelist, 'columns': columns,
+                    'skipped': pathtable.skipped,
+                    'state': table.get_state()}
+        directory = op.dirname(fname)
+        if not op.exists(directory):
+            os.makedirs(directory)
+        tempname = fname + '.tmp'
+        with open(tempname, 'w') as f:
+            json.dump(contents, f, default=encode_value, separators=(',', ':'))
+        os.replace(tempname, fname)
+
+
+def load_snapshot(fname, settings=None, tags=None, headerentries=128,
+                  headerbytes=None, path=None):
+    """Resumes a seriestable from a snapshot
+
+    Parameters
+    ----------
+    fname : string
+        The snapshot
+    path : string
+        The directory or archive the session reads; a snapshot of
+        anything else is refused
+    settings : dict
+        How the table would be read now; see save_snapshot
+    tags : list
+        Tags the table must hold, besides LIGHT_TAGS
+    headerentries, headerbytes
+        See dcmtable_light
+
+    Returns
+    -------
+    The seriestable, over a dcmtable_light, or None if there is no
+    snapshot
+
+    Raises
+    ------
+    StaleSnapshot if the tree has changed or is read differently now
+    ValueError if the snapshot cannot be read or is of another tree,
+    saying why
+    """
+    try:
+        with open(fname) as f:
+            contents = json.load(f, object_hook=decode_value)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        raise ValueError('Snapshot ' + fname + ' is unreadable: ' + str(e))
+    if (not isinstance(contents, dict) or
+            contents.get('version') != SNAPSHOTVERSION):
+        raise ValueError('Snapshot ' + fname + ' is not a dicomorg session '
+                         'of version ' + str(SNAPSHOTVERSION))
+    filelist = contents['filelist']
+    if path is not None:
+        root = op.abspath(path)
+        if (contents['path'] != root or
+                not all(f.startswith(root + os.sep) for f in filelist)):
+            raise ValueError('Snapshot ' + fname + ' is not of ' + root)
+    state = contents['state']
+    # Compared as they would be stored
+    settings = json.loads(json.dumps(settings or {}))
+    if contents['settings'] != settings:
+        raise StaleSnapshot('Snapshot ' + fname + ' was taken with other '
+                            'reading options', state)
+    missing = set(tags or ()).difference(contents['tags'])
+    if missing:
+        raise StaleSnapshot('Snapshot ' + fname + ' does not hold ' +
+                            ', '.join(sorted(missing)), state)
+    try:
+        current = tree_state(contents['path'], filelist, fname)
+    except OSError:
+        current = None
+    if current != contents['tree']:
+        raise StaleSnapshot('Files have changed since snapshot ' + fname +
+                            ' was taken', state)
+    with timing.stage('snapshot', files=len(filelist)):
+        columns = {t: [compact_json(v) for v in c]
+                   for t, c in contents['columns'].items()}
+        pathtable = dcmtable_light.from_columns(
+            contents['path'], filelist, columns,
+            preambleless=contents['preambleless'],
+            headerentries=headerentries, headerbytes=headerbytes)
+        pathtable.skipped = contents['skipped']
+        return seriestable.from_state(pathtable, state)
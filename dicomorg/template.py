@@ -0,0 +1,104 @@
+"""Templates of ignore/alias instructions to apply to many sessions"""
+
+# Template commands, with the interactive shortcuts for each
+COMMANDS = {'i': 'ignore', 'ignore': 'ignore',
+            'a': 'alias', 'alias': 'alias'}
+
+
+def read_template(fname):
+    """Reads a template file
+
+    Each line holds a command followed by its input as typed in the
+    interactive mode, e.g.
+
+        ignore 1 2 3
+        alias 10 t1 11 rest
+
+    Blank lines and lines starting with # are skipped.
+
+    Parameters
+    ----------
+    fname : string
+        The template file
+
+    Returns
+    -------
+    A list of (command, input) tuples
+
+    Raises
+    ------
+    ValueError if a line has an unknown command
+    """
+    instructions = []
+    with open(fname) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            words = line.split(None, 1)
+            if words[0] not in COMMANDS:
+                raise ValueError('Unknown template command ' + words[0] +
+                                 ' on line ' + str(lineno))
+            if len(words) < 2:
+                raise ValueError('Template command ' + words[0] +
+                                 ' on line ' + str(lineno) +
+                                 ' has no input')
+            instructions.append((COMMANDS[words[0]], words[1]))
+    return instructions
+
+
+def apply_template(table, instructions):
+    """Applies template instructions to a seriestable
+
+    Parameters
+    ----------
+    table : seriestable
+        The table to apply the instructions to
+    instructions : list
+        (command, input) tuples as returned by read_template
+
+    Returns
+    -------
+    The new seriestable
+    """
+    for command, userinput in instructions:
+        if command == 'ignore':
+            table = table.ignore(userinput.split())
+        else:
+            table = table.alias(' '.join(userinput.split()))
+    return table
+
+
+def template_aliases(instructions):
+    """Collapses template instructions into the final alias of each
+    series number they touch
+
+    Parameters
+    ----------
+    instructions : list
+        (command, input) tuples as returned by read_template
+
+    Returns
+    -------
+    A dict where each series key as typed (see dcmseries.get_key)
+    hashes to its alias, or to '' if it is ignored
+    """
+    aliases = {}
+    for command, userinput in instructions:
+        words = userinput.split()
+        if command == 'ignore':
+            for number in words:
+                aliases[number] = ''
+        else:
+            if len(words) % 2 != 0:
+                raise Exception('Alias indices are not paired with '
+                                'aliases.')
+            for i in range(0, len(words), 2):
+                # Keys of series sharing a number look like 10.2
+                try:
+                    float(words[i])
+                except ValueError:
+                    raise Exception(words[i] + ' cannot be converted to '
+                                    'a series number.')
+                aliases[words[i]] = words[i + 1]
+    return aliases
@@ -0,0 +1,185 @@
+"""Optional per-stage timing of reading and converting
+
+Instrumented code calls stage, count and record_subprocess, which do
+nothing unless a profiler has been enabled, e.g.
+
+    prof = timing.enable()
+    table = seriestable(dcmtable(path))
+    table.convert()
+    prof.dump('profile.json')
+    timing.disable()
+
+Stages are inclusive and may nest: 'series' includes the 'group' it
+calls. CPU time is that of the whole process, so it includes worker
+threads; work done in worker processes is not counted.
+"""
+
+import time
+import json
+import threading
+import cProfile
+from contextlib import contextmanager
+
+_profiler = None
+
+
+class profiler:
+    """Accumulates timings by stage
+
+    Attributes
+    ----------
+    stages : dict
+        A dict where each stage name hashes to a dict of its calls,
+        wall and cpu seconds, files and bytes
+    subprocesses : list
+        A dict for each external command run, with its command, files,
+        seconds and returncode
+    scanprofile : cProfile.Profile
+        The profile of the table reads, if asked for
+    """
+    def __init__(self, profile_scan=False):
+        """Constructor for profiler
+        Parameters
+        ----------
+        profile_scan : bool
+            Whether to run cProfile while tables are read
+        """
+        self.stages = {}
+        self.subprocesses = []
+        self.scanprofile = cProfile.Profile() if profile_scan else None
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _entry(self, name):
+        try:
+            return self.stages[name]
+        except KeyError:
+            entry = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'files': 0,
+                     'bytes': 0}
+            self.stages[name] = entry
+            return entry
+
+    def add(self, name, wall=0.0, cpu=0.0, files=0, nbytes=0, calls=1):
+        """Adds to the totals of a stage"""
+        with self._lock:
+            entry = self._entry(name)
+            entry['calls'] += calls
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['files'] += files
+            entry['bytes'] += nbytes
+
+    def report(self):
+        """Returns the timings as a dict which json can write"""
+        with self._lock:
+            return {'started': self.started,
+                    'seconds': time.time() - self.started,
+                    'stages': {k: dict(v) for k, v in self.stages.items()},
+                    'subprocesses': list(self.subprocesses)}
+
+    def dump(self, fname):
+        """Writes the timings to a json file"""
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def dump_scan(self, fname):
+        """Writes the cProfile stats of the table reads, for pstats"""
+        if self.scanprofile is not None:
+            self.scanprofile.dump_stats(fname)
+
+
+def enable(profile_scan=False):
+    """Starts collecting timings, returning the profiler"""
+    global _profiler
+    _profiler = profiler(profile_scan)
+    return _profiler
+
+
+def disable():
+    """Stops collecting timings, returning the profiler used"""
+    global _profiler
+    prof = _profiler
+    _profiler = None
+    return prof
+
+
+def current():
+    """Returns the enabled profiler, or None"""
+    return _profiler
+
+
+@contextmanager
+def stage(name, files=0, nbytes=0):
+    """Times the enclosed code as a stage, if profiling"""
+    prof = _profiler
+    if prof is None:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        prof.add(name, time.perf_counter() - wall,
+                 time.process_time() - cpu, files, nbytes)
+
+
+@contextmanager
+def scan_profile():
+    """Runs cProfile over the enclosed code, if asked for"""
+    prof = _profiler
+    if prof is None or prof.scanprofile is None:
+        yield
+        return
+    prof.scanprofile.enable()
+    try:
+        yield
+    finally:
+        prof.scanprofile.disable()
+
+
+def count(name, files=0, nbytes=0):
+    """Adds files and bytes to a stage without timing it"""
+    prof = _profiler
+    if prof is not None:
+        prof.add(name, files=files, nbytes=nbytes, calls=0)
+
+
+def timed(name, iterable):
+    """Yields from an iterable, timing each step as a stage and counting
+    each item as a file
+
+    This times generators, such as directory walks, which do their work
+    in between the caller's.
+    """
+    iterator = iter(iterable)
+    while True:
+        prof = _profiler
+        if prof is None:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+            continue
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            prof.add(name, time.perf_counter() - wall,
+                     time.process_time() - cpu, calls=0)
+            return
+        prof.add(name, time.perf_counter() - wall,
+                 time.process_time() - cpu, files=1, calls=0)
+        yield item
+
+
+def record_subprocess(command, files, seconds, returncode):
+    """Records an external command run, if profiling"""
+    prof = _profiler
+    if prof is not None:
+        with prof._lock:
+            prof.subprocesses.append({'command': command, 'files': files,
+                                      'seconds': seconds,
+                                      'returncode': returncode})
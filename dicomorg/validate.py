@@ -0,0 +1,169 @@
+"""Checks that a series is complete before it is converted
+
+The checks only use headers already in a table, so they cost no reads
+and no subprocess. Each is done with numpy over the whole series at
+once: missing instance numbers, slice positions missing from the stack
+or from some volumes, acquisitions of different sizes, duplicated
+SOPInstanceUIDs and echoes with different numbers of files.
+"""
+
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# The tags the checks use; a dcmtable_light needs them to check a series
+VALIDATION_TAGS = ['SOPInstanceUID', 'InstanceNumber', 'AcquisitionNumber',
+                   'ImagePositionPatient', 'ImageOrientationPatient']
+
+# What to do with series which fail the checks
+VALIDATION_ACTIONS = ('skip', 'quarantine')
+
+# The directory under the output path quarantined series go to
+QUARANTINENAME = 'quarantine'
+
+# Slice positions closer than this, in mm, are the same position
+POSITION_DECIMALS = 3
+
+
+def _array(values, width=None):
+    """Returns header values as a float array, nan where a file has no
+    usable value"""
+    shape = (len(values),) if width is None else (len(values), width)
+    array = np.full(shape, np.nan)
+    for i, v in enumerate(values):
+        if v is None:
+            continue
+        try:
+            if width is None:
+                array[i] = float(v)
+            elif len(v) == width:
+                array[i] = [float(x) for x in v]
+        except (TypeError, ValueError):
+            pass
+    return array
+
+
+def _uniform(counts):
+    return bool((counts == counts[0]).all())
+
+
+def check_duplicates(uids):
+    """Returns a problem if any SOPInstanceUID is shared by several
+    files, or None"""
+    known = np.array([str(u) for u in uids if u is not None])
+    if not len(known):
+        return None
+    counts = np.unique(known, return_counts=True)[1]
+    extra = int((counts - 1).sum())
+    if extra:
+        return 'duplicated SOPInstanceUIDs: {}'.format(extra)
+    return None
+
+
+def check_instances(numbers):
+    """Returns a problem if instance numbers have gaps, or None"""
+    numbers = numbers[~np.isnan(numbers)]
+    if not len(numbers):
+        return None
+    unique = np.unique(numbers)
+    missing = int(unique[-1] - unique[0] + 1 - len(unique))
+    if missing > 0:
+        return 'instance numbers missing between {} and {}: {}'.format(
+            int(unique[0]), int(unique[-1]), missing)
+    return None
+
+
+def check_positions(positions, orientations):
+    """Returns the problems with the slice positions of one echo
+
+    Slices are placed along the normal of their orientation. Gaps of
+    more than one and a half times the usual spacing are missing
+    slices, and positions which appear fewer times than others are
+    missing from some volumes.
+    """
+    normals = np.cross(orientations[:, :3], orientations[:, 3:])
+    distances = np.round((positions * normals).sum(axis=1),
+                         POSITION_DECIMALS)
+    distances = distances[~np.isnan(distances)]
+    if len(distances) < 2:
+        return []
+    unique, counts = np.unique(distances, return_counts=True)
+    problems = []
+    if not _uniform(counts):
+        problems.append('slices appear {} to {} times, so some volumes '
+                        'are incomplete'.format(counts.min(),
+                                                counts.max()))
+    if len(unique) > 2:
+        steps = np.diff(unique)
+        step = np.median(steps)
+        gaps = steps[steps > 1.5 * step]
+        if step > 0 and len(gaps):
+            missing = int((np.round(gaps / step) - 1).sum())
+            problems.append('slices missing from the stack: {}'.format(
+                missing))
+    return problems
+
+
+def check_acquisitions(numbers):
+    """Returns a problem if acquisitions have different numbers of
+    files, or None"""
+    numbers = numbers[~np.isnan(numbers)]
+    if not len(numbers):
+        return None
+    counts = np.unique(numbers, return_counts=True)[1]
+    if not _uniform(counts):
+        return 'acquisitions have {} to {} files'.format(counts.min(),
+                                                         counts.max())
+    return None
+
+
+def validate_series(table, files, echo_groups=None):
+    """Checks a series using the headers in its table
+
+    Parameters
+    ----------
+    table : dcmtable
+        The table the series' files are in
+    files : list
+        The files of the series
+    echo_groups : list
+        The files of each echo, if the series is multi-echo
+
+    Returns
+    -------
+    A list of problems found, as strings; empty if there are none
+
+    Raises
+    ------
+    ValueError if numpy is not installed, or if the table was read
+    without VALIDATION_TAGS, which would pass every check
+    """
+    if np is None:
+        raise ValueError('Validating series needs numpy')
+    # A dcmtable keeps whole headers; a dcmtable_light only its tags
+    if table.tags is not None:
+        missing = [t for t in VALIDATION_TAGS if t not in table.tags]
+        if missing:
+            raise ValueError('Validating series needs ' + ', '.join(missing)
+                             + ', which the table was read without')
+    problems = [check_duplicates(table.optional_values('SOPInstanceUID',
+                                                       files)),
+                check_instances(_array(table.optional_values(
+                    'InstanceNumber', files)))]
+    groups = echo_groups or [files]
+    if len(groups) > 1:
+        sizes = np.array([len(g) for g in groups])
+        if not _uniform(sizes):
+            problems.append('echoes have ' + ', '.join(str(n) for n in sizes)
+                            + ' files')
+    for i, group in enumerate(groups):
+        found = [check_acquisitions(_array(table.optional_values(
+            'AcquisitionNumber', group)))]
+        found += check_positions(
+            _array(table.optional_values('ImagePositionPatient', group), 3),
+            _array(table.optional_values('ImageOrientationPatient', group),
+                   6))
+        if len(groups) > 1:
+            found = ['echo {}: {}'.format(i + 1, p) for p in found if p]
+        problems += found
+    return [p for p in problems if p]
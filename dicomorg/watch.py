@@ -0,0 +1,311 @@
+"""Watching a directory and converting series as they arrive"""
+
+import os
+import os.path as op
+import time
+
+from .dcmutil import dcmtable, dcmtable_light, seriestable, LIGHT_TAGS
+from .pipeline import streamconverter, HINT_TAGS
+from .scan import walk_files, _matches
+from .cache import CACHENAME, SNAPSHOTNAME
+from .manifest import MANIFESTNAME
+from .template import template_aliases
+from .colors import *
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Our own files, which may be written into the watched directory
+IGNORED = (CACHENAME, SNAPSHOTNAME, MANIFESTNAME, '.tmp.')
+
+
+class watcher:
+    """Keeps a table of a directory up to date as files arrive and are
+    removed, converting series once they are stable
+
+    New files are only read once they have not been modified for a
+    settling period, and a series is converted once no file has arrived
+    for it for a stable period (or its header hints say it is complete).
+    Series which change after conversion are converted again.
+
+    With inotify_simple installed, changes are taken from inotify events
+    and each cycle costs as much as the files which changed. Otherwise
+    the tree is listed each cycle, which needs no stat of files already
+    seen, but still grows with the number of files.
+
+    Attributes
+    ----------
+    table : dcmtable
+        The table of the directory
+    series : seriestable
+        The series of the table, with the template applied to each as
+        it arrives
+    converter : streamconverter
+        The converter which decides when series are sent
+    seen : set
+        The files read or skipped so far
+    pending : set
+        New files still settling
+    """
+    def __init__(self, path, outpath=None, settle=2.0, stable=60.0,
+                 instructions=None, jobs=1, force=False, manifest=True,
+                 backend='dcm2niix', light=False, inotify=None, **tableargs):
+        """Constructor for watcher
+        Parameters
+        ----------
+        path : string
+            The directory to watch
+        outpath : string
+            Where to write the niftis; by default path
+        settle : float
+            Seconds a file must be unmodified before it is read
+        stable : float
+            Seconds without new files after which a series is converted
+        instructions : list
+            Template instructions, as returned by read_template
+        jobs, force, manifest, backend
+            See streamconverter
+        light : bool
+            Whether to keep a dcmtable_light rather than a dcmtable
+        inotify : bool
+            Whether to use inotify; by default it is used if available
+        tableargs
+            Passed on to the table
+        """
+        self.path = op.abspath(path)
+        self.settle = settle
+        self.instructions = instructions or []
+        self.aliases = template_aliases(self.instructions)
+        self.backend = backend
+        self.maxdepth = tableargs.get('maxdepth', 0)
+        self.include = tableargs.get('include')
+        self.exclude = tableargs.get('exclude')
+        self.workers = tableargs.get('workers', 1)
+        self.processes = tableargs.get('processes', False)
+        if inotify and INotify is None:
+            raise ValueError('inotify needs the inotify_simple package')
+        self.inotify = None
+        self.watches = {}
+        if inotify or (inotify is None and INotify is not None):
+            self.inotify = INotify()
+            self._watch(self.path, 0)
+        self.converter = streamconverter(
+            outpath or self.path, jobs=jobs, quiet=stable,
+            aliases=self.aliases, force=force,
+            manifest=manifest, backend=backend)
+
+        # List before reading, so a file arriving meanwhile is read now
+        # or found by the next cycle, never lost
+        listed = set(self._list())
+        if light:
+            self.table = dcmtable_light(self.path,
+                                        tags=LIGHT_TAGS + HINT_TAGS,
+                                        callback=self.converter,
+                                        **tableargs)
+        else:
+            self.table = dcmtable(self.path, callback=self.converter,
+                                  **tableargs)
+        self.seen = set(self.table.filelist)
+        self.pending = set()
+        for f in listed.difference(self.seen):
+            # Files still being written may not have read as dicoms
+            if self._settled(f, time.time()):
+                self.seen.add(f)
+            else:
+                self.pending.add(f)
+        # Series named in the template may not have arrived yet, so it is
+        # applied a series at a time
+        self.series = seriestable(self.table)
+        for s in self.series.SeriesList:
+            self._setup(s)
+
+    def _list(self, directory=None):
+        """Lists the files the table would read, under a directory"""
+        if directory is None:
+            return walk_files(self.path, maxdepth=self.maxdepth,
+                              include=self.include, exclude=self.exclude,
+                              ignore=IGNORED)
+        rel = op.relpath(directory, self.path)
+        depth = rel.count(os.sep) + 1
+        if self.maxdepth is not None:
+            if depth > self.maxdepth:
+                return []
+            maxdepth = self.maxdepth - depth
+        else:
+            maxdepth = None
+        return [f for f in walk_files(directory, maxdepth=maxdepth,
+                                      ignore=IGNORED)
+                if self._wanted(f)]
+
+    def _wanted(self, fname):
+        """Returns whether the table would read a file"""
+        rel = op.relpath(fname, self.path).replace(os.sep, '/')
+        if op.basename(fname).startswith(IGNORED):
+            return False
+        if self.exclude and any(_matches('/'.join(rel.split('/')[:i]),
+                                         self.exclude)
+                                for i in range(1, rel.count('/') + 2)):
+            return False
+        if self.include and not _matches(rel, self.include):
+            return False
+        depth = rel.count('/')
+        return self.maxdepth is None or depth <= self.maxdepth
+
+    def _watch(self, directory, depth):
+        """Watches a directory and, within maxdepth, its subdirectories"""
+        mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                flags.DELETE | flags.CREATE | flags.DELETE_SELF)
+        try:
+            wd = self.inotify.add_watch(directory, mask)
+        except OSError:
+            return
+        self.watches[wd] = directory
+        if self.maxdepth is not None and depth >= self.maxdepth:
+            return
+        try:
+            with os.scandir(directory) as it:
+                subdirs = [e.path for e in it if e.is_dir()]
+        except OSError:
+            return
+        for d in subdirs:
+            self._watch(d, depth + 1)
+
+    def _settled(self, fname, now):
+        """Returns whether a file has been left alone for long enough to
+        be read, or None if it is gone"""
+        try:
+            return now - os.stat(fname).st_mtime >= self.settle
+        except OSError:
+            return None
+
+    def _changes(self, timeout=0):
+        """Returns the sets of new and removed files since the last
+        cycle, waiting up to timeout seconds for inotify events"""
+        if self.inotify is None:
+            current = set(self._list())
+            return current.difference(self.seen), \
+                self.seen.difference(current)
+        new = set()
+        removed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self.watches[event.wd]
+                continue
+            if not event.name:
+                continue
+            fname = op.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    depth = op.relpath(fname, self.path).count(os.sep)
+                    self._watch(fname, depth + 1)
+                    new.update(self._list(fname))
+                elif event.mask & flags.MOVED_FROM:
+                    prefix = fname + os.sep
+                    removed.update(f for f in self.seen
+                                   if f.startswith(prefix))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO |
+                               flags.CREATE):
+                if self._wanted(fname):
+                    new.add(fname)
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                removed.add(fname)
+        return new.difference(self.seen), removed.intersection(self.seen)
+
+    def cycle(self, timeout=0):
+        """Applies the changes since the last cycle
+
+        Parameters
+        ----------
+        timeout : float
+            With inotify, how long to wait for changes
+
+        Returns
+        -------
+        added : list
+            The dicoms added to the table
+        removed : list
+            The dicoms removed from the table
+        """
+        new, removed = self._changes(timeout)
+        now = time.time()
+        candidates = self.pending.union(new)
+        self.pending = set()
+        ready = []
+        for f in sorted(candidates):
+            settled = self._settled(f, now)
+            if settled:
+                ready.append(f)
+            elif settled is not None:
+                self.pending.add(f)
+        self.seen.update(ready)
+        self.seen.difference_update(removed)
+
+        gone = [f for f in removed if f in self.table._rows()]
+        if gone:
+            self.converter.remove(self.table, gone)
+            gone = self.table.remove_files(gone)
+            self.series.remove_files(gone)
+        added = self.table.add_files(ready, workers=self.workers,
+                                     processes=self.processes)
+        before = set(id(s) for s in self.series.SeriesList)
+        self.series.add_files(added)
+        for s in self.series.SeriesList:
+            if id(s) not in before:
+                self._setup(s)
+        self.converter(self.table, added)
+        self.converter.collect()
+        return added, gone
+
+    def _setup(self, s):
+        """Applies the template and backend to a new series"""
+        s.set_backend(self.backend)
+        alias = self.aliases.get(s.get_key())
+        if alias == '':
+            s.ignore()
+        elif alias:
+            s.set_alias(alias)
+
+    def run(self, interval=5.0, cycles=None):
+        """Applies changes every interval seconds until interrupted
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between cycles
+        cycles : int
+            How many cycles to run; by default until interrupted
+        """
+        print(blue('Watching ' + self.path + ' (' +
+                   ('inotify' if self.inotify else 'polling') + ')'))
+        n = 0
+        try:
+            while cycles is None or n < cycles:
+                start = time.monotonic()
+                if self.inotify is not None:
+                    added, removed = self.cycle(timeout=interval)
+                else:
+                    added, removed = self.cycle()
+                if added or removed:
+                    print('{}: {} files added, {} removed, {} series'.format(
+                        time.strftime('%H:%M:%S'), len(added),
+                        len(removed), len(self.series.SeriesList)))
+                n += 1
+                if self.inotify is None and (cycles is None or n < cycles):
+                    time.sleep(max(0, interval -
+                                   (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            print(blue('Stopping; waiting for running conversions...'))
+        self.close()
+
+    def close(self):
+        """Waits for running conversions and stops watching"""
+        self.converter.collect(wait=True)
+        self.converter.pool.shutdown()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -1,3 +1,7 @@
 from .dicomorg import main
+from .batch import main as batch_main
+from .find import main as find_main
+from .watch import main as watch_main
+from .shard import main as shard_main
 
 __all__ = ['dicomorg']
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+import os
+import os.path as op
+import sys
+import time
+import argparse
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from dicomorg.dcmutil import dcmtable, dcmtable_light, seriestable, \
+    BACKENDS, LIGHT_TAGS
+from dicomorg.template import read_template, apply_template
+from dicomorg.pipeline import stream_convert
+from dicomorg.colors import *
+from dicomorg import timing
+from dicomorg.database import headerdb, INDEXED_TAGS
+from dicomorg.organise import ORGANISE_MODES
+from dicomorg.archive import archive_stem
+from dicomorg.validate import VALIDATION_ACTIONS, VALIDATION_TAGS
+
+SUMMARYNAME = 'summary.tsv'
+SUMMARYFIELDS = ['session', 'status', 'series', 'converted', 'skipped',
+                 'failures', 'seconds', 'message']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='apply a template to many sessions and convert them')
+    parser.add_argument('sessions', nargs='*',
+                        help='session directories of dicoms to convert')
+    parser.add_argument('-t', '--template', required=True,
+                        help='template of ignore/alias instructions')
+    parser.add_argument('-l', '--list', default=None,
+                        help='file listing session directories, one per '
+                             'line')
+    parser.add_argument('-o', '--output', default=None,
+                        help='directory to put each session\'s niftis in, '
+                             'under the session\'s name (default: '
+                             'in-place)')
+    parser.add_argument('--logs', default=None,
+                        help='directory for per-session logs and the '
+                             'summary (default: OUTPUT/logs or ./logs)')
+    parser.add_argument('-p', '--sessions-at-once', type=int, default=1,
+                        help='number of sessions to process at once')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of workers to read dicom headers with')
+    parser.add_argument('--preambleless', action='store_true',
+                        help='also read dicoms without the 128-byte '
+                             'preamble and DICM prefix')
+    parser.add_argument('--archives', action='store_true',
+                        help='read dicoms inside zip and tar archives in '
+                             'place; sessions which are archives are '
+                             'always read this way')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='read dicoms in subdirectories of each session '
+                             'too')
+    parser.add_argument('--include', action='append', default=None,
+                        help='glob of files to read; may be repeated')
+    parser.add_argument('--exclude', action='append', default=None,
+                        help='glob of files or directories not to read; '
+                             'may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of series to convert at once in each '
+                             'session')
+    parser.add_argument('--dcm2niix-batch', type=int, default=1,
+                        metavar='N',
+                        help='convert up to N series in each dcm2niix run, '
+                             'saving a process start per series; not with '
+                             '--stream')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='start converting each series as soon as its '
+                             'files have been read')
+    parser.add_argument('--quiet', type=float, default=None,
+                        help='with --stream, seconds without new files '
+                             'after which a series is converted even if '
+                             'its headers say it is incomplete')
+    parser.add_argument('--backend', choices=BACKENDS, default='dcm2niix',
+                        help='converter to use; numpy converts simple '
+                             'uncompressed series in-process and falls '
+                             'back to dcm2niix for the rest')
+    parser.add_argument('--export-db', default=None, metavar='DB',
+                        help='store the headers of each session in this '
+                             'SQLite database, for dicomorg-find')
+    parser.add_argument('--organise', default=None, metavar='DIR',
+                        help='also lay out the dicoms of each session in a '
+                             'Patient/Study/Series tree under this '
+                             'directory')
+    parser.add_argument('--organise-mode', choices=ORGANISE_MODES,
+                        default='auto',
+                        help='how --organise places files (default: '
+                             'hardlinks or reflinks where possible, else '
+                             'copies)')
+    parser.add_argument('--validate', choices=VALIDATION_ACTIONS,
+                        default=None,
+                        help='check series for missing slices and '
+                             'duplicated files before converting, and '
+                             'skip or quarantine those with problems')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per-stage timings of each session as '
+                             'json next to its log')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='overwrite existing niftis')
+    parser.add_argument('--light', action='store_true',
+                        help='only keep the tags needed for sorting in '
+                             'memory')
+    args = parser.parse_args()
+    sessions = list(args.sessions)
+    if args.list:
+        with open(args.list) as f:
+            sessions += [l.strip() for l in f if l.strip()]
+    if not sessions:
+        parser.error('no sessions given')
+    logdir = args.logs
+    if logdir is None:
+        logdir = op.join(args.output or os.getcwd(), 'logs')
+    results = batch(sessions, args.template, outroot=args.output,
+                    logdir=logdir, processes=args.sessions_at_once,
+                    workers=args.workers, jobs=args.jobs, force=args.force,
+                    light=args.light, preambleless=args.preambleless,
+                    maxdepth=None if args.recursive else 0,
+                    include=args.include, exclude=args.exclude,
+                    stream=args.stream, quiet=args.quiet,
+                    backend=args.backend, profile=args.profile,
+                    exportdb=args.export_db, organise=args.organise,
+                    organisemode=args.organise_mode,
+                    validate=args.validate, archives=args.archives,
+                    convertbatch=args.dcm2niix_batch)
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
+
+
+def batch(sessions, template, outroot=None, logdir='logs', processes=1,
+          workers=1, jobs=1, force=False, light=False, preambleless=False,
+          maxdepth=0, include=None, exclude=None, stream=False,
+          quiet=None, backend='dcm2niix', profile=False, exportdb=None,
+          organise=None, organisemode='auto', validate=None,
+          archives=False, convertbatch=1):
+    """Applies a template to many sessions and converts them
+
+    Parameters
+    ----------
+    sessions : list
+        The session directories, or zip or tar archives, to convert
+    template : string
+        The template file of ignore/alias instructions
+    outroot : string
+        A directory to convert each session into, under the session's
+        name without any archive extension; by default sessions are
+        converted in-place, or next to archives
+    logdir : string
+        Where to write a log for each session and the summary
+    processes : int
+        The number of sessions to process at once
+    workers, jobs, force, light, preambleless, maxdepth, include, exclude,
+    archives
+        Passed on to the dcmtable and seriestable of each session
+    stream : bool
+        Whether to start converting series while each session is still
+        being read; see stream_convert
+    quiet : float
+        See stream_convert
+    backend : string
+        The converter to use; one of BACKENDS
+    profile : bool
+        Whether to write per-stage timings of each session next to its
+        log, as the log name with .json instead of .log
+    exportdb : string
+        A SQLite database to store the headers of each session in; see
+        headerdb
+    organise : string
+        A directory to lay out the dicoms of every session in, as a
+        Patient/Study/Series tree; see seriestable.organise
+    organisemode : string
+        How to place files in the tree; one of ORGANISE_MODES
+    validate : string
+        What to do with series which fail validation, one of
+        VALIDATION_ACTIONS; by default series are not checked. Not used
+        with stream.
+    convertbatch : int
+        The most series to convert in one dcm2niix run. Not used with
+        stream.
+
+    Returns
+    -------
+    A list of per-session result dicts, in the order of sessions, with
+    the keys of SUMMARYFIELDS
+    """
+    instructions = read_template(template)
+    sessions = [op.abspath(op.expanduser(s)) for s in sessions]
+    logdir = op.abspath(logdir)
+    os.makedirs(logdir, exist_ok=True)
+    tasks = []
+    for i, session in enumerate(sessions):
+        if outroot:
+            outpath = op.join(op.abspath(outroot),
+                              archive_stem(op.basename(session)))
+        else:
+            outpath = None
+        # Prefix with the position, since sessions may share a name
+        logname = op.join(logdir, '{:05d}_{}.log'.format(
+            i, op.basename(session)))
+        tableargs = dict(workers=workers, preambleless=preambleless,
+                         maxdepth=maxdepth, include=include, exclude=exclude,
+                         archives=archives)
+        tasks.append((session, instructions, outpath, logname, tableargs,
+                      jobs, force, light, stream, quiet, backend, profile,
+                      exportdb and op.abspath(exportdb),
+                      organise and op.abspath(organise), organisemode,
+                      validate, convertbatch))
+
+    start = time.time()
+    print(blue('Processing ' + str(len(sessions)) + ' sessions...'))
+    results = []
+    if processes <= 1:
+        runs = map(_run_session, tasks)
+        for r in runs:
+            results.append(_report(r))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for r in pool.map(_run_session, tasks):
+                results.append(_report(r))
+
+    elapsed = time.time() - start
+    summaryname = op.join(logdir, SUMMARYNAME)
+    with open(summaryname, 'w') as f:
+        f.write('\t'.join(SUMMARYFIELDS) + '\n')
+        for r in results:
+            f.write('\t'.join(str(r[k]).replace('\t', ' ').replace('\n', ' ')
+                              for k in SUMMARYFIELDS) + '\n')
+    nfailed = sum(r['status'] != 'ok' for r in results)
+    rate = len(results) / elapsed * 3600 if elapsed else 0
+    print(blue('{} sessions in {:.1f} s ({:.0f} sessions/hour), {} with '
+               'problems'.format(len(results), elapsed, rate, nfailed)))
+    print('Summary written to ' + summaryname)
+    return results
+
+
+def _report(result):
+    """Prints a one-line report for a finished session"""
+    line = '{}\t{} converted, {} skipped, {} failed\t{:.1f} s'.format(
+        result['session'], result['converted'], result['skipped'],
+        result['failures'], result['seconds'])
+    if result['status'] == 'ok':
+        print(green(line))
+    else:
+        print(red(line + '\t' + result['message']))
+    return result
+
+
+def _export(table, dbfile):
+    """Stores a session's headers in the database"""
+    db = headerdb(dbfile)
+    try:
+        print('Exported ' + str(db.export(table)) + ' files to ' + dbfile)
+    finally:
+        db.close()
+
+
+def _run_session(task):
+    """Builds, templates and converts one session, logging to a file"""
+    session, instructions, outpath, logname, tableargs, jobs, force, \
+        light, stream, quiet, backend, profile, exportdb, organise, \
+        organisemode, validate, convertbatch = task
+    result = dict.fromkeys(SUMMARYFIELDS, 0)
+    result['session'] = session
+    result['message'] = ''
+    start = time.time()
+    if profile:
+        prof = timing.enable()
+    with open(logname, 'w') as log, redirect_stdout(log):
+        try:
+            if stream:
+                thistable, counts = stream_convert(
+                    session, outpath=outpath, jobs=jobs, quiet=quiet,
+                    instructions=instructions, force=force, light=light,
+                    backend=backend,
+                    tags=list(INDEXED_TAGS) if exportdb else None,
+                    **tableargs)
+                print(thistable.pathtable)
+                print(thistable)
+                if exportdb:
+                    _export(thistable.pathtable, exportdb)
+            else:
+                if light:
+                    # Read the indexed and validated tags too, if needed
+                    tags = list(LIGHT_TAGS)
+                    if exportdb:
+                        tags += INDEXED_TAGS
+                    if validate:
+                        tags += VALIDATION_TAGS
+                    tags = list(dict.fromkeys(tags))
+                    table = dcmtable_light(session, tags=tags, **tableargs)
+                else:
+                    table = dcmtable(session, **tableargs)
+                print(table)
+                if exportdb:
+                    _export(table, exportdb)
+                thistable = apply_template(seriestable(table), instructions)
+                thistable.set_backend(backend)
+                print(thistable)
+                counts = thistable.convert(outpath=outpath, force=force,
+                                           interactive=False, jobs=jobs,
+                                           validate=validate,
+                                           batch=convertbatch)
+            if organise:
+                thistable.organise(organise, mode=organisemode)
+            converted, skipped, failures = counts
+            result['series'] = len(thistable.SeriesList)
+            result['converted'] = converted
+            result['skipped'] = skipped
+            result['failures'] = failures
+            result['status'] = 'failed' if failures else 'ok'
+        except Exception as e:
+            print(red(repr(e)))
+            result['status'] = 'error'
+            result['message'] = str(e)
+    result['seconds'] = round(time.time() - start, 3)
+    if profile:
+        timing.disable()
+        prof.dump(op.splitext(logname)[0] + '.json')
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,18 @@ import os
 import os.path as op
 import readline
 from copy import copy
+from functools import partial
 from dicomorg.dcmutil import *
 from dicomorg.colors import *
+from dicomorg.template import read_template, apply_template
+from dicomorg import timing
+from dicomorg.database import headerdb, INDEXED_TAGS
+from dicomorg.organise import ORGANISE_MODES
+from dicomorg.shard import sharded_table, merge_indices
+from dicomorg.validate import VALIDATION_ACTIONS, VALIDATION_TAGS
+from dicomorg.cache import snapshot_location
+from dicomorg.snapshot import save_snapshot, load_snapshot, StaleSnapshot
+from dicomorg.engine import conversionengine
 # Aliases; this isn't pythonic but modules are hard
 import argparse
 
@@ -16,17 +26,143 @@ def main():
     parser.add_argument('-t', '--template',
                         help='template to use to sort the dicoms',
                         default=None)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of workers to read dicom headers with')
+    parser.add_argument('--processes', action='store_true',
+                        help='read headers with processes instead of '
+                             'threads')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep a header index so reloads only read '
+                             'new or changed files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to keep header indices and '
+                             'sessions in (default: indices in '
+                             '~/.cache/dicomorg, sessions alongside the '
+                             'dicoms)')
+    parser.add_argument('--light', action='store_true',
+                        help='only keep the tags needed for sorting in '
+                             'memory, reading full headers on demand')
+    parser.add_argument('--header-cache', type=int, default=128,
+                        help='with --light, the most full headers to keep '
+                             'cached')
+    parser.add_argument('--header-cache-bytes', type=int, default=None,
+                        help='with --light, the most full header bytes to '
+                             'keep cached')
+    parser.add_argument('--preambleless', action='store_true',
+                        help='also read dicoms without the 128-byte '
+                             'preamble and DICM prefix')
+    parser.add_argument('--archives', action='store_true',
+                        help='read dicoms inside zip and tar archives in '
+                             'place; a location which is an archive is '
+                             'always read this way')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='read dicoms in subdirectories too')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='how many levels of subdirectories to read '
+                             '(implies --recursive)')
+    parser.add_argument('--include', action='append', default=None,
+                        help='glob of files to read; may be repeated')
+    parser.add_argument('--exclude', action='append', default=None,
+                        help='glob of files or directories not to read; '
+                             'may be repeated')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='read the location as this many shards in '
+                             'parallel processes, keeping only the tags '
+                             'needed for sorting, as --light does')
+    parser.add_argument('--index', default=None,
+                        help='load a complete index written by '
+                             'dicomorg-shard instead of reading the '
+                             'location')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of series to convert at once')
+    parser.add_argument('--dcm2niix-batch', type=int, default=1,
+                        metavar='N',
+                        help='convert up to N series in each dcm2niix run, '
+                             'saving a process start per series; not with '
+                             '--background')
+    parser.add_argument('--background', action='store_true',
+                        help='convert in the background, up to --jobs '
+                             'series at once, so that the table can be '
+                             'edited meanwhile')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='converter to use (default: dcm2niix, or '
+                             'those of a resumed session); numpy converts '
+                             'simple uncompressed series in-process and '
+                             'falls back to dcm2niix for the rest')
+    parser.add_argument('--profile', default=None, metavar='JSON',
+                        help='write per-stage timings to this file on '
+                             'quitting')
+    parser.add_argument('--profile-scan', default=None, metavar='STATS',
+                        help='with --profile, also write cProfile stats of '
+                             'reading dicoms to this file')
+    parser.add_argument('--export-db', default=None, metavar='DB',
+                        help='store the headers of each table read in this '
+                             'SQLite database, for dicomorg-find')
+    parser.add_argument('--organise-mode', choices=ORGANISE_MODES,
+                        default='auto',
+                        help='how (o)rganise places files: hardlinks or '
+                             'reflinks where possible and copies '
+                             'otherwise (auto), or only one way')
+    parser.add_argument('--validate', choices=VALIDATION_ACTIONS,
+                        default=None,
+                        help='check series for missing slices and '
+                             'duplicated files before converting, and '
+                             'skip or quarantine those with problems')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help='always convert every series, instead of '
+                             'skipping those already converted')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='do not save the session on quitting, so '
+                             'that the next one reads the dicoms again')
+    parser.add_argument('--fresh', action='store_true',
+                        help='read the dicoms again instead of resuming '
+                             'the saved session')
     args = parser.parse_args()
-    location = op.abspath(args.location)
-    dicomorg(location, template=args.template)
+    if args.location is None and args.index is None:
+        parser.error('no location or index given')
+    location = op.abspath(args.location) if args.location else None
+    if args.profile:
+        prof = timing.enable(profile_scan=args.profile_scan is not None)
+    if args.max_depth is not None:
+        maxdepth = args.max_depth
+    elif args.recursive:
+        maxdepth = None
+    else:
+        maxdepth = 0
+    dicomorg(location, template=args.template, workers=args.workers,
+             processes=args.processes, cache=args.cache or
+             args.cache_dir is not None, cachedir=args.cache_dir,
+             light=args.light, jobs=args.jobs,
+             manifest=not args.no_manifest, preambleless=args.preambleless,
+             maxdepth=maxdepth, include=args.include, exclude=args.exclude,
+             headerentries=args.header_cache,
+             headerbytes=args.header_cache_bytes, backend=args.backend,
+             exportdb=args.export_db, organisemode=args.organise_mode,
+             validate=args.validate, archives=args.archives,
+             shards=args.shards, index=args.index,
+             snapshot=not args.no_snapshot, fresh=args.fresh,
+             convertbatch=args.dcm2niix_batch,
+             background=args.background)
+    if args.profile:
+        prof.dump(args.profile)
+        prof.dump_scan(args.profile_scan)
+        print('Timings written to ' + args.profile)
 
 
-def dicomorg(path, template=None):
+def dicomorg(path, template=None, workers=1, processes=False, cache=False,
+             cachedir=None, light=False, jobs=1, manifest=True,
+             preambleless=False, maxdepth=0, include=None, exclude=None,
+             headerentries=128, headerbytes=None, backend=None,
+             exportdb=None, organisemode='auto', validate=None,
+             archives=False, shards=None, index=None, snapshot=True,
+             fresh=False, convertbatch=1, background=False):
     if template:
-        print('Feature unavailable right now')
+        instructions = read_template(template)
     DCMINSTRUCTIONS = ('Please type (i)gnore, (a)lias, (u)ndo, (r)edo, '
                        '(c)onvert, (f)orce convert (overwrites files), '
-                       'change (p)ath, '
+                       'change (p)ath, set (b)ackend, (o)rganise, '
+                       '(v)alidate, '
+                       'list (j)obs, cancel (x) or convert (n)ext, '
                        '(h)elp, or (q)uit.')
     IGNTEXT = ('Use ignore to remove certain series numbers from the '
                'table. '
@@ -41,92 +177,320 @@ def dicomorg(path, template=None):
 
     UNDOTEXT = ('Undo will undo your latest change and restore the table '
                 'to '
-                'its previous state.\n')
+                'its previous state. Follow it with a series number or '
+                'name to only undo the latest change to that series, '
+                'e.g.,\n'
+                'u 10\n')
 
     REDOTEXT = ('Redo will redo your latest undo and restore the table to '
-                'its future state. Note that using an ignore or alias '
-                'command '
-                'will prohibit you from using redo do due its simple '
-                'implementation.\n')
+                'its future state. Follow it with a series number or '
+                'name to only redo the latest undo of that series. '
+                'Changing a series after undoing it prohibits redoing '
+                'that series, but not others.\n')
+
+    BACKENDTEXT = ('Backend sets the converter, one of ' +
+                   ', '.join(BACKENDS) + ', followed by the numbers of '
+                   'the series to set, or none for all of them, e.g.,\n'
+                   'numpy 10 11\n'
+                   'The numpy converters fall back to dcm2niix for series '
+                   'they cannot handle.\n')
+
+    ORGANISETEXT = ('Organise lays out the dicoms of every series which is '
+                    'not ignored in a Patient/Study/Series tree, naming '
+                    'series directories by their aliases. Files are '
+                    'hardlinked where possible, so no space is used. '
+                    'Run it again on the same destination to resume.\n')
+
+    VALIDATETEXT = ('Validate checks each series for missing slices, '
+                    'duplicated files and echoes of different sizes, '
+                    'using the headers already read.\n')
+
+    JOBSTEXT = ('With --background, convert and force convert queue the '
+                'series and return at once, converting them while you '
+                'keep editing. Jobs lists the conversions; x cancels them '
+                'all, or one if followed by a series, even while it '
+                'converts; n moves a queued series to the front, e.g.,\n'
+                'n 10\n')
 
     PATHTEXT = ('Changing path will dump the current table and read a new '
-                'path, creating a new table.\n')
+                'path, creating a new table. Unless --no-snapshot is '
+                'given, the session is saved first, as it is on quitting, '
+                'and is resumed the next time its path is read.\n')
 
-    HELPTEXT = (IGNTEXT + ALIASTEXT + UNDOTEXT + REDOTEXT + PATHTEXT)
+    HELPTEXT = (IGNTEXT + ALIASTEXT + UNDOTEXT + REDOTEXT + BACKENDTEXT +
+                ORGANISETEXT + VALIDATETEXT + JOBSTEXT + PATHTEXT)
 
     print(DCMINSTRUCTIONS)
     print('Loading data...')
     userinput = ''
 
-    currtable = dcmtable(path)
-    thistable = seriestable(currtable)
-    print(currtable.tablepath)
-
-    while True:
-        if thistable.isempty():
-            print('This directory does not have dicoms.'
-                  'Please enter a new path.')
-            userinput = 'p'
-        else:
-            if not (userinput == 'c' or userinput == 'f'):
-                print(thistable)
-            userinput = input('>> ')
-        if userinput == 'i':
-            userinput = input('>> ')
-            inputvalues = userinput.split(' ')
-            thistable = thistable.ignore(inputvalues)
-        elif userinput == 'h':
-            print(HELPTEXT)
-            continue
-        elif userinput == 'q':
-            break
-        elif userinput == 'a':
-            userinput = input('>> ')
-            thistable = thistable.alias(userinput)
-        elif userinput == 'u':
-            if thistable.prevtable:
-                temptable = copy(thistable.prevtable)
-                temptable.nexttable = copy(thistable)
-                thistable = temptable
-            else:
-                print('No changes to undo')
-        elif userinput == 'r':
-            if thistable.nexttable:
-                thistable = thistable.nexttable
-            else:
-                print('No changes to redo')
-        elif userinput == 'c':
-            print('Enter output destination (leave blank for in-place)')
-            niidest = input('>> ')
-            if niidest == None or len(niidest) == 0:
-                print('Sending to ' + path)
-                thistable.convert()
+    tableargs = dict(workers=workers, processes=processes, cache=cache,
+                     cachedir=cachedir, preambleless=preambleless,
+                     maxdepth=maxdepth, include=include, exclude=exclude,
+                     archives=archives)
+    if light or shards:
+        tabletype = dcmtable_light
+        tableargs.update(headerentries=headerentries,
+                         headerbytes=headerbytes)
+        # Series can be validated at any time, and the indexed tags are
+        # needed to export
+        tags = LIGHT_TAGS + VALIDATION_TAGS
+        if exportdb:
+            tags += INDEXED_TAGS
+        tableargs.update(tags=list(dict.fromkeys(tags)))
+    else:
+        tabletype = dcmtable
+    if shards:
+        tabletype = partial(sharded_table, shards=shards)
+    # What decides which files a snapshot holds
+    settings = dict(preambleless=preambleless, maxdepth=maxdepth,
+                    include=include, exclude=exclude, archives=archives)
+
+    def resume(path, instructions=None):
+        """Returns the session saved for path, or reads path and
+        carries over what it can of a stale session, then exports it and
+        applies the backend and template instructions"""
+        state = None
+        table = None
+        if snapshot and not fresh:
+            fname = snapshot_location(path, cachedir)
+            tags = VALIDATION_TAGS + (list(INDEXED_TAGS) if exportdb else [])
+            try:
+                table = load_snapshot(fname, settings, tags, headerentries,
+                                      headerbytes, path)
+                if table is not None:
+                    print(green('Resumed the session saved in ' + fname))
+            except StaleSnapshot as e:
+                print(blue(str(e) + '; reading the dicoms again'))
+                state = e.state
+            except ValueError as e:
+                print(blue(str(e) + '; reading the dicoms again'))
+        if table is None:
+            table = seriestable(tabletype(path, **tableargs))
+        if exportdb:
+            export_table(table.pathtable, exportdb)
+        if backend:
+            table.set_backend(backend)
+        if instructions:
+            table = apply_template(table, instructions)
+        if state is not None:
+            print(blue('Carried over aliases of ' +
+                       str(table.restore(state)) + ' series'))
+        return table
+
+    def save(table):
+        """Saves a session to be resumed, warning if it cannot"""
+        if not snapshot or index or table.isempty():
+            return
+        fname = snapshot_location(table.pathtable.tablepath, cachedir)
+        try:
+            save_snapshot(table, fname, settings)
+        except OSError as e:
+            print(red('Could not save the session to ' + fname + ': ' +
+                      str(e)))
+
+    if index:
+        try:
+            currtable = merge_indices([index], headerentries, headerbytes)
+        except (OSError, ValueError) as e:
+            print(red(str(e)))
+            return
+        path = currtable.tablepath
+        if exportdb:
+            export_table(currtable, exportdb)
+        thistable = seriestable(currtable)
+        if backend:
+            thistable.set_backend(backend)
+        if template:
+            thistable = apply_template(thistable, instructions)
+    else:
+        thistable = resume(path, instructions if template else None)
+    print(path)
+    engine = conversionengine(jobs) if background else None
+
+    # Saved however the session ends, to be resumed next time
+    try:
+        while True:
+            if thistable.isempty():
+                print('This directory does not have dicoms.'
+                      'Please enter a new path.')
+                userinput = 'p'
             else:
-                niidest = op.abspath(niidest)
-                print('Sending to ' + niidest)
-                thistable.convert(outpath=niidest)
-        elif userinput == 'f':
-            print('Enter output destination (leave blank for in-place)')
-            niidest = input('>> ')
-            if niidest == None or len(niidest) == 0:
-                print('Sending to ' + path)
-                thistable.convert(force=True)
+                if not (userinput == 'c' or userinput == 'f'):
+                    print(thistable)
+                userinput = input('>> ')
+            # Undo, redo, cancel and next may be followed by a series
+            words = userinput.split()
+            if len(words) == 2 and words[0] in ('u', 'r', 'x', 'n'):
+                userinput, target = words
             else:
-                niidest = op.abspath(niidest)
-                print('Sending to ' + niidest)
-                thistable.convert(outpath=niidest, force=True)
-        elif userinput == 'p':
-            print('Enter new reading path.')
-            if not thistable.isempty():
-                print('WARNING: purges current table.')
-            path = op.abspath(op.expanduser(input('>> ')))
-            if not op.exists(newdcmpath):
-                print('Given path ' + newdcmpath + ' does not exist!')
+                target = None
+            if userinput == 'i':
+                userinput = input('>> ')
+                inputvalues = userinput.split(' ')
+                thistable = thistable.ignore(inputvalues)
+            elif userinput == 'h':
+                print(HELPTEXT)
+                continue
+            elif userinput == 'q':
+                if engine and engine.busy():
+                    print(blue('Waiting for ' + str(engine.busy()) +
+                               ' conversions to finish; Ctrl-C cancels '
+                               'them'))
+                    try:
+                        engine.wait()
+                    except KeyboardInterrupt:
+                        engine.close(cancel=True)
+                break
+            elif userinput == 'a':
+                userinput = input('>> ')
+                thistable = thistable.alias(userinput)
+            elif userinput == 'b':
+                words = input('>> ').split()
+                try:
+                    thistable.set_backend(words[0], words[1:] or None)
+                except IndexError:
+                    print(red('No backend given'))
+                except Exception as e:
+                    print(red(str(e)))
+            elif userinput == 'u':
+                try:
+                    if not thistable.undo(target):
+                        if target:
+                            print('There are no changes to undo for series ' +
+                                  target)
+                        else:
+                            print('No changes to undo')
+                except Exception as e:
+                    print(red(str(e)))
+            elif userinput == 'r':
+                try:
+                    if not thistable.redo(target):
+                        if target:
+                            print('There are no changes to redo for series ' +
+                                  target)
+                        else:
+                            print('No changes to redo')
+                except Exception as e:
+                    print(red(str(e)))
+            elif userinput == 'c' or userinput == 'f':
+                print('Enter output destination (leave blank for in-place)')
+                niidest = input('>> ')
+                if niidest == None or len(niidest) == 0:
+                    niidest = None
+                    print('Sending to ' + path)
+                else:
+                    niidest = op.abspath(niidest)
+                    print('Sending to ' + niidest)
+                if engine:
+                    n = thistable.submit(engine, outpath=niidest,
+                                         force=(userinput == 'f'),
+                                         manifest=manifest,
+                                         validate=validate)
+                    print(blue('Queued ' + str(n) + ' series'))
+                else:
+                    thistable.convert(outpath=niidest,
+                                      force=(userinput == 'f'), jobs=jobs,
+                                      manifest=manifest, validate=validate,
+                                      batch=convertbatch)
+            elif userinput == 'j':
+                if not engine:
+                    print('Conversions only run in the background with '
+                          '--background')
+                    continue
+                conversions = engine.get_jobs()
+                colours = {'running': blue, 'cancelling': yellow,
+                           'done': green, 'failed': red,
+                           'cancelled': yellow}
+                for job in conversions:
+                    colour = colours.get(job.state)
+                    print(colour(str(job)) if colour else str(job))
+                if not conversions:
+                    print('No conversions yet')
+                continue
+            elif userinput in ('x', 'n'):
+                if not engine:
+                    print('Conversions only run in the background with '
+                          '--background')
+                    continue
+                try:
+                    series = None
+                    if target:
+                        series = thistable.SeriesList[
+                            thistable.find_series(target)]
+                    if userinput == 'x':
+                        if not engine.cancel(series):
+                            print('Nothing to cancel')
+                    elif series is None:
+                        print('No series given')
+                    elif engine.prioritise(series):
+                        print(blue(str(series) + '\tnext'))
+                    else:
+                        print('Series ' + target + ' is not queued')
+                except Exception as e:
+                    print(red(str(e)))
                 continue
-            currtable = dcmtable(newdcmpath)
-            thistable = seriestable(newdcmpath)
-        else:
-            print('Unrecognized command ' + userinput)
+            elif userinput == 'o':
+                print('Enter destination of the tree')
+                treedest = input('>> ')
+                if not treedest:
+                    print('No destination given')
+                    continue
+                try:
+                    thistable.organise(op.abspath(op.expanduser(treedest)),
+                                       mode=organisemode)
+                except OSError as e:
+                    print(red(str(e)))
+                    print(blue('Run organise again to resume.'))
+            elif userinput == 'v':
+                try:
+                    bad = thistable.validate()
+                except ValueError as e:
+                    print(red(str(e)))
+                    continue
+                for s in bad:
+                    print(red(str(s)))
+                    for p in s.get_problems():
+                        print(red('    ' + p))
+                if not bad:
+                    print(green('No problems found'))
+                continue
+            elif userinput == 'p':
+                print('Enter new reading path.')
+                if not thistable.isempty():
+                    print('WARNING: purges current table.')
+                newdcmpath = op.abspath(op.expanduser(input('>> ')))
+                if not op.exists(newdcmpath):
+                    print('Given path ' + newdcmpath + ' does not exist!')
+                    continue
+                save(thistable)
+                path = newdcmpath
+                thistable = resume(path)
+            else:
+                print('Unrecognized command ' + userinput)
+    finally:
+        save(thistable)
+        if engine:
+            engine.close(cancel=True)
+
+def export_table(table, dbfile):
+    """Stores a table's headers in a database, warning if it cannot"""
+    if isinstance(table, dcmtable_light):
+        # e.g. an index written without them
+        missing = [t for t in INDEXED_TAGS if t not in table.columns]
+        if missing:
+            print(yellow('The table was read without ' +
+                         ', '.join(missing) + '; they are exported empty'))
+    try:
+        db = headerdb(dbfile)
+        try:
+            n = db.export(table)
+        finally:
+            db.close()
+        print('Exported ' + str(n) + ' files to ' + dbfile)
+    except Exception as e:
+        print(red('Could not export to ' + dbfile + ': ' + str(e)))
+
 
 if __name__ =='__main__':
     main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+from dicomorg.database import headerdb, INDEXED_TAGS
+from dicomorg.colors import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='find series in a header database by their tags')
+    parser.add_argument('database', help='database written with --export-db')
+    parser.add_argument('criteria', nargs='*', metavar='TAG=VALUE',
+                        help='indexed tags the series must have, one of ' +
+                             ', '.join(INDEXED_TAGS))
+    parser.add_argument('-s', '--session', default=None,
+                        help='only search this session directory')
+    parser.add_argument('--files', action='store_true',
+                        help='list matching files rather than series')
+    args = parser.parse_args()
+    criteria = {}
+    for c in args.criteria:
+        tag, sep, value = c.partition('=')
+        if not sep:
+            parser.error(c + ' is not of the form TAG=VALUE')
+        criteria[tag] = value
+    db = headerdb(args.database)
+    try:
+        if args.files:
+            tag = sorted(criteria)[0] if criteria else 'SeriesNumber'
+            value = criteria.pop(tag, None)
+            if value is None:
+                groups, values = db.group_by_attribute(tag, args.session)
+                files = [f for g in groups for f in g]
+            else:
+                files = db.group_by_value(tag, value, args.session,
+                                          **criteria)
+            for f in files:
+                print(f)
+            return
+        series = db.find_series(args.session, **criteria)
+    except ValueError as e:
+        print(red(str(e)))
+        sys.exit(1)
+    finally:
+        db.close()
+    session = None
+    for s in series:
+        if s['session'] != session:
+            session = s['session']
+            print(blue(session))
+        print('{:3d}\t{:35s}\t{:5d}'.format(s['SeriesNumber'] or 0,
+                                            s['SeriesDescription'] or '',
+                                            s['files']))
+
+
+if __name__ == '__main__':
+    main()
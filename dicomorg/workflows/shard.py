@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import sys
+import os.path as op
+import argparse
+from dicomorg.shard import index_shard, merge_indices, write_index, \
+    sharded_table
+from dicomorg.scan import SHARD_MODES
+from dicomorg.colors import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='read a large tree of dicoms as shards and merge them')
+    commands = parser.add_subparsers(dest='command')
+    index = commands.add_parser('index', help='read one shard of a tree')
+    index.add_argument('path', help='root of the tree')
+    index.add_argument('--shard', type=int, required=True,
+                       help='which shard to read, from 0')
+    index.add_argument('--of', type=int, required=True,
+                       help='number of shards')
+    run = commands.add_parser('run', help='read every shard of a tree with '
+                                          'local processes and merge them')
+    run.add_argument('path', help='root of the tree')
+    run.add_argument('-n', '--shards', type=int, default=2,
+                     help='number of shards, and of processes')
+    for p in (index, run):
+        p.add_argument('-o', '--output', required=True,
+                       help='index file to write')
+        p.add_argument('--by', choices=SHARD_MODES, default='hash',
+                       help='split files by the hash of their path, or '
+                            'top-level directories by their name')
+        p.add_argument('-w', '--workers', type=int, default=1,
+                       help='number of workers to read dicom headers with '
+                            'in each shard')
+        p.add_argument('-r', '--recursive', action='store_true',
+                       help='read dicoms in subdirectories too')
+        p.add_argument('--preambleless', action='store_true',
+                       help='also read dicoms without the 128-byte '
+                            'preamble and DICM prefix')
+        p.add_argument('--include', action='append', default=None,
+                       help='glob of files to read; may be repeated')
+        p.add_argument('--exclude', action='append', default=None,
+                       help='glob of files or directories not to read; '
+                            'may be repeated')
+    merge = commands.add_parser('merge', help='merge shard indices into '
+                                              'one index')
+    merge.add_argument('indices', nargs='+', help='shard index files')
+    merge.add_argument('-o', '--output', required=True,
+                       help='index file to write')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('no command given')
+
+    try:
+        if args.command == 'merge':
+            table = merge_indices(args.indices)
+            write_index(table, args.output)
+        else:
+            tableargs = dict(workers=args.workers,
+                             preambleless=args.preambleless,
+                             maxdepth=None if args.recursive else 0,
+                             include=args.include, exclude=args.exclude)
+            path = op.abspath(args.path)
+            if args.command == 'index':
+                index_shard(path, args.shard, args.of, args.output,
+                            shardby=args.by, **tableargs)
+                print(green('Shard ' + str(args.shard) + ' of ' +
+                            str(args.of) + ' written to ' + args.output))
+                return
+            table = sharded_table(path, args.shards, shardby=args.by,
+                                  **tableargs)
+            write_index(table, args.output)
+    except (OSError, ValueError) as e:
+        print(red(str(e)))
+        sys.exit(1)
+    print(table)
+    print(green('Index written to ' + args.output))
+
+
+if __name__ == '__main__':
+    main()
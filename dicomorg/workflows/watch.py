@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os.path as op
+import argparse
+from dicomorg.dcmutil import BACKENDS
+from dicomorg.template import read_template
+from dicomorg.watch import watcher
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='watch a directory and convert series as they arrive')
+    parser.add_argument('path', help='directory the scanner writes to')
+    parser.add_argument('-t', '--template', default=None,
+                        help='template of ignore/alias instructions')
+    parser.add_argument('-o', '--output', default=None,
+                        help='directory to put niftis in (default: '
+                             'in-place)')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between checks for new files')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must be unmodified before it '
+                             'is read')
+    parser.add_argument('--stable', type=float, default=60.0,
+                        help='seconds without new files after which a '
+                             'series is converted')
+    parser.add_argument('--poll', action='store_true',
+                        help='list the directory each time instead of '
+                             'using inotify')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of workers to read dicom headers with')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='watch subdirectories too')
+    parser.add_argument('--include', action='append', default=None,
+                        help='glob of files to read; may be repeated')
+    parser.add_argument('--exclude', action='append', default=None,
+                        help='glob of files or directories not to read; '
+                             'may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of series to convert at once')
+    parser.add_argument('--backend', choices=BACKENDS, default='dcm2niix',
+                        help='converter to use')
+    parser.add_argument('--light', action='store_true',
+                        help='only keep the tags needed for sorting in '
+                             'memory')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help='always convert every series, instead of '
+                             'skipping those already converted')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='overwrite existing niftis')
+    args = parser.parse_args()
+    instructions = read_template(args.template) if args.template else None
+    w = watcher(op.abspath(args.path), outpath=args.output,
+                settle=args.settle, stable=args.stable,
+                instructions=instructions, jobs=args.jobs, force=args.force,
+                manifest=not args.no_manifest, backend=args.backend,
+                light=args.light, inotify=False if args.poll else None,
+                workers=args.workers,
+                maxdepth=None if args.recursive else 0,
+                include=args.include, exclude=args.exclude)
+    w.run(interval=args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,11 @@ setup(name='dicomorg',
       author_email='jbtevespro@gmail.com',
       python_requires='>=3.6',
       install_requires='pydicom',
+      extras_require={'numpy': ['numpy'], 'watch': ['inotify_simple']},
       entry_points={'console_scripts':
-          ['dicomorg=dicomorg.workflows:main']}
+          ['dicomorg=dicomorg.workflows:main',
+           'dicomorg-batch=dicomorg.workflows:batch_main',
+           'dicomorg-find=dicomorg.workflows:find_main',
+           'dicomorg-watch=dicomorg.workflows:watch_main',
+           'dicomorg-shard=dicomorg.workflows:shard_main']}
       )
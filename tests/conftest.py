@@ -0,0 +1,47 @@
+"""Fixtures shared by the tests: synthetic sessions and the stub
+dcm2niix from benchmarks, so no real converter is needed"""
+
+import os
+import os.path as op
+import sys
+
+import pytest
+
+BENCHMARKS = op.join(op.dirname(op.dirname(op.abspath(__file__))),
+                     'benchmarks')
+sys.path.insert(0, BENCHMARKS)
+
+from synthetic import make_session  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def stub_dcm2niix(monkeypatch):
+    """Puts the stub dcm2niix first on PATH, answering at once"""
+    monkeypatch.setenv('PATH', op.join(BENCHMARKS, 'bin') + os.pathsep +
+                       os.environ.get('PATH', ''))
+    monkeypatch.setenv('DCM2NIIX_STUB_DELAY', '0')
+
+
+@pytest.fixture
+def session(tmp_path):
+    """A session of three single-echo series of four slices"""
+    path = str(tmp_path / 'session')
+    make_session(path, series=3, slices=4)
+    return path
+
+
+@pytest.fixture
+def me_session(tmp_path):
+    """A session of two series of three echoes of four slices"""
+    path = str(tmp_path / 'me')
+    make_session(path, series=2, slices=4, echoes=3)
+    return path
+
+
+@pytest.fixture
+def two_studies(tmp_path):
+    """A folder holding two studies whose series share numbers"""
+    path = tmp_path / 'studies'
+    make_session(str(path / 'a'), series=2, slices=2)
+    make_session(str(path / 'b'), series=2, slices=2)
+    return str(path)
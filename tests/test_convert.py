@@ -0,0 +1,313 @@
+"""Converting series with the stub dcm2niix: the manifest, dcm2niix
+batches, streaming, the background engine and timings"""
+
+import json
+import os
+import os.path as op
+import time
+
+import pytest
+
+from dicomorg.convert import conversion_outputs
+from dicomorg.dcmutil import dcmtable, seriestable
+from dicomorg.engine import conversionengine
+from dicomorg.manifest import MANIFESTNAME, conversionmanifest
+from dicomorg.pipeline import stream_convert, streamconverter
+
+
+def _outputs(path):
+    return sorted(f for f in os.listdir(path) if not f.startswith('.'))
+
+
+def _manifest(path):
+    with open(op.join(path, MANIFESTNAME)) as f:
+        return json.load(f)['entries']
+
+
+def test_manifest_skips_converted_series(session, tmp_path):
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(session))
+    assert table.convert(outpath, interactive=False) == (3, 0, 0)
+    assert sorted(_manifest(outpath)) == ['1', '2', '3']
+    assert table.convert(outpath, interactive=False) == (0, 3, 0)
+    assert table.convert(outpath, force=True, interactive=False) == (3, 0, 0)
+    # A new alias is a new output name
+    table.alias('2 rest')
+    assert table.convert(outpath, interactive=False) == (1, 2, 0)
+    assert 'rest.nii' in _outputs(outpath)
+
+
+def _touch(series):
+    stat = os.stat(series.files[0])
+    os.utime(series.files[0], ns=(stat.st_atime_ns,
+                                  stat.st_mtime_ns + 10**9))
+
+
+def test_changed_series_replace_their_outputs(session, tmp_path):
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(session))
+    assert table.convert(outpath, interactive=False) == (3, 0, 0)
+    _touch(table.SeriesList[2])
+    assert table.convert(outpath, interactive=False) == (1, 2, 0)
+    _, counts = stream_convert(session, outpath)
+    assert counts == (0, 3, 0)
+    _touch(table.SeriesList[1])
+    _, counts = stream_convert(session, outpath)
+    assert counts == (1, 2, 0)
+    _touch(table.SeriesList[0])
+    engine = conversionengine(jobs=1)
+    try:
+        assert table.submit(engine, outpath) == 1
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert [j.state for j in engine.history] == ['done']
+
+
+def test_streaming_force_bypasses_manifest(session, tmp_path):
+    outpath = str(tmp_path / 'niftis')
+    _, counts = stream_convert(session, outpath)
+    assert counts == (3, 0, 0)
+    _, counts = stream_convert(session, outpath)
+    assert counts == (0, 3, 0)
+    _, counts = stream_convert(session, outpath, force=True)
+    assert counts == (3, 0, 0)
+
+
+def test_streamed_keys_follow_later_series(two_studies, tmp_path):
+    outpath = str(tmp_path / 'niftis')
+    pathtable = dcmtable(two_studies, maxdepth=1)
+    table = seriestable(pathtable)
+    # Whichever study sorts second is read first
+    first = [f for s in table.SeriesList if s.get_key().endswith('.2')
+             for f in s.files]
+    rest = [f for f in pathtable.filelist if f not in first]
+    converter = streamconverter(outpath, aliases={'1.1': 't1', '2.2': ''})
+    converter(pathtable, first)
+    converter(pathtable, [])
+    # Sent before the other study arrived, as 1 and 2
+    assert sorted(v[1].get_key() for v in converter.dispatched.values()) \
+        == ['1', '2']
+    converter(pathtable, rest)
+    converted, skipped, failures = converter.finish(pathtable)
+    assert failures == 0
+    assert _outputs(outpath) == ['series1_1-2.json', 'series1_1-2.nii',
+                                 'series2_2-1.json', 'series2_2-1.nii',
+                                 't1.json', 't1.nii']
+    assert sorted(_manifest(outpath)) == ['1.1', '1.2', '2.1']
+    for s in table.SeriesList:
+        sent = [v[1] for v in converter.dispatched.values()
+                if v[1].get_uid() == s.get_uid()][0]
+        assert sent.get_key() == s.get_key()
+
+
+@pytest.mark.parametrize('echoes', [1, 3])
+def test_batches_name_outputs_as_single_runs(tmp_path, echoes):
+    from synthetic import make_session
+    path = str(tmp_path / 'session')
+    make_session(path, series=3, slices=2, echoes=echoes)
+    table = seriestable(dcmtable(path))
+    table.alias('2 rest')
+    single = str(tmp_path / 'single')
+    batched = str(tmp_path / 'batched')
+    assert table.convert(single, interactive=False)[0] == 3
+    assert table.convert(batched, interactive=False, batch=3)[0] == 3
+    assert _outputs(single) == _outputs(batched)
+
+
+def test_batch_runs_dcm2niix_once(session, tmp_path, monkeypatch):
+    import dicomorg.convert
+    calls = []
+    run = dicomorg.convert.run_dcm2niix
+
+    def counted(args, nfiles, verbose=False):
+        calls.append(args)
+        return run(args, nfiles, verbose)
+
+    monkeypatch.setattr(dicomorg.convert, 'run_dcm2niix', counted)
+    table = seriestable(dcmtable(session))
+    outpath = str(tmp_path / 'niftis')
+    assert table.convert(outpath, interactive=False, batch=8) == (3, 0, 0)
+    assert len(calls) == 1
+    assert _outputs(outpath) == ['series{}.{}'.format(n, e)
+                                 for n in (1, 2, 3) for e in ('json', 'nii')]
+
+
+def test_batch_converts_unclaimed_series_alone(session, tmp_path,
+                                               monkeypatch):
+    import dicomorg.dcmutil
+    from dicomorg.convert import ConversionError
+
+    def nothing(groups, path, overwrite=False):
+        return [ConversionError('dcm2niix produced nothing for ' + g[1])
+                for g in groups]
+
+    monkeypatch.setattr(dicomorg.dcmutil, 'dcm2niix_batch', nothing)
+    table = seriestable(dcmtable(session))
+    outpath = str(tmp_path / 'niftis')
+    assert table.convert(outpath, interactive=False, batch=8) == (3, 0, 0)
+
+
+def test_engine_keeps_one_manifest(session, tmp_path, monkeypatch):
+    monkeypatch.setenv('DCM2NIIX_STUB_DELAY', '0.2')
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(session))
+    engine = conversionengine(jobs=1)
+    try:
+        assert table.submit(engine, outpath) == 3
+        time.sleep(0.3)
+        # The first series is done and the second converting
+        table.submit(engine, outpath)
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert sorted(_manifest(outpath)) == ['1', '2', '3']
+
+
+def test_engine_prioritises_series(session, tmp_path, monkeypatch):
+    monkeypatch.setenv('DCM2NIIX_STUB_DELAY', '0.2')
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(session))
+    engine = conversionengine(jobs=1)
+    try:
+        table.submit(engine, outpath)
+        assert engine.prioritise(table.SeriesList[2])
+        queued = [j for j in engine.get_jobs() if j.state == 'queued']
+        assert queued[0].series is table.SeriesList[2]
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert [j.state for j in engine.history] == ['done'] * 3
+
+
+def test_cancelled_multiecho_series_can_be_requeued(me_session, tmp_path,
+                                                   monkeypatch):
+    monkeypatch.setenv('DCM2NIIX_STUB_DELAY', '0.5')
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(me_session))
+    table.ignore(['2'])
+    engine = conversionengine(jobs=1)
+    try:
+        table.submit(engine, outpath)
+        # Cancel while the second echo converts
+        first = op.join(outpath, 'series1_echo-1.json')
+        deadline = time.time() + 30
+        while not op.exists(first) and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        assert engine.cancel() == 1
+        assert engine.wait(30)
+        assert _outputs(outpath) == []
+        assert table.submit(engine, outpath) == 1
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert [j.state for j in engine.history] == ['cancelled', 'done']
+    assert len(_outputs(outpath)) == 6
+
+
+def test_watcher_converts_arriving_series(session, tmp_path):
+    from dicomorg.watch import watcher
+    outpath = str(tmp_path / 'niftis')
+    w = watcher(session, outpath, settle=0, stable=0, inotify=False)
+    try:
+        w.cycle()
+        w.cycle()
+        w.converter.collect(wait=True)
+        assert _outputs(outpath) == ['series{}.{}'.format(n, e)
+                                     for n in (1, 2, 3)
+                                     for e in ('json', 'nii')]
+        gone = w.series.SeriesList[2].files
+        for f in gone:
+            os.remove(f)
+        added, removed = w.cycle()
+        assert sorted(removed) == sorted(gone)
+        assert [s.get_key() for s in w.series.SeriesList] == ['1', '2']
+    finally:
+        w.close()
+
+
+def test_outputs_are_only_dcm2niix_suffixes(tmp_path):
+    for name in ('T1.nii', 'T1.json', 'T1_e2.nii', 'T1_i00002.nii.gz',
+                 'T1_fmap.nii', 'T1_fmap.json', 'T1a.nii', 'T1.txt',
+                 'me_echo-1.nii', 'me_echo-2_ph.json', 'me_echo-x.nii'):
+        (tmp_path / name).write_text('')
+    names = [op.basename(f) for f in conversion_outputs('T1', str(tmp_path))]
+    assert names == ['T1.json', 'T1.nii', 'T1_e2.nii', 'T1_i00002.nii.gz']
+    names = [op.basename(f)
+             for f in conversion_outputs('me_echo-%e', str(tmp_path))]
+    assert names == ['me_echo-1.nii', 'me_echo-2_ph.json']
+
+
+def test_cancel_keeps_outputs_sharing_a_prefix(session, tmp_path,
+                                               monkeypatch):
+    monkeypatch.setenv('DCM2NIIX_STUB_DELAY', '1')
+    outpath = str(tmp_path / 'niftis')
+    table = seriestable(dcmtable(session))
+    table.alias('1 T1_fmap 2 T1')
+    table.ignore(['3'])
+    engine = conversionengine(jobs=2)
+    try:
+        engine.submit(table.SeriesList[0], outpath)
+        time.sleep(0.5)
+        engine.submit(table.SeriesList[1], outpath)
+        # Cancel T1 once T1_fmap, which finished while it ran, is done
+        deadline = time.time() + 30
+        while (table.SeriesList[0] not in
+               [j.series for j in engine.history if j.state == 'done'] and
+               time.time() < deadline):
+            time.sleep(0.05)
+        assert engine.cancel(table.SeriesList[1]) == 1
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert [j.state for j in engine.history] == ['done', 'cancelled']
+    assert _outputs(outpath) == ['T1_fmap.json', 'T1_fmap.nii']
+
+
+def test_engine_survives_manifest_errors(session, tmp_path, monkeypatch):
+    def unwritable(self):
+        raise OSError('read-only file system')
+
+    monkeypatch.setattr(conversionmanifest, 'save', unwritable)
+    table = seriestable(dcmtable(session))
+    engine = conversionengine(jobs=1)
+    try:
+        assert table.submit(engine, str(tmp_path / 'niftis')) == 3
+        assert engine.wait(30)
+    finally:
+        engine.close()
+    assert [j.state for j in engine.history] == ['failed'] * 3
+    assert 'read-only' in str(engine.history[0].error)
+
+
+def test_timings_are_written_as_json(session, tmp_path):
+    from dicomorg import timing
+    prof = timing.enable()
+    try:
+        table = seriestable(dcmtable(session))
+        with timing.stage('outer'):
+            with timing.stage('inner', files=2, nbytes=10):
+                pass
+        table.convert(str(tmp_path / 'niftis'), interactive=False)
+    finally:
+        assert timing.disable() is prof
+    with timing.stage('outer'):
+        pass
+    fname = str(tmp_path / 'profile.json')
+    prof.dump(fname)
+    with open(fname) as f:
+        report = json.load(f)
+    stages = report['stages']
+    assert (stages['parse']['calls'], stages['parse']['files']) == (1, 12)
+    assert stages['parse']['bytes'] > 0
+    assert (stages['dcm2niix']['calls'], stages['dcm2niix']['files']) == \
+        (3, 12)
+    assert stages['convert']['wall'] >= stages['dcm2niix']['wall']
+    # Stages nest, and nothing is counted once disabled
+    assert stages['outer']['calls'] == 1
+    assert stages['outer']['wall'] >= stages['inner']['wall']
+    assert (stages['inner']['files'], stages['inner']['bytes']) == (2, 10)
+    assert [(s['command'][0], s['files'], s['returncode'])
+            for s in report['subprocesses']] == [('dcm2niix', 4, 0)] * 3
+    assert report['seconds'] >= stages['convert']['wall']
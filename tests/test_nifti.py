@@ -0,0 +1,110 @@
+"""The in-process numpy converter: orientation, voxel sizes and data"""
+
+import json
+import os.path as op
+import struct
+
+import numpy as np
+import pytest
+from pydicom.uid import generate_uid
+
+from synthetic import make_header
+
+from dicomorg.nifti import numpy_convert, NIFTI_HEADER, UnsupportedSeries
+
+ROWS, COLUMNS = 3, 5
+# A coronal acquisition: rows run right to left, columns head to foot
+ORIENTATION = [1, 0, 0, 0, 0, -1]
+SPACING = [0.5, 0.75]
+ORIGIN = np.array([-10.0, 20.0, 30.0])
+GAP = 2.5
+
+
+def _write_series(path, slices, volumes=1):
+    """Writes slices with distinct pixels, returning the files shuffled
+    and the (volumes, slices, rows, columns) data they hold"""
+    study, uid = generate_uid(), generate_uid()
+    data = np.arange(volumes * slices * ROWS * COLUMNS, dtype='<u2')
+    data = data.reshape(volumes, slices, ROWS, COLUMNS)
+    files = []
+    for v in range(volumes):
+        for i in range(slices):
+            ds = make_header(1, 1, i, study, uid, slices, 10.0, ROWS, COLUMNS)
+            ds.AcquisitionNumber = v + 1
+            ds.InstanceNumber = v * slices + i + 1
+            ds.ImageOrientationPatient = ORIENTATION
+            ds.ImagePositionPatient = list(ORIGIN + [0, i * GAP, 0])
+            ds.PixelSpacing = SPACING
+            ds.PixelData = data[v, i].tobytes()
+            files.append(op.join(path, 'IM{:05d}.dcm'.format(len(files))))
+            ds.save_as(files[-1], enforce_file_format=True)
+    return files[::-1], data
+
+
+def _read_nifti(fname):
+    """Returns the header fields of a nifti and its data bytes"""
+    with open(fname, 'rb') as f:
+        contents = f.read()
+    fields = struct.unpack(NIFTI_HEADER, contents[:348])
+    header = {'dim': fields[7:15], 'datatype': fields[19],
+              'bitpix': fields[20], 'pixdim': fields[22:30],
+              'vox_offset': fields[30], 'qform_code': fields[44],
+              'sform_code': fields[45], 'quatern': fields[46:49],
+              'qoffset': fields[49:52],
+              'srow': np.array(fields[52:64]).reshape(3, 4),
+              'magic': fields[65]}
+    return header, contents[int(header['vox_offset']):]
+
+
+def _qform(header):
+    """Rebuilds the qform matrix from the quaternion and voxel sizes"""
+    b, c, d = header['quatern']
+    a = np.sqrt(max(0.0, 1 - b * b - c * c - d * d))
+    rotation = np.array([
+        [a*a + b*b - c*c - d*d, 2 * (b*c - a*d), 2 * (b*d + a*c)],
+        [2 * (b*c + a*d), a*a + c*c - b*b - d*d, 2 * (c*d - a*b)],
+        [2 * (b*d - a*c), 2 * (c*d + a*b), a*a + d*d - b*b - c*c]])
+    rotation[:, 2] *= header['pixdim'][0]
+    return np.column_stack([rotation * header['pixdim'][1:4],
+                            header['qoffset']])
+
+
+def test_writer_orients_and_orders_slices(tmp_path):
+    files, data = _write_series(str(tmp_path), slices=4)
+    outpath = str(tmp_path / 'niftis')
+    assert numpy_convert(files, 'coronal', outpath) == [
+        op.join(outpath, 'coronal.nii'), op.join(outpath, 'coronal.json')]
+    header, voxels = _read_nifti(op.join(outpath, 'coronal.nii'))
+    assert header['magic'] == b'n+1\0'
+    assert header['dim'] == (3, COLUMNS, ROWS, 4, 1, 1, 1, 1)
+    assert (header['datatype'], header['bitpix']) == (512, 16)
+    assert header['pixdim'][1:4] == pytest.approx(
+        (SPACING[1], SPACING[0], GAP))
+    # Dicom is LPS+ and nifti RAS+, so x and y change sign
+    assert header['srow'] == pytest.approx(np.array([
+        [-SPACING[1], 0, 0, 10],
+        [0, 0, -GAP, -20],
+        [0, -SPACING[0], 0, 30]]))
+    assert (header['qform_code'], header['sform_code']) == (1, 1)
+    # The quaternion is stored as float32, which loses a little
+    assert _qform(header) == pytest.approx(header['srow'], abs=1e-3)
+    # The first voxel index runs along a row, the last across slices
+    volume = np.frombuffer(voxels, dtype='<u2').reshape(4, ROWS, COLUMNS)
+    assert np.array_equal(volume, data[0])
+    with open(op.join(outpath, 'coronal.json')) as f:
+        assert json.load(f)['SeriesDescription'] == 'series1'
+    with pytest.raises(ValueError, match='would be overwritten'):
+        numpy_convert(files, 'coronal', outpath)
+
+
+def test_writer_stacks_volumes(tmp_path):
+    files, data = _write_series(str(tmp_path), slices=3, volumes=2)
+    outpath = str(tmp_path / 'niftis')
+    numpy_convert(files, 'series', outpath)
+    header, voxels = _read_nifti(op.join(outpath, 'series.nii'))
+    assert header['dim'][:5] == (4, COLUMNS, ROWS, 3, 2)
+    assert header['pixdim'][4] == pytest.approx(2.0)
+    volumes = np.frombuffer(voxels, dtype='<u2').reshape(data.shape)
+    assert np.array_equal(volumes, data)
+    with pytest.raises(UnsupportedSeries, match='complete volumes'):
+        numpy_convert(files[1:], 'partial', outpath)
@@ -0,0 +1,143 @@
+"""Reading headers: worker pools, the header index, the preamble check
+and the header cache of light tables"""
+
+import os
+import os.path as op
+
+import pytest
+
+from synthetic import make_session
+
+import dicomorg.dcmutil
+from dicomorg.cache import headercache, headerlru
+from dicomorg.dcmutil import dcmtable, dcmtable_light
+from dicomorg.scan import (classify, classify_start, PREAMBLE_LENGTH, PREFIX,
+                           SKIP_DIRECTORY, SKIP_SPECIAL, SKIP_SMALL,
+                           SKIP_NOPREFIX, SKIP_UNREADABLE)
+
+
+@pytest.fixture
+def mixed(tmp_path):
+    """A nested session with non-dicom files among the dicoms"""
+    path = str(tmp_path / 'mixed')
+    make_session(path, series=3, slices=8, echoes=2, junk=10, depth=2)
+    return path
+
+
+def _contents(table):
+    return (table.filelist, table.skipped,
+            table.attribute_values('SeriesNumber'),
+            table.attribute_values('EchoTime'))
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_workers_read_the_same_table(mixed, processes):
+    serial = dcmtable(mixed, maxdepth=None)
+    parallel = dcmtable(mixed, maxdepth=None, workers=4,
+                        processes=processes)
+    assert len(serial.filelist) == 48
+    assert serial.skipped == {'too small': 10}
+    assert _contents(parallel) == _contents(serial)
+
+
+def test_header_index_reads_only_changed_files(session, tmp_path,
+                                               monkeypatch):
+    cachedir = str(tmp_path / 'cache')
+    reads = []
+    read_headers = dicomorg.dcmutil.read_headers
+
+    def counted(files, *args, **kwargs):
+        reads.extend(files)
+        return read_headers(files, *args, **kwargs)
+
+    monkeypatch.setattr(dicomorg.dcmutil, 'read_headers', counted)
+    first = dcmtable(session, cache=True, cachedir=cachedir)
+    assert len(reads) == 12
+    del reads[:]
+    again = dcmtable(session, cache=True, cachedir=cachedir)
+    assert reads == []
+    assert _contents(again) == _contents(first)
+
+    changed, gone = first.filelist[0], first.filelist[-1]
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    os.remove(gone)
+    table = dcmtable(session, cache=True, cachedir=cachedir)
+    assert reads == [changed]
+    assert table.filelist == first.filelist[:-1]
+    assert sorted(headercache(session, cachedir).entries) == table.filelist
+
+
+def test_preamble_check_gives_skip_reasons(session):
+    first = dcmtable(session).filelist[0]
+    with open(first, 'rb') as f:
+        contents = f.read()
+    with open(op.join(session, 'notes.txt'), 'wb') as f:
+        f.write(b'a' * 64)
+    with open(op.join(session, 'report.pdf'), 'wb') as f:
+        f.write(b'%PDF' + bytes(256))
+    with open(op.join(session, 'bare.dcm'), 'wb') as f:
+        f.write(contents[PREAMBLE_LENGTH + len(PREFIX):])
+    os.mkfifo(op.join(session, 'pipe'))
+    os.mkdir(op.join(session, 'sub'))
+
+    assert classify(first) == (None, False)
+    assert classify(op.join(session, 'sub')) == (SKIP_DIRECTORY, False)
+    assert classify(op.join(session, 'missing')) == (SKIP_UNREADABLE, False)
+    assert classify(op.join(session, 'bare.dcm')) == (SKIP_NOPREFIX, False)
+    assert classify(op.join(session, 'bare.dcm'), preambleless=True) == \
+        (None, True)
+    assert classify_start(b'\x08\x00', preambleless=True) == (None, True)
+    assert classify_start(b'\x08\x00') == (SKIP_SMALL, False)
+
+    table = dcmtable(session)
+    assert len(table.filelist) == 12
+    assert table.skipped == {SKIP_SMALL: 1, SKIP_NOPREFIX: 2,
+                             SKIP_SPECIAL: 1, SKIP_DIRECTORY: 1}
+    table = dcmtable(session, preambleless=True)
+    assert op.join(session, 'bare.dcm') in table.filelist
+    assert table.skipped[SKIP_NOPREFIX] == 1
+
+
+def test_header_cache_evicts_least_recently_used():
+    loaded = []
+
+    def loader(fname):
+        loaded.append(fname)
+        return fname.upper(), 10
+
+    cache = headerlru(maxentries=2, maxbytes=None)
+    assert cache.get('a', loader) == 'A'
+    cache.get('b', loader)
+    cache.get('a', loader)
+    # b is now the least recently used
+    cache.get('c', loader)
+    cache.get('a', loader)
+    cache.get('b', loader)
+    assert loaded == ['a', 'b', 'c', 'b']
+    assert cache.info() == {'hits': 2, 'misses': 4, 'evictions': 2,
+                            'entries': 2, 'bytes': 20, 'maxentries': 2,
+                            'maxbytes': None}
+    cache = headerlru(maxentries=None, maxbytes=25)
+    for fname in 'abc':
+        cache.get(fname, loader)
+    assert (len(cache), cache.nbytes, cache.evictions) == (2, 20, 1)
+    # A header bigger than the limit is still kept until the next one
+    cache = headerlru(maxentries=None, maxbytes=5)
+    cache.get('a', loader)
+    assert len(cache) == 1
+
+
+def test_light_table_reads_headers_once(session):
+    table = dcmtable_light(session, headerentries=4)
+    files = table.filelist
+    for fname in files[:4] + files[:4]:
+        assert table.get_header(fname).SeriesDescription == 'series1'
+    assert table.headers.info()['misses'] == 4
+    assert table.headers.info()['hits'] == 4
+    table.get_header(files[4])
+    assert len(table.headers) == 4
+    assert table.headers.evictions == 1
+    assert table.get_header('missing.dcm') is None
+    with pytest.raises(ValueError, match='not in the file table'):
+        table.access('missing.dcm')
@@ -0,0 +1,119 @@
+"""Templates, validation, organising and resuming sessions"""
+
+import os
+import os.path as op
+import pickle
+
+import pytest
+
+from dicomorg.cache import snapshot_location, cache_location
+from dicomorg.dcmutil import (dcmtable, dcmtable_light, seriestable,
+                              LIGHT_TAGS)
+from dicomorg.organise import place
+from dicomorg.snapshot import save_snapshot, load_snapshot, StaleSnapshot
+from dicomorg.template import read_template, template_aliases
+from dicomorg.validate import VALIDATION_TAGS
+
+
+def test_template_aliases_keep_keys_as_typed(tmp_path):
+    template = tmp_path / 'template.txt'
+    template.write_text('# comment\nignore 1 2\nalias 10.2 t1 3 rest\n'
+                        'alias 1 scout\n')
+    aliases = template_aliases(read_template(str(template)))
+    assert aliases == {'1': 'scout', '2': '', '10.2': 't1', '3': 'rest'}
+    with pytest.raises(Exception, match='cannot be converted'):
+        template_aliases([('alias', 't1 10')])
+
+
+def test_template_aliases_match_shared_numbers(two_studies, tmp_path):
+    from dicomorg.pipeline import stream_convert
+    outpath = str(tmp_path / 'niftis')
+    table, counts = stream_convert(
+        two_studies, outpath, maxdepth=1,
+        instructions=[('alias', '1.2 t1'), ('ignore', '2.1 2.2')])
+    assert counts == (2, 0, 0)
+    assert 't1.nii' in os.listdir(outpath)
+    assert table.SeriesList[table.find_series('1.2')].get_alias() == 't1'
+
+
+def _drop_slice(path):
+    os.remove(op.join(path, 'IM001_01_00001.dcm'))
+
+
+def test_validation_finds_missing_slices(session):
+    _drop_slice(session)
+    for pathtable in (dcmtable(session),
+                      dcmtable_light(session,
+                                     tags=LIGHT_TAGS + VALIDATION_TAGS)):
+        invalid = seriestable(pathtable).validate()
+        assert [s.get_key() for s in invalid] == ['1']
+        assert invalid[0].get_problems()
+
+
+def test_validation_refuses_light_table_without_tags(session):
+    _drop_slice(session)
+    table = seriestable(dcmtable_light(session))
+    with pytest.raises(ValueError, match='read without'):
+        table.validate()
+
+
+def test_organise_resumes_and_keeps_files(session, tmp_path):
+    outpath = str(tmp_path / 'tree')
+    table = seriestable(dcmtable(session))
+    table.alias('2 rest')
+    counts = table.organise(outpath)
+    assert sum(counts.values()) == 12
+    assert op.isdir(op.join(outpath, 'SYNTHETIC'))
+    assert table.organise(outpath)['journal'] == 12
+
+
+def test_place_refuses_different_file_of_same_size(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    src.write_bytes(b'a' * 64)
+    dst.write_bytes(b'b' * 64)
+    with pytest.raises(FileExistsError):
+        place(str(src), str(dst))
+    dst.write_bytes(b'a' * 64)
+    assert place(str(src), str(dst)) == 'existing'
+
+
+def test_snapshot_resumes_session(session):
+    table = seriestable(dcmtable(session))
+    table.alias('1 t1')
+    table.ignore(['3'])
+    fname = snapshot_location(session)
+    save_snapshot(table, fname, {'maxdepth': 0})
+    resumed = load_snapshot(fname, {'maxdepth': 0}, path=session)
+    assert [s.get_alias() for s in resumed.SeriesList] == \
+        [s.get_alias() for s in table.SeriesList]
+    assert resumed.undo()
+    assert resumed.SeriesList[2].get_alias() is None
+    with pytest.raises(StaleSnapshot):
+        load_snapshot(fname, {'maxdepth': 1}, path=session)
+    with pytest.raises(ValueError, match='is not of'):
+        load_snapshot(fname, {'maxdepth': 0}, path=op.dirname(session))
+    _drop_slice(session)
+    with pytest.raises(StaleSnapshot):
+        load_snapshot(fname, {'maxdepth': 0}, path=session)
+
+
+class _planted:
+    """Runs code when unpickled"""
+    def __init__(self, marker):
+        self.marker = marker
+
+    def __reduce__(self):
+        return os.mkdir, (self.marker,)
+
+
+def test_planted_pickle_is_never_loaded(session, tmp_path):
+    marker = str(tmp_path / 'ran')
+    fname = snapshot_location(session)
+    with open(fname, 'wb') as f:
+        pickle.dump(_planted(marker), f)
+    with pytest.raises(ValueError, match='unreadable'):
+        load_snapshot(fname, path=session)
+    assert not op.exists(marker)
+    # Header indices are never looked for next to the dicoms
+    assert not cache_location(session).startswith(session)
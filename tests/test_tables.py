@@ -0,0 +1,149 @@
+"""Reading sessions into tables and grouping them into series"""
+
+import json
+import os
+import os.path as op
+import pickle
+import zipfile
+
+import pytest
+
+from dicomorg.database import headerdb, INDEXED_TAGS
+from dicomorg.dcmutil import (dcmtable, dcmtable_light, seriestable,
+                              header_value, compact_value, read_header,
+                              LIGHT_TAGS)
+from dicomorg.shard import (index_shard, merge_indices, sharded_table,
+                            read_index)
+from dicomorg.validate import VALIDATION_TAGS
+
+
+def _keys(table):
+    return [s.get_key() for s in table.SeriesList]
+
+
+def test_series_are_grouped_by_number_and_echo(me_session):
+    table = seriestable(dcmtable(me_session))
+    assert _keys(table) == ['1', '2']
+    for s in table.SeriesList:
+        assert s.is_me()
+        assert len(s.files) == 12
+        assert [len(g) for g in s.echo_groups] == [4, 4, 4]
+
+
+def test_light_table_groups_like_full_table(me_session):
+    full = seriestable(dcmtable(me_session))
+    light = seriestable(dcmtable_light(me_session))
+    assert _keys(light) == _keys(full)
+    assert ([s.files for s in light.SeriesList] ==
+            [s.files for s in full.SeriesList])
+
+
+def test_header_value_matches_pydicom(session):
+    tags = LIGHT_TAGS + VALIDATION_TAGS
+    for f in dcmtable(session).filelist:
+        header = read_header(f, tags=tags)
+        for tag in tags:
+            expected = compact_value(getattr(header, tag, None))
+            assert header_value(header, tag) == expected
+
+
+def test_series_sharing_a_number_get_counters(two_studies):
+    table = seriestable(dcmtable(two_studies, maxdepth=1))
+    assert sorted(_keys(table)) == ['1.1', '1.2', '2.1', '2.2']
+    with pytest.raises(Exception, match='Several series are numbered 1'):
+        table.alias('1 t1')
+    table.alias('1.2 t1')
+    assert table.SeriesList[table.find_series('1.2')].get_alias() == 't1'
+
+
+def test_undo_and_redo_each_series(session):
+    table = seriestable(dcmtable(session))
+    table.alias('1 t1')
+    table.alias('2 rest')
+    table.alias('1 mprage')
+    assert table.undo('2')
+    assert table.SeriesList[1].get_alias() is None
+    assert table.SeriesList[0].get_alias() == 'mprage'
+    # Undoing one series is a change itself, undone first
+    assert table.undo()
+    assert table.SeriesList[1].get_alias() == 'rest'
+    assert table.undo()
+    assert table.SeriesList[0].get_alias() == 't1'
+    assert table.redo()
+    assert table.SeriesList[0].get_alias() == 'mprage'
+    assert table.redo()
+    assert table.SeriesList[1].get_alias() is None
+    assert not table.redo()
+
+
+def test_added_and_removed_files_regroup(session, tmp_path):
+    pathtable = dcmtable(session)
+    table = seriestable(pathtable)
+    table.alias('1 t1')
+    gone = table.SeriesList[2].files
+    pathtable.remove_files(gone)
+    assert table.remove_files(gone) == [3]
+    assert _keys(table) == ['1', '2']
+    assert table.SeriesList[0].get_alias() == 't1'
+    assert table.undo()
+    assert table.SeriesList[0].get_alias() is None
+
+
+def test_archive_reads_like_directory(session, tmp_path):
+    archive = str(tmp_path / 'export.zip')
+    with zipfile.ZipFile(archive, 'w') as z:
+        for f in sorted(os.listdir(session)):
+            z.write(op.join(session, f), f)
+    table = seriestable(dcmtable(archive))
+    assert _keys(table) == _keys(seriestable(dcmtable(session)))
+    outpath = str(tmp_path / 'niftis')
+    converted, skipped, failures = table.convert(outpath,
+                                                 interactive=False)
+    assert (converted, skipped, failures) == (3, 0, 0)
+    assert op.exists(op.join(outpath, 'series1.nii'))
+
+
+def test_merged_shards_match_full_read(session, tmp_path):
+    full = dcmtable_light(session)
+    parts = []
+    for i in range(3):
+        parts.append(str(tmp_path / 'part{}.idx'.format(i)))
+        index_shard(session, i, 3, parts[-1])
+    merged = merge_indices(parts)
+    assert merged.filelist == full.filelist
+    for tag in LIGHT_TAGS:
+        assert merged.attribute_values(tag) == full.attribute_values(tag)
+    sharded = sharded_table(session, shards=2)
+    assert sharded.filelist == full.filelist
+
+
+def test_malformed_indices_are_refused(session, tmp_path):
+    fname = str(tmp_path / 'part.idx')
+    index_shard(session, 0, 1, fname)
+    with open(fname) as f:
+        contents = json.load(f)
+    del contents['columns']['SeriesNumber']
+    with open(fname, 'w') as f:
+        json.dump(contents, f)
+    with pytest.raises(ValueError, match='malformed'):
+        read_index(fname)
+    with open(fname, 'wb') as f:
+        pickle.dump({'version': 1}, f)
+    with pytest.raises(ValueError, match='unreadable'):
+        read_index(fname)
+    with open(fname, 'w') as f:
+        json.dump({'version': contents['version']}, f)
+    with pytest.raises(ValueError, match='not a dicomorg index'):
+        merge_indices([fname])
+
+
+def test_exported_light_table_is_searchable(session, tmp_path):
+    db = headerdb(str(tmp_path / 'archive.db'))
+    try:
+        db.export(dcmtable_light(session,
+                                 tags=LIGHT_TAGS + list(INDEXED_TAGS)))
+        found = db.find_series(Modality='MR', SeriesDescription='series2')
+        assert [(s['SeriesNumber'], s['files']) for s in found] == [(2, 4)]
+        assert len(db.table(op.abspath(session)).filelist) == 12
+    finally:
+        db.close()